@@ -1,31 +1,2255 @@
-from textblob import TextBlob, Word
-import pandas as pd
-import prettytable
-#from StringIO import StringIO
-from io import StringIO
+# pandas, numpy, TextBlob (with NLTK), asyncio and multiprocessing are imported
+# where they are first needed: importing them takes most of the startup time
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+import argparse
+import csv
+import json
+import math
+import os
+import re
+import struct
 import sys
+import threading
+import time
+import weakref
+import zlib
+
+
+def percentile(values, q):
+    """
+    Nearest-rank percentile
+    :param values: iterable of numbers
+    :param float q: percentile (0-100)
+    """
+
+    values = sorted(values)
+    if not values:
+        return 0.0
+
+    return values[max(0, int(math.ceil(q / 100.0 * len(values))) - 1)]
+
+
+def peak_rss():
+    """Peak resident set size of the process in bytes (None if unknown)"""
+
+    # Linux: high water mark of this program (ru_maxrss keeps the peak of the parent across exec)
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+
+    try:
+        import resource
+    except ImportError:
+        return None
+
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+class LRUCache(object):
+    """ Bounded least-recently-used cache with hit/miss counters """
+
+    def __init__(self, maxsize=4096):
+        """
+        Constructor for LRUCache
+        :param int maxsize: maximal number of entries (0 disables the cache)
+        """
+
+        self._maxsize = maxsize
+        self._items = OrderedDict()
+        # the bot normalizes words in worker threads
+        self._lock = threading.Lock()
+        # number of successful and failed lookups
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    @property
+    def maxsize(self):
+        return self._maxsize
+
+    def get(self, key, default=None):
+        """Return cached value (and mark it as recently used) or default"""
+
+        with self._lock:
+            try:
+                value = self._items[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Store the value, evicting the least recently used entries if needed"""
+
+        if self._maxsize <= 0:
+            return
+
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self._maxsize:
+                self._items.popitem(last=False)
+
+    def items(self):
+        """List of (key, value) pairs, least recently used first"""
+
+        with self._lock:
+            return list(self._items.items())
+
+    def clear(self):
+        """Drop all entries and reset counters"""
+
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """Return dictionary with size and hit/miss counters"""
+
+        lookups = self.hits + self.misses
+        return {'size': len(self._items),
+                'maxsize': self._maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+    def save(self, FileName):
+        """
+        Save entries (least recently used first) to a json file
+        :param str FileName: name of the file
+        """
+
+        items = [[str(key), str(value)] for key, value in self.items()]
+        with open(FileName, 'w') as f:
+            json.dump(items, f)
+
+    def load(self, FileName):
+        """
+        Load entries saved with save()
+        :param str FileName: name of the file
+        """
+
+        with open(FileName) as f:
+            for key, value in json.load(f):
+                self.put(key, value)
+
+
+class DomainCorrector(object):
+    """
+    Spell corrector over a closed vocabulary (symmetric delete index)
+
+    Every vocabulary word is indexed under all its deletes up to max_distance,
+    so a lookup only generates the deletes of the input word and checks the
+    few candidates sharing one of them. Words with digits (model names) are
+    left out: input with digits is never corrected.
+    """
+
+    def __init__(self, vocabulary, max_distance=2, keywords=()):
+        """
+        Constructor for DomainCorrector
+        :param dict vocabulary: word -> frequency (used to break ties)
+        :param int max_distance: maximal edit distance of a correction
+        :param keywords: vocabulary words reached only within one edit (ordinary words are
+            often two edits away from a keyword, like 'please' from 'leave')
+        """
+
+        self._vocabulary = {word: n for word, n in vocabulary.items() if not any(c.isdigit() for c in word)}
+        self._max_distance = max_distance
+        self._keywords = frozenset(keywords)
+        # delete -> words it was generated from
+        self._deletes = {}
+        for word in self._vocabulary:
+            for d in self._generate_deletes(word, max_distance):
+                self._deletes.setdefault(d, set()).add(word)
+
+    def __contains__(self, word):
+        return word in self._vocabulary
+
+    @staticmethod
+    def _generate_deletes(word, distance):
+        """Set of strings obtained from word by deleting up to distance characters"""
+
+        deletes = {word}
+        edge = {word}
+        for _ in range(distance):
+            edge = {w[:i] + w[i+1:] for w in edge for i in range(len(w))}
+            deletes |= edge
+
+        return deletes
+
+    @staticmethod
+    def _distance(a, b):
+        """Optimal string alignment distance (Levenshtein with transpositions)"""
+
+        prev2 = None
+        prev = list(range(len(b) + 1))
+        for i in range(1, len(a) + 1):
+            cur = [i] + [0] * len(b)
+            for j in range(1, len(b) + 1):
+                cost = 0 if a[i-1] == b[j-1] else 1
+                cur[j] = min(prev[j] + 1, cur[j-1] + 1, prev[j-1] + cost)
+                if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1]:
+                    cur[j] = min(cur[j], prev2[j-2] + 1)
+            prev2, prev = prev, cur
+
+        return prev[len(b)]
+
+    def _allowed_distance(self, word):
+        """Short words get fewer edits, otherwise everything is one edit away from them"""
+
+        if len(word) <= 3:
+            return 0
+        elif len(word) <= 5:
+            return min(1, self._max_distance)
+        else:
+            return self._max_distance
+
+    def correct(self, word):
+        """
+        Return the nearest vocabulary word, or the word itself if nothing is close enough
+        :param str word: lower case word
+        """
+
+        if word in self._vocabulary or any(c.isdigit() for c in word):
+            return word
+
+        distance = self._allowed_distance(word)
+        if not distance:
+            return word
+
+        best = None
+        seen = set()
+        for d in self._generate_deletes(word, distance):
+            for candidate in self._deletes.get(d, ()):
+                if candidate in seen:
+                    continue
+                seen.add(candidate)
+                dist = self._distance(word, candidate)
+                if dist <= distance and (dist <= 1 or candidate not in self._keywords):
+                    key = (dist, -self._vocabulary[candidate], candidate)
+                    if best is None or key < best:
+                        best = key
+
+        return best[2] if best is not None else word
+
+
+class KeywordRewriter(object):
+    """
+    Replace whole-word keywords in one pass
+
+    The keywords are compiled into a single regular expression shaped as a
+    character trie, so matching at a position costs at most the length of the
+    longest keyword regardless of the table size. At every position the
+    longest keyword is taken, and replaced text is never rewritten again.
+    Plural forms of the keywords ('laptops', 'watches') are replaced as well.
+    """
+
+    def __init__(self, table):
+        """
+        Constructor for KeywordRewriter
+        :param dict table: keyword -> replacement
+        """
+
+        self._table = dict(table)
+
+        trie = {}
+        for word in self._table:
+            node = trie
+            for char in word:
+                node = node.setdefault(char, {})
+            node[''] = True
+
+        if self._table:
+            self._regex = re.compile(r"(?<!\w)(" + self._trie_pattern(trie) + r")(?:e?s)?(?!\w)")
+        else:
+            self._regex = None
+
+    @classmethod
+    def _trie_pattern(cls, node):
+        """Regular expression matching all keywords of the trie node (longest first)"""
+
+        alternatives = [re.escape(char) + cls._trie_pattern(child)
+                        for char, child in sorted(node.items()) if char]
+        if not alternatives:
+            return ''
+
+        if '' not in node and len(alternatives) == 1:
+            return alternatives[0]
+
+        return '(?:' + '|'.join(alternatives) + ')' + ('?' if '' in node else '')
+
+    @staticmethod
+    def read_table(FileName):
+        """
+        Read keyword table from a .csv file with 'keyword,replacement' rows
+        :param str FileName: name of the file
+        :return: dict keyword -> replacement
+        """
+
+        table = {}
+        with open(FileName, newline='') as f:
+            for row in csv.reader(f):
+                if len(row) < 2 or not row[0].strip() or row[0].startswith('#'):
+                    continue
+                table[row[0].strip().lower()] = row[1].strip().lower()
+
+        return table
+
+    def __len__(self):
+        return len(self._table)
+
+    def rewrite(self, text):
+        """Return text with all keywords replaced"""
+
+        if self._regex is None:
+            return text
+
+        return self._regex.sub(lambda m: self._table[m.group(1)], text)
+
+
+class Intent(object):
+    """ Intents and slots of one user message (see IntentExtractor) """
+
+    __slots__ = ('quit', 'greet', 'yes', 'no', 'category', 'brand', 'searchtype',
+                 'category_mentioned', 'brand_mentioned', 'catalog')
+
+    def __init__(self, catalog=None):
+
+        # user wants to leave / said hello
+        self.quit = False
+        self.greet = False
+        # user said yes / no (no: only when no brand is named, 'no apple but samsung' names brands)
+        self.yes = False
+        self.no = False
+        # first category and brand not negated, or None
+        self.category = None
+        self.brand = None
+        # 'category' or 'brand' if the user named the search type, else None
+        self.searchtype = None
+        # a category / brand keyword appears (negated or not)
+        self.category_mentioned = False
+        self.brand_mentioned = False
+        # catalog version the brands were looked up in
+        self.catalog = catalog
+
+    def __repr__(self):
+        return 'Intent({0})'.format(', '.join('{0}={1!r}'.format(name, getattr(self, name))
+                                               for name in self.__slots__[:-1]))
+
+
+class IntentExtractor(object):
+    """
+    Intents and slots of a message in one pass over its words
+
+    Every keyword is compiled into a lexicon entry of bit flags, brands are
+    looked up in a dict of the catalog: each word costs two hash lookups,
+    whatever the number of brands. Negated words ('not', 'no' and "don't"
+    up to 'but' or a 'want'-like verb, anything after 'hate', 'dislike' or
+    'discard') count as mentioned but do not fill the category and brand
+    slots, as in Bot._analyze_sentence_structure.
+    """
+
+    # lexicon flags
+    QUIT, GREET, CATEGORY, NEGATION, HATE, CANCEL, NO, NOT, YES, WOULD, SEARCHTYPE = (1 << i for i in range(11))
+
+    def __init__(self, quit_words, greet_words, categories):
+        """
+        Constructor for IntentExtractor
+        :param quit_words: words to leave the conversation
+        :param greet_words: greeting words
+        :param categories: category keywords
+        """
+
+        entries = [(quit_words, self.QUIT), (greet_words, self.GREET), (categories, self.CATEGORY),
+                   (('no', 'not', "don't"), self.NEGATION), (('hate', 'dislike', 'discard'), self.HATE),
+                   (('but', 'want', 'like', 'need'), self.CANCEL),
+                   (('no',), self.NO), (('not',), self.NOT), (('ye', 'yep', 'yeah'), self.YES),
+                   (('would',), self.WOULD), (('brand', 'category'), self.SEARCHTYPE)]
+
+        # word -> flags
+        self._lexicon = {}
+        for words, flag in entries:
+            for word in words:
+                self._lexicon[word] = self._lexicon.get(word, 0) | flag
+
+    def extract(self, words, raw_input, brands, catalog=None):
+        """
+        Intents and slots of a message
+        :param list words: normalized words of the message
+        :param str raw_input: lower case message
+        :param brands: container of the brands (a dict or set)
+        :param CatalogIndex catalog: catalog version of the brands (kept in the result)
+        :return: Intent
+        """
+
+        intent = Intent(catalog)
+        if not words:
+            return intent
+
+        lexicon = self._lexicon
+        flags = [lexicon.get(w, 0) for w in words]
+        seen = 0
+        negation = False
+        last = len(words) - 1
+        for i, w in enumerate(words):
+            f = flags[i]
+            seen |= f
+
+            # negation rules of Bot._analyze_sentence_structure
+            if i != last and f & self.NEGATION and not flags[i + 1] & self.HATE:
+                negation = True
+            if i != 0:
+                if f & self.HATE and not flags[i - 1] & self.NEGATION:
+                    negation = True
+                if negation and f & self.CANCEL and not flags[i - 1] & self.NEGATION:
+                    negation = False
+            elif f & self.HATE:
+                negation = True
+
+            if f & self.CATEGORY:
+                intent.category_mentioned = True
+                if not negation and intent.category is None:
+                    intent.category = w
+            if w in brands:
+                intent.brand_mentioned = True
+                if not negation and intent.brand is None:
+                    intent.brand = w
+            if f & self.SEARCHTYPE and intent.searchtype != 'category':
+                intent.searchtype = w
+
+        intent.quit = bool(seen & self.QUIT)
+        intent.greet = bool(seen & self.GREET)
+        intent.no = bool(seen & (self.NO | self.NOT) or 'nope' in raw_input) and not intent.brand_mentioned
+        intent.yes = bool(seen & self.YES or (seen & self.WOULD and not seen & self.NOT))
+
+        return intent
+
+
+class StringTable(object):
+    """
+    Immutable list of strings stored as utf-8 bytes
+
+    The strings are separated by zero bytes, string i is
+    data[offsets[i]:offsets[i + 1] - 1]. Items are decoded on access, so a
+    table mapped from a snapshot takes no memory until it is read.
+    """
+
+    def __init__(self, data, offsets):
+        """
+        Constructor for StringTable
+        :param data: numpy uint8 array with the zero-separated strings
+        :param offsets: numpy int64 array with the start of each string (and the end)
+        """
+
+        self.data = data
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        """
+        Encode the strings into a table
+        :param list strings: list of str
+        """
+
+        import numpy as np
+
+        text = '\0'.join(strings) + '\0'
+        data = text.encode('utf-8')
+        if len(data) == len(text):
+            # ascii: byte lengths are string lengths
+            lengths = map(len, strings)
+        else:
+            lengths = (len(string.encode('utf-8')) for string in strings)
+
+        offsets = np.zeros(len(strings) + 1, dtype='<i8')
+        np.cumsum(np.fromiter(lengths, dtype='<i8', count=len(strings)) + 1, out=offsets[1:])
+
+        return cls(np.frombuffer(data, dtype='u1')[:offsets[-1]], offsets)
+
+    @classmethod
+    def concat(cls, tables):
+        """Join tables into one"""
+
+        import numpy as np
+
+        offsets, shift = [np.zeros(1, dtype='<i8')], 0
+        for table in tables:
+            offsets.append(table.offsets[1:] + shift)
+            shift += table.offsets[-1]
+
+        return cls(np.concatenate([table.data for table in tables]), np.concatenate(offsets))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1] - 1].tobytes().decode('utf-8')
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.offsets.nbytes
+
+    def tolist(self):
+        """All strings (decoded at once)"""
+
+        strings = self.data.tobytes().decode('utf-8').split('\0')[:-1]
+        if len(strings) != len(self):
+            # some string contains a zero byte
+            strings = [self[i] for i in range(len(self))]
+
+        return strings
+
+
+class CatalogIndex(object):
+    """
+    Product catalog as arrays, with its row positions by category, brand and (category, brand)
+
+    Brands and categories are interned once: each row holds integer codes
+    into brands and categories, plans are a float32 array and names a
+    StringTable. Built once per catalog version, answers all the
+    category/brand lookups of the dialogue with integer arrays.
+    The rows of each group are ordered by plan (most expensive first, ties
+    in catalog order), next to their negated plans: listings need no sort
+    and plan ranges are found by binary search.
+    """
+
+    # first bytes of a catalog snapshot file (the last one is the format version)
+    snapshot_magic = b'GRVSNAP2'
+
+    def __init__(self, ids, names, brand_codes, category_codes, plans, brands, categories, index_name=None):
+        """
+        Constructor for CatalogIndex
+        :param ids: numpy array of product ids
+        :param StringTable names: product names
+        :param brand_codes: numpy int32 array, position of the brand of each row in brands
+        :param category_codes: numpy int32 array, position of the category of each row in categories
+        :param plans: numpy float32 array of plans
+        :param list brands: brands (lower case, order of first appearance)
+        :param list categories: categories (order of first appearance)
+        :param str index_name: name of the id column
+        """
+
+        import numpy as np
+
+        # negated plans: ascending keys for the rows in descending plan order
+        negated = -np.asarray(plans, dtype=np.float32)
+
+        def grouped(codes, keys):
+            # by code, then by plan (the sort is stable: ties stay in catalog order)
+            order = np.lexsort((negated, codes)).astype(np.int32)
+            sorted_keys = negated[order]
+            offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+            np.cumsum(np.bincount(codes, minlength=len(keys)), out=offsets[1:])
+            groups = [(key, offsets[i], offsets[i + 1]) for i, key in enumerate(keys) if offsets[i + 1] > offsets[i]]
+            return ({key: order[start:end] for key, start, end in groups},
+                    {key: sorted_keys[start:end] for key, start, end in groups})
+
+        # (category, brand) pairs, numbered in sorted code order and listed in order of first appearance
+        unique, first, pair_codes = np.unique(category_codes.astype(np.int64) * len(brands) + brand_codes,
+                                              return_index=True, return_inverse=True)
+        pair_keys = [(categories[code // len(brands)], brands[code % len(brands)]) for code in unique.tolist()]
+        pairs = [pair_keys[i] for i in np.argsort(first, kind='stable')]
+
+        self._setup(ids, names, brand_codes, category_codes, plans, brands, categories, index_name,
+                    grouped(category_codes, categories),
+                    grouped(brand_codes, brands),
+                    grouped(pair_codes, pair_keys),
+                    pairs)
+
+    def _setup(self, ids, names, brand_codes, category_codes, plans, brands, categories, index_name,
+               by_category, by_brand, by_pair, pairs):
+        """
+        Set catalog arrays and row positions
+        :param tuple by_category: category -> row positions, category -> their negated plans
+        :param tuple by_brand: brand -> row positions, brand -> their negated plans
+        :param tuple by_pair: (category, brand) -> row positions, (category, brand) -> their negated plans
+        :param list pairs: (category, brand) pairs (order of first appearance)
+        (other parameters as in the constructor)
+        """
+
+        import numpy as np
+
+        self.ids = ids
+        self.names = names
+        self.brand_codes = brand_codes
+        self.category_codes = category_codes
+        self.plans = plans
+        self.brands = brands
+        self.categories = categories
+        self.index_name = index_name
+        # brand/category -> code
+        self.brand_code = {brand: i for i, brand in enumerate(brands)}
+        self.category_code = {cat: i for i, cat in enumerate(categories)}
+
+        # row positions (numpy int32 arrays, most expensive first, ties in catalog order)
+        self._empty = np.empty(0, dtype=np.int32)
+        self.by_category, self._category_plans = by_category
+        self.by_brand, self._brand_plans = by_brand
+        self.by_pair, self._pair_plans = by_pair
+        # negated plans of the rows (numpy float32 arrays, ascending)
+        self._no_plans = np.empty(0, dtype=np.float32)
+
+        # brands of each category and categories of each brand (order of first appearance)
+        self.pairs = pairs
+        self.brands_of_category = {}
+        self.categories_of_brand = {}
+        for cat, brand in pairs:
+            self.brands_of_category.setdefault(cat, []).append(brand)
+            self.categories_of_brand.setdefault(brand, []).append(cat)
+
+        # rendered summary tables of this catalog (filled on first use)
+        self.tables = {}
+
+        # version number and file, rows, load time and peak RSS (set by the Bot loading it)
+        self.version = 0
+        self.load_stats = None
+        # crc32 of the arrays (computed on first use)
+        self._fingerprint = None
+
+        # exact product words of the choices (built on first use)
+        self._product_tokens = None
+        # ranked search over the names (built on first use)
+        self._search = None
+        self._search_lock = threading.Lock()
+        # completions of names and the bot keywords (Typeahead, built by the bot on first use)
+        self.typeahead = None
+        # similar products (built on first use, after the search)
+        self._recommender = None
+
+    @classmethod
+    def read_csv(cls, FileName, category_names=None, chunksize=65536):
+        """
+        Read catalog from csv file (id, name, brand, category, plan) in chunks
+
+        Brands (lower case) and categories are interned into codes, plans
+        converted to float32 and names encoded chunk by chunk, so only the
+        compact arrays are kept, not the text of the whole file.
+        A row with an empty field or a plan that is not a number stops the
+        load with ValueError naming the row.
+        :param str FileName: name of the .csv file
+        :param dict category_names: category in the file -> category in the catalog
+        :param int chunksize: number of rows parsed at once
+        :return: CatalogIndex
+        """
+
+        import numpy as np
+        import pandas as pd
+
+        category_names = category_names or {}
+        with open(FileName, newline='') as f:
+            header = next(csv.reader(f), [])
+        if len(header) != 5:
+            raise ValueError("'{0}': expected 5 columns (id, name, brand, category, plan), got {1}".format(
+                FileName, len(header)))
+
+        # brand/category -> code, in order of first appearance
+        brand_codes, category_codes = {}, {}
+        ids, names, brands, categories, plans = [], [], [], [], []
+        row = 1
+        # only empty fields are missing values; plans are parsed by pandas unless some are not numbers
+        reader = pd.read_csv(FileName, index_col=0, chunksize=chunksize, keep_default_na=False, na_values=[''],
+                             dtype={column: str for column in header[1:4]})
+        for chunk in reader:
+            chunk.columns = ['name', 'brand', 'category', 'plan']
+            plan = chunk['plan']
+            if plan.dtype.kind not in 'fi':
+                plan = pd.to_numeric(plan, errors='coerce')
+            bad = chunk.isna().values.any(axis=1) | plan.isna().values
+            if bad.any():
+                first = int(bad.argmax())
+                raise ValueError("'{0}', row {1} (id {2}): empty field or plan that is not a number".format(
+                    FileName, row + first, chunk.index[first]))
+
+            raw_brands = {value: brand_codes.setdefault(value.lower(), len(brand_codes))
+                          for value in chunk['brand'].unique()}
+            raw_categories = {value: category_codes.setdefault(category_names.get(value, value), len(category_codes))
+                              for value in chunk['category'].unique()}
+
+            ids.append(chunk.index.values)
+            names.append(StringTable.from_strings(chunk['name'].tolist()))
+            brands.append(chunk['brand'].map(raw_brands).values.astype(np.int32))
+            categories.append(chunk['category'].map(raw_categories).values.astype(np.int32))
+            plans.append(plan.values.astype(np.float32))
+            row += len(chunk)
+
+        if not ids:
+            raise ValueError("'{0}' has no products".format(FileName))
+
+        return cls(np.concatenate(ids), StringTable.concat(names),
+                   np.concatenate(brands), np.concatenate(categories), np.concatenate(plans),
+                   list(brand_codes), list(category_codes), header[0])
+
+    @classmethod
+    def is_snapshot(cls, FileName):
+        """Check if the file is a catalog snapshot (and not a .csv file)"""
+
+        with open(FileName, 'rb') as f:
+            return f.read(len(cls.snapshot_magic))[:-1] == cls.snapshot_magic[:-1]
+
+    def save(self, FileName):
+        """
+        Write binary snapshot of the catalog and its index
+
+        Layout: magic, header length (uint64), json header (row count, brand and
+        category strings, sections), then 8-byte aligned little-endian arrays:
+        product ids (int64 or float64, or a string table of their text for other
+        ids, like 'SKU-1'), plans, brand and category codes, the product name string
+        table (zero-separated utf-8 bytes and offsets) and the row positions grouped by
+        category, brand and (category, brand) with their negated plans and offsets.
+        :param str FileName: name of the snapshot file
+        """
+
+        import numpy as np
+
+        def grouped(groups, plans, keys):
+            rows = [np.asarray(groups.get(key, self._empty), dtype='<i4') for key in keys]
+            offsets = np.zeros(len(rows) + 1, dtype='<i8')
+            np.cumsum([len(r) for r in rows], out=offsets[1:])
+            if not rows:
+                return np.empty(0, dtype='<i4'), np.empty(0, dtype='<f4'), offsets
+            return (np.concatenate(rows),
+                    np.concatenate([np.asarray(plans.get(key, self._no_plans), dtype='<f4') for key in keys]),
+                    offsets)
+
+        category_rows, category_plans, category_offsets = grouped(self.by_category, self._category_plans,
+                                                                  self.categories)
+        brand_rows, brand_plans, brand_offsets = grouped(self.by_brand, self._brand_plans, self.brands)
+        pair_rows, pair_plans, pair_offsets = grouped(self.by_pair, self._pair_plans, self.pairs)
+
+        if self.ids.dtype.kind in 'biu':
+            ids = [('ids', np.asarray(self.ids, dtype='<i8'))]
+        elif self.ids.dtype.kind == 'f':
+            ids = [('ids', np.asarray(self.ids, dtype='<f8'))]
+        else:
+            table = StringTable.from_strings([str(index) for index in self.ids.tolist()])
+            ids = [('id_offsets', table.offsets), ('id_strings', table.data)]
+
+        arrays = ids + [('plans', np.asarray(self.plans, dtype='<f4')),
+                        ('brand_codes', np.asarray(self.brand_codes, dtype='<i4')),
+                        ('category_codes', np.asarray(self.category_codes, dtype='<i4')),
+                        ('name_offsets', np.asarray(self.names.offsets, dtype='<i8')),
+                        ('names', np.asarray(self.names.data, dtype='u1')),
+                        ('category_rows', category_rows), ('category_plans', category_plans),
+                        ('category_offsets', category_offsets),
+                        ('brand_rows', brand_rows), ('brand_plans', brand_plans), ('brand_offsets', brand_offsets),
+                        ('pair_rows', pair_rows), ('pair_plans', pair_plans), ('pair_offsets', pair_offsets)]
+
+        sections = {}
+        offset = 0
+        for name, array in arrays:
+            sections[name] = [offset, array.dtype.str, len(array)]
+            offset += (array.nbytes + 7) // 8 * 8
+
+        header = json.dumps({'rows': len(self),
+                             'index_name': self.index_name,
+                             'brands': [str(brand) for brand in self.brands],
+                             'categories': [str(cat) for cat in self.categories],
+                             'pairs': [[self.category_code[cat], self.brand_code[brand]] for cat, brand in self.pairs],
+                             'sections': sections}).encode('utf-8')
+        start = len(self.snapshot_magic) + 8 + len(header)
+
+        with open(FileName, 'wb') as f:
+            f.write(self.snapshot_magic)
+            f.write(struct.pack('<Q', len(header)))
+            f.write(header)
+            f.write(b'\0' * ((start + 7) // 8 * 8 - start))
+            for name, array in arrays:
+                f.write(array.tobytes())
+                f.write(b'\0' * ((array.nbytes + 7) // 8 * 8 - array.nbytes))
+
+    @classmethod
+    def load(cls, FileName):
+        """
+        Load snapshot written by save()
+
+        The file is memory-mapped: all arrays, the product names included, are
+        read-only views of the mapping (shared by all processes loading the
+        same file), nothing is decoded until it is used, except product ids
+        that are not numbers.
+        :param str FileName: name of the snapshot file
+        :return: CatalogIndex
+        """
+
+        import mmap
+        import numpy as np
+
+        with open(FileName, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        start = len(cls.snapshot_magic)
+        if buf[:start - 1] != cls.snapshot_magic[:-1]:
+            raise ValueError("'{0}' is not a catalog snapshot".format(FileName))
+        if buf[:start] != cls.snapshot_magic:
+            raise ValueError("'{0}' is a catalog snapshot of another format version, compile it again".format(
+                FileName))
+        length, = struct.unpack('<Q', buf[start:start + 8])
+        header = json.loads(buf[start + 8:start + 8 + length].decode('utf-8'))
+        base = (start + 8 + length + 7) // 8 * 8
+
+        def section(name):
+            offset, dtype, count = header['sections'][name]
+            if not count:
+                return np.empty(0, dtype=dtype)
+            return np.frombuffer(buf, dtype=dtype, count=count, offset=base + offset)
+
+        def grouped(name, keys):
+            rows, plans, offsets = section(name + '_rows'), section(name + '_plans'), section(name + '_offsets')
+            groups = [(key, offsets[i], offsets[i + 1]) for i, key in enumerate(keys) if offsets[i + 1] > offsets[i]]
+            return ({key: rows[start:end] for key, start, end in groups},
+                    {key: plans[start:end] for key, start, end in groups})
+
+        brands, categories = header['brands'], header['categories']
+        pairs = [(categories[c], brands[b]) for c, b in header['pairs']]
+
+        if 'id_strings' in header['sections']:
+            ids = np.array(StringTable(section('id_strings'), section('id_offsets')).tolist(), dtype=object)
+        else:
+            ids = section('ids')
+
+        index = cls.__new__(cls)
+        index._setup(ids, StringTable(section('names'), section('name_offsets')),
+                     section('brand_codes'), section('category_codes'), section('plans'),
+                     brands, categories, header['index_name'],
+                     grouped('category', categories),
+                     grouped('brand', brands),
+                     grouped('pair', pairs),
+                     pairs)
+        return index
+
+    def __len__(self):
+        return len(self.plans)
+
+    def brand_of(self, pos):
+        """Brand of the product at row position"""
+
+        return self.brands[self.brand_codes[pos]]
+
+    def category_of(self, pos):
+        """Category of the product at row position"""
+
+        return self.categories[self.category_codes[pos]]
+
+    @property
+    def search(self):
+        """ProductSearch over the names, built on first use"""
+
+        with self._search_lock:
+            if self._search is None:
+                self._search = ProductSearch(self.names)
+
+        return self._search
+
+    @property
+    def recommender(self):
+        """Recommender over the products, built on first use"""
+
+        search = self.search
+        with self._search_lock:
+            if self._recommender is None:
+                self._recommender = Recommender(self, search)
+
+        return self._recommender
+
+    @property
+    def product_tokens(self):
+        """ProductTokens of the products, built on first use"""
+
+        with self._search_lock:
+            if self._product_tokens is None:
+                self._product_tokens = ProductTokens(self.ids, self.names, self.plans)
+
+        return self._product_tokens
+
+    @property
+    def fingerprint(self):
+        """crc32 of the catalog contents: the same catalog has the same fingerprint in every process"""
+
+        if self._fingerprint is None:
+            import numpy as np
+
+            crc = zlib.crc32('\0'.join(list(self.brands) + [''] + list(self.categories)).encode('utf-8'))
+            if self.ids.dtype.kind in 'biuf':
+                ids = [self.ids]
+            else:
+                # ids that are not numbers (like 'SKU-1'): their utf-8 text
+                table = StringTable.from_strings([str(index) for index in self.ids.tolist()])
+                ids = [table.data, table.offsets]
+            for array in ids + [self.brand_codes, self.category_codes, self.plans,
+                                self.names.data, self.names.offsets]:
+                crc = zlib.crc32(np.ascontiguousarray(array).view(np.uint8), crc)
+            self._fingerprint = crc
+
+        return self._fingerprint
+
+    @property
+    def nbytes(self):
+        """Memory of the catalog arrays and row positions (mapped or not)"""
+
+        arrays = [self.ids, self.brand_codes, self.category_codes, self.plans]
+        for group in (self.by_category, self.by_brand, self.by_pair,
+                      self._category_plans, self._brand_plans, self._pair_plans):
+            arrays.extend(group.values())
+
+        search = self._search.nbytes if self._search is not None else 0
+        typeahead = self.typeahead.nbytes if self.typeahead is not None else 0
+        recommender = self._recommender.nbytes if self._recommender is not None else 0
+        tokens = self._product_tokens.nbytes if self._product_tokens is not None else 0
+        return (self.names.nbytes + sum(array.nbytes for array in arrays) + search + typeahead + recommender +
+                tokens)
+
+    def rows(self, cat=None, brand=None):
+        """Row positions of the products of category and/or brand (most expensive first)"""
+
+        if cat is not None and brand is not None:
+            return self.by_pair.get((cat, brand), self._empty)
+        elif cat is not None:
+            return self.by_category.get(cat, self._empty)
+        elif brand is not None:
+            return self.by_brand.get(brand, self._empty)
+        else:
+            return self._empty
+
+    def _negated_plans(self, cat=None, brand=None):
+        """Negated plans of rows(cat, brand) (ascending)"""
+
+        if cat is not None and brand is not None:
+            return self._pair_plans.get((cat, brand), self._no_plans)
+        elif cat is not None:
+            return self._category_plans.get(cat, self._no_plans)
+        elif brand is not None:
+            return self._brand_plans.get(brand, self._no_plans)
+        else:
+            return self._no_plans
+
+    def plan_rows(self, cat=None, brand=None, low=None, high=None, cheapest=None):
+        """
+        Row positions of the products of category and/or brand in a plan range
+
+        Binary search in the plans of the group: the result is a slice of
+        rows(cat, brand) (or two, for the cheapest products).
+        :param float low: lowest plan (included), None for no limit
+        :param float high: highest plan (included), None for no limit
+        :param int cheapest: number of cheapest products of the range to keep (ties: the first
+            in catalog order), None for all
+        :return: numpy int32 array of row positions, most expensive first (ties in catalog order)
+        """
+
+        import numpy as np
+
+        rows, keys = self.rows(cat, brand), self._negated_plans(cat, brand)
+        # plans in [low, high] are keys in [-high, -low]
+        start = 0 if high is None else int(np.searchsorted(keys, -np.float32(high), 'left'))
+        end = len(keys) if low is None else int(np.searchsorted(keys, -np.float32(low), 'right'))
+        if cheapest is None or end - start <= cheapest:
+            return rows[start:end]
+        elif cheapest <= 0:
+            return self._empty
+
+        # all rows cheaper than the plan of the last one kept, then the first of those tied with it
+        tied = keys[end - cheapest]
+        first = int(np.searchsorted(keys, tied, 'left'))
+        last = int(np.searchsorted(keys, tied, 'right'))
+        return np.concatenate((rows[first:first + cheapest - (end - last)], rows[last:end]))
+
+    def selector(self, cat=None, brand=None, low=None, high=None):
+        """
+        Function row positions -> boolean array, True for the products of category and/or brand
+        with a plan in [low, high] (None: all)
+        """
+
+        import numpy as np
+
+        tests = []
+        if cat is not None:
+            tests.append((np.equal, self.category_codes, self.category_code.get(cat, -1)))
+        if brand is not None:
+            tests.append((np.equal, self.brand_codes, self.brand_code.get(brand, -1)))
+        if low is not None:
+            tests.append((np.greater_equal, self.plans, np.float32(low)))
+        if high is not None:
+            tests.append((np.less_equal, self.plans, np.float32(high)))
+        if not tests:
+            return None
+
+        def select(positions):
+            test, values, value = tests[0]
+            keep = test(values[positions], value)
+            for test, values, value in tests[1:]:
+                keep &= test(values[positions], value)
+            return keep
+
+        return select
+
+    def count(self, cat=None, brand=None):
+        """Number of products of category and/or brand"""
+
+        return len(self.rows(cat, brand))
+
+    def num_brands(self, cat):
+        """Number of brands in category"""
+
+        return len(self.brands_of_category.get(cat, ()))
+
+    def num_categories(self, brand):
+        """Number of categories of brand"""
+
+        return len(self.categories_of_brand.get(brand, ()))
+
+
+class ProductTokens(object):
+    """
+    Exact words of the products (name split on spaces, plan and id) -> row positions
+
+    The distinct words of each name are keyed by their hash into sorted
+    numpy postings, so matching a word against the candidates of a choice
+    is a binary search per candidate, whatever the names. Plans and ids are
+    compared as arrays, the way they print (float32 plans print as written
+    in the file).
+    """
+
+    def __init__(self, ids, names, plans):
+        """
+        Constructor for ProductTokens
+        :param ids: numpy array of product ids
+        :param StringTable names: product names
+        :param plans: numpy float32 array of plans
+        """
+
+        import numpy as np
+
+        self._ids = ids
+        self._plans = plans
+
+        hashes, counts = [], []
+        for name in names.tolist():
+            words = name.lower().split(' ')
+            hashes.extend(map(hash, words))
+            counts.append(len(words))
+        hashes = np.array(hashes, dtype=np.int64)
+        docs = np.repeat(np.arange(len(counts), dtype=np.int32), counts)
+
+        # (hash, row) pairs sorted by hash then row, each once
+        order = np.lexsort((docs, hashes))
+        hashes, docs = hashes[order], docs[order]
+        keep = np.ones(len(hashes), dtype=bool)
+        keep[1:] = (hashes[1:] != hashes[:-1]) | (docs[1:] != docs[:-1])
+        hashes, self.postings = hashes[keep], docs[keep]
+        self.hashes, starts = np.unique(hashes, return_index=True)
+        self.offsets = np.append(starts, len(hashes)).astype(np.int64)
+
+    @property
+    def nbytes(self):
+        return self.hashes.nbytes + self.offsets.nbytes + self.postings.nbytes
+
+    def matches(self, word, rows):
+        """
+        Which of the rows have the word
+        :param str word: lower case word
+        :param rows: sorted numpy array of row positions
+        :return: boolean numpy array, for each row
+        """
+
+        import numpy as np
+
+        found = np.zeros(len(rows), dtype=bool)
+        key = hash(word)
+        i = int(np.searchsorted(self.hashes, key))
+        if i < len(self.hashes) and self.hashes[i] == key:
+            docs = self.postings[self.offsets[i]:self.offsets[i + 1]]
+            j = np.minimum(np.searchsorted(docs, rows), len(docs) - 1)
+            found |= docs[j] == rows
+
+        if re.match(r'-?[\d.]', word):
+            try:
+                plan = np.float32(word)
+            except ValueError:
+                plan = None
+            if plan is not None and str(plan) == word:
+                found |= self._plans[rows] == plan
+        if self._ids.dtype.kind in 'iu':
+            if re.fullmatch(r'-?\d+', word) and str(int(word)) == word:
+                found |= self._ids[rows] == int(word)
+        else:
+            found |= np.char.lower(self._ids[rows].astype(str)) == word
+
+        return found
+
+
+class ProductSearch(object):
+    """
+    Ranked search over the product names (BM25 over words and character trigrams)
+
+    Names are lower-cased and every character that is not a letter or digit
+    becomes a word boundary. The terms are the words (their first 16 bytes)
+    and the trigram centered on each letter or digit (boundaries included),
+    so model codes like 'VR20J9020UR/EG' or 'i5-5250U' match exactly as
+    well as typed partially or with other separators. The inverted index
+    (term -> sorted row positions with their BM25 weights) is built with
+    numpy over the name table.
+
+    Queries score the postings of their rarest terms into a scratch array,
+    as long as these postings fit in a budget; the more common terms only
+    re-rank the best candidates. The rarest terms of a long query (a full
+    name) are selective enough with a smaller budget.
+    """
+
+    # term codes: trigrams are the 3 bytes, words come after them
+    _word_base = 1 << 24
+    # terms with a lower idf do not re-rank
+    min_idf = 0.05
+    # queries with more terms (full product names) score a proportionally smaller budget
+    long_query = 6
+
+    def __init__(self, names, k1=1.2, b=0.75, budget=16000):
+        """
+        Constructor for ProductSearch
+        :param StringTable names: product names
+        :param float k1: BM25 term frequency saturation
+        :param float b: BM25 length normalization
+        :param int budget: number of postings scored per query (the rest re-ranks)
+        """
+
+        import numpy as np
+
+        self._size = len(names)
+        self._budget = budget
+        self._local = threading.local()
+
+        trigrams, centers, words, starts = self._tokens(np.asarray(names.data, dtype=np.uint8))
+        self.words = np.unique(words)
+        codes = np.concatenate((trigrams, self._word_base + np.searchsorted(self.words, words)))
+        docs = np.searchsorted(names.offsets, np.concatenate((centers, starts)), side='right') - 1
+        lengths = np.bincount(docs, minlength=self._size).astype(np.float32)
+
+        # (term, doc) pairs sorted by term then doc, with their counts
+        pairs, tf = np.unique((codes.astype(np.int64) << 32) | docs, return_counts=True)
+        terms = (pairs >> 32).astype(np.int32)
+        self.postings = (pairs & 0xffffffff).astype(np.int32)
+        self.terms, starts = np.unique(terms, return_index=True)
+        self.offsets = np.append(starts, len(pairs)).astype(np.int64)
+
+        df = np.diff(self.offsets)
+        self.idf = np.log(1.0 + (self._size - df + 0.5) / (df + 0.5)).astype(np.float32)
+        norm = k1 * (1 - b + b * lengths / max(float(lengths.mean()), 1.0))
+        self.weights = (np.repeat(self.idf, df) * tf * (k1 + 1) / (tf + norm[self.postings])).astype(np.float32)
+
+    @staticmethod
+    def _tokens(data):
+        """
+        Trigrams and words of zero-separated (or single) strings
+        :param data: numpy uint8 array of utf-8 bytes
+        :return: trigram codes (int32) and positions of their center bytes,
+            words (numpy 'S16' array) and positions of their first bytes
+        """
+
+        import numpy as np
+
+        d = data.copy()
+        d[(d >= 65) & (d <= 90)] += 32
+        alnum = ((d >= 97) & (d <= 122)) | ((d >= 48) & (d <= 57)) | (d >= 128)
+        d[~alnum] = 32
+
+        # padded with a boundary at each end
+        padded = np.concatenate(([32], d, [32])).astype(np.int32)
+        centers = np.flatnonzero(alnum)
+        trigrams = (padded[centers] << 16) | (padded[centers + 1] << 8) | padded[centers + 2]
+
+        # words: runs of letters and digits
+        edges = np.diff(np.concatenate(([False], alnum, [False])).astype(np.int8))
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        words = np.zeros((len(starts), 16), dtype=np.uint8)
+        for j in range(16):
+            long_enough = ends - starts > j
+            words[long_enough, j] = d[starts[long_enough] + j]
+
+        return trigrams, centers, words.view('S16').ravel(), starts
+
+    def _query_terms(self, query):
+        """Term codes of the query found in the index (tokenized like the names, in python: queries are short)"""
+
+        import numpy as np
+
+        text = re.sub(rb'[^a-z0-9\x80-\xff]', b' ', query.encode('utf-8').lower())
+        padded = b' ' + text + b' '
+        codes = [(padded[i] << 16) | (padded[i + 1] << 8) | padded[i + 2]
+                 for i in range(len(text)) if text[i] != 32]
+
+        words = np.array([word[:16] for word in text.split()], dtype='S16')
+        if len(words) and len(self.words):
+            i = np.minimum(np.searchsorted(self.words, words), len(self.words) - 1)
+            codes.extend((self._word_base + i[self.words[i] == words]).tolist())
+
+        codes = np.unique(np.array(codes, dtype=self.terms.dtype))
+        found = np.minimum(np.searchsorted(self.terms, codes), len(self.terms) - 1)
+
+        return found[self.terms[found] == codes] if len(self.terms) else found[:0]
+
+    @property
+    def nbytes(self):
+        return (self.words.nbytes + self.terms.nbytes + self.offsets.nbytes +
+                self.postings.nbytes + self.weights.nbytes)
+
+    def _scratch(self):
+        """Zeroed score array of this thread"""
+
+        import numpy as np
+
+        scores = getattr(self._local, 'scores', None)
+        if scores is None:
+            scores = self._local.scores = np.zeros(self._size, dtype=np.float32)
+
+        return scores
+
+    def top(self, query, k=10, allowed=None):
+        """
+        Best matching products
+        :param str query: search text
+        :param int k: maximal number of results
+        :param allowed: function row positions -> boolean array of the products to keep, or None
+        :return: list of (row position, score), best first
+        """
+
+        import numpy as np
+
+        found = self._query_terms(query)
+        if not len(found) or k <= 0:
+            return []
+
+        df = self.offsets[found + 1] - self.offsets[found]
+        found = found[np.argsort(df, kind='stable')]
+        df = np.sort(df, kind='stable')
+        budget = self._budget * min(1.0, self.long_query / float(len(found)))
+        # the rarest term generates candidates even if it is over budget
+        selective = max(1, int(np.sum(np.cumsum(df) <= budget)))
+
+        scores = self._scratch()
+        touched = []
+        try:
+            for term in found[:selective]:
+                start, end = self.offsets[term], self.offsets[term + 1]
+                docs = self.postings[start:end]
+                scores[docs] += self.weights[start:end]
+                touched.append(docs)
+            candidates = np.concatenate(touched)
+            candidate_scores = scores[candidates]
+        finally:
+            for docs in touched:
+                scores[docs] = 0
+
+        if allowed is not None:
+            keep = allowed(candidates)
+            candidates, candidate_scores = candidates[keep], candidate_scores[keep]
+            if not len(candidates):
+                return []
+
+        # best candidates (each row appears once per selective term it contains)
+        pool = min(len(candidates), 4 * k * selective)
+        if pool < len(candidates):
+            best = np.argpartition(-candidate_scores, pool - 1)[:pool]
+            candidates, candidate_scores = candidates[best], candidate_scores[best]
+        candidates, first = np.unique(candidates, return_index=True)
+        candidate_scores = candidate_scores[first]
+
+        # common terms re-rank the pool (those in almost every name would add next to nothing)
+        for term in found[selective:][self.idf[found[selective:]] >= self.min_idf]:
+            start, end = self.offsets[term], self.offsets[term + 1]
+            docs = self.postings[start:end]
+            i = np.minimum(np.searchsorted(docs, candidates), len(docs) - 1)
+            hit = docs[i] == candidates
+            candidate_scores[hit] += self.weights[start:end][i[hit]]
+
+        order = np.lexsort((candidates, -candidate_scores))[:k]
+        return [(int(pos), float(score)) for pos, score in zip(candidates[order], candidate_scores[order])]
+
+
+class Typeahead(object):
+    """
+    Completions of a typed prefix: keywords and product names
+
+    Every word start of every text (product names, then the keywords) gives
+    a key: the next 16 bytes of the text, lower case. The keys are sorted
+    once, so the texts containing a word that starts with the prefix are
+    one range found by binary search. Entries (products, then keywords)
+    are ranked by score; the best ones of every range larger than
+    `precomputed` keys (short and common prefixes) are computed when the
+    index is built, smaller ranges are ranked per query.
+    """
+
+    # bytes per key (longer prefixes are checked against the texts)
+    key_size = 16
+
+    def __init__(self, names, scores, keywords=(), precomputed=512, depth=16):
+        """
+        Constructor for Typeahead
+        :param StringTable names: product names (entries 0 .. len(names) - 1)
+        :param scores: numpy array, score of each product (higher first)
+        :param list keywords: (texts, score, value) of the keyword entries (len(names), len(names) + 1, ...)
+        :param int precomputed: ranges with more keys than this have their best entries precomputed
+        :param int depth: number of best entries precomputed for each such range
+        """
+
+        import numpy as np
+
+        keywords = list(keywords)
+        # value of each keyword entry
+        self.keywords = [value for _, _, value in keywords]
+        texts = [text for texts, _, _ in keywords for text in texts]
+        extra = '\0'.join(texts).encode('utf-8') + b'\0' if texts else b''
+        data = np.concatenate((np.asarray(names.data, dtype=np.uint8), np.frombuffer(extra, dtype=np.uint8)))
+        lengths = [len(text.encode('utf-8')) + 1 for text in texts]
+        offsets = np.concatenate((np.asarray(names.offsets, dtype=np.int64),
+                                  names.offsets[-1] + np.cumsum(lengths, dtype=np.int64)))
+        # text -> entry
+        owners = np.concatenate((np.arange(len(names), dtype=np.int32),
+                                 np.repeat(np.arange(len(names), len(names) + len(keywords), dtype=np.int32),
+                                           [len(texts) for texts, _, _ in keywords]).astype(np.int32)))
+        self.scores = np.concatenate((np.asarray(scores, dtype=np.float64),
+                                      np.array([score for _, score, _ in keywords], dtype=np.float64)))
+        self._data, self._offsets, self._owners = data, offsets, owners
+        self._size = len(names)
+        self._precomputed = precomputed
+        self._depth = depth
+
+        d = data.copy()
+        d[(d >= 65) & (d <= 90)] += 32
+        alnum = ((d >= 97) & (d <= 122)) | ((d >= 48) & (d <= 57)) | (d >= 128)
+        starts = np.flatnonzero(alnum & ~np.concatenate(([False], alnum[:-1])))
+        text_of = np.searchsorted(offsets, starts, side='right') - 1
+        ends = offsets[text_of + 1] - 1
+
+        keys = np.zeros((len(starts), self.key_size), dtype=np.uint8)
+        for j in range(self.key_size):
+            long_enough = ends - starts > j
+            keys[long_enough, j] = d[starts[long_enough] + j]
+        # sort by the 16 bytes (two big-endian integers)
+        halves = keys.view('>u8')
+        order = np.lexsort((halves[:, 1], halves[:, 0]))
+        keys = keys[order]
+        self.keys = keys.view('S{0}'.format(self.key_size)).ravel()
+        self.starts = starts[order]
+        self.entries = owners[text_of[order]]
+
+        # best entries of the large ranges: prefix -> entries
+        self._best = {}
+        change = np.zeros(len(keys), dtype=bool)
+        if len(keys):
+            change[0] = True
+        for j in range(self.key_size):
+            change[1:] |= keys[1:, j] != keys[:-1, j]
+            first = np.flatnonzero(change)
+            sizes = np.diff(np.append(first, len(keys)))
+            for lo, size in zip(first[sizes > precomputed].tolist(), sizes[sizes > precomputed].tolist()):
+                if keys[lo, j]:
+                    self._best[keys[lo, :j + 1].tobytes()] = self._rank(lo, lo + size, depth)
+
+    @property
+    def nbytes(self):
+        return (self._data.nbytes + self._offsets.nbytes + self._owners.nbytes + self.scores.nbytes +
+                self.keys.nbytes + self.starts.nbytes + self.entries.nbytes +
+                sum(best.nbytes for best in self._best.values()))
+
+    def _rank(self, lo, hi, k, prefix=None):
+        """
+        Best k entries with a key in lo:hi (each once, ties in entry order)
+        :param bytes prefix: if longer than a key, only the keys whose text goes on with it
+        :return: numpy int32 array
+        """
+
+        import numpy as np
+
+        entries, starts = self.entries[lo:hi], self.starts[lo:hi]
+        if prefix is not None and len(prefix) > self.key_size:
+            keep = [self._data[start:start + len(prefix)].tobytes().lower() == prefix for start in starts.tolist()]
+            entries = entries[np.array(keep, dtype=bool)]
+        scores = self.scores[entries]
+
+        # the keys scoring at least as the pool-th best are enough (an entry has one key per matching
+        # word), unless they hold less than k entries
+        pool = 4 * k
+        if pool < len(entries):
+            threshold = np.partition(scores, len(scores) - pool)[len(scores) - pool]
+            ranked = np.unique(entries[scores >= threshold])
+            if len(ranked) >= k:
+                entries, scores = ranked, self.scores[ranked]
+        entries, first = np.unique(entries, return_index=True)
+        scores = scores[first]
+
+        return entries[np.lexsort((entries, -scores))[:k]].astype(np.int32)
+
+    def top(self, prefix, k=10):
+        """
+        Best entries whose text has a word starting with prefix
+        :param str prefix: typed text (case does not matter)
+        :param int k: maximal number of entries
+        :return: list of entries (ints: products are row positions, keywords come after them)
+        """
+
+        import numpy as np
+
+        prefix = prefix.lstrip().encode('utf-8').lower()
+        if not prefix or k <= 0:
+            return []
+
+        key = prefix[:self.key_size]
+        best = self._best.get(key)
+        if best is not None and len(prefix) <= self.key_size and k <= self._depth:
+            return best[:k].tolist()
+
+        lo = int(np.searchsorted(self.keys, key, side='left'))
+        hi = int(np.searchsorted(self.keys, key + b'\xff' * (self.key_size - len(key)), side='right'))
+
+        return self._rank(lo, hi, k, prefix).tolist()
+
+    def keyword(self, entry):
+        """Value of a keyword entry, None for a product entry (its row position)"""
+
+        return self.keywords[entry - self._size] if entry >= self._size else None
+
+
+class Recommender(object):
+    """
+    Products similar to a product, of other brands or with a lower plan
+
+    Every product has a precomputed sparse vector: the BM25 weights of its
+    name terms (character trigrams and words, as indexed by ProductSearch)
+    normalized to length 1, its brand and category one-hot, and its plan as
+    a unit vector at an angle from 0 (lowest plan) to 90 degrees (highest).
+    The similarity of two products is the dot product of their vectors:
+
+        name_weight * cosine of the names + brand_weight * (same brand)
+        + category_weight * (same category) + plan_weight * cos(angle between the plans)
+
+    The candidates are pruned before scoring: the products sharing the
+    rarest name terms (as many postings as fit in a budget) and the
+    products of the same category with the closest plans. They are scored
+    all at once with numpy, so a query costs about the same on any catalog
+    size.
+    """
+
+    def __init__(self, catalog, search, name_weight=1.0, brand_weight=0.25, category_weight=0.5,
+                 plan_weight=0.25, pool=256, budget=2048):
+        """
+        Constructor for Recommender
+        :param CatalogIndex catalog: the products
+        :param ProductSearch search: search index over their names
+        :param float name_weight: weight of the name similarity
+        :param float brand_weight: weight of the same brand
+        :param float category_weight: weight of the same category
+        :param float plan_weight: weight of the plan similarity
+        :param int pool: number of plan neighbours scored per query
+        :param int budget: number of name term postings gathered per query
+        """
+
+        import numpy as np
+
+        self._catalog = catalog
+        self._search = search
+        self._weights = name_weight, brand_weight, category_weight, plan_weight
+        self._pool = pool
+        self._budget = budget
+        self._local = threading.local()
+        size = len(catalog)
+
+        # name vectors: the postings of the search index by product (terms in order), unit length
+        counts = np.diff(search.offsets)
+        order = np.argsort(search.postings, kind='stable')
+        docs = search.postings[order]
+        self.terms = np.repeat(np.arange(len(counts), dtype=np.int32), counts)[order]
+        weights = search.weights[order].astype(np.float64)
+        norms = np.sqrt(np.bincount(docs, weights=weights * weights, minlength=size))
+        self.weights = (weights / np.maximum(norms, 1e-12)[docs]).astype(np.float32)
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(docs, minlength=size)))).astype(np.int64)
+        self._terms_count = len(counts)
+
+        # plan vectors
+        plans = np.asarray(catalog.plans, dtype=np.float64)
+        low, high = (plans.min(), plans.max()) if size else (0.0, 0.0)
+        angles = (plans - low) / ((high - low) or 1.0) * (math.pi / 2)
+        self.plan_vectors = np.stack((np.cos(angles), np.sin(angles)), axis=1).astype(np.float32)
+
+    @property
+    def nbytes(self):
+        return self.terms.nbytes + self.weights.nbytes + self.offsets.nbytes + self.plan_vectors.nbytes
+
+    def _scratch(self):
+        """Zeroed term weight array of this thread"""
+
+        import numpy as np
+
+        weights = getattr(self._local, 'weights', None)
+        if weights is None:
+            weights = self._local.weights = np.zeros(self._terms_count, dtype=np.float32)
+
+        return weights
+
+    def candidates(self, pos):
+        """
+        Products worth scoring for the product at row position: of another brand or with a lower plan
+        :return: numpy array of row positions (without pos)
+        """
+
+        import numpy as np
+
+        catalog = self._catalog
+        brand, plan = catalog.brand_codes[pos], catalog.plans[pos]
+
+        def allowed(rows):
+            return ((catalog.brand_codes[rows] != brand) | (catalog.plans[rows] < plan)) & (rows != pos)
+
+        # the products sharing the rarest name terms (the rarest one even if it is over budget)
+        search = self._search
+        terms = self.terms[self.offsets[pos]:self.offsets[pos + 1]]
+        starts, ends = search.offsets[terms], search.offsets[terms + 1]
+        order = np.argsort(ends - starts, kind='stable')
+        selective = max(1, int(np.sum(np.cumsum((ends - starts)[order]) <= self._budget)))
+        named = np.concatenate([search.postings[starts[i]:ends[i]] for i in order[:selective].tolist()] +
+                               [np.empty(0, dtype=np.int32)]).astype(np.int64)
+        named = named[allowed(named)]
+
+        # the closest plans of the category (rows most expensive first): a few more expensive, more cheaper
+        cat = catalog.category_of(pos)
+        rows = catalog.rows(cat=cat)
+        at = int(np.searchsorted(catalog._negated_plans(cat=cat), -plan))
+        near = rows[max(0, at - self._pool // 4):at + self._pool].astype(np.int64)
+
+        return np.unique(np.concatenate((named, near[allowed(near)])))
+
+    def scores(self, pos, rows):
+        """
+        Similarity of the products at rows with the product at row position pos (batched dot products)
+        :param rows: numpy array of row positions
+        :return: numpy float32 array
+        """
+
+        import numpy as np
+
+        catalog = self._catalog
+        name_weight, brand_weight, category_weight, plan_weight = self._weights
+        rows = np.asarray(rows, dtype=np.int64)
+
+        # names: the query vector scattered into the scratch array, the rows gathered against it
+        start, end = self.offsets[pos], self.offsets[pos + 1]
+        scratch = self._scratch()
+        scratch[self.terms[start:end]] = self.weights[start:end]
+        try:
+            starts, ends = self.offsets[rows], self.offsets[rows + 1]
+            lengths = ends - starts
+            flat = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+            products = self.weights[flat] * scratch[self.terms[flat]]
+            names = np.bincount(np.repeat(np.arange(len(rows)), lengths), weights=products, minlength=len(rows))
+        finally:
+            scratch[self.terms[start:end]] = 0
+
+        scores = name_weight * names
+        scores += brand_weight * (catalog.brand_codes[rows] == catalog.brand_codes[pos])
+        scores += category_weight * (catalog.category_codes[rows] == catalog.category_codes[pos])
+        scores += plan_weight * (self.plan_vectors[rows] @ self.plan_vectors[pos])
+
+        return scores.astype(np.float32)
+
+    def similar(self, pos, k=5):
+        """
+        Most similar products of another brand or with a lower plan
+        :param int pos: row position of the product
+        :param int k: maximal number of products
+        :return: list of (row position, similarity), most similar first (ties in catalog order)
+        """
+
+        import numpy as np
+
+        rows = self.candidates(pos)
+        if not len(rows) or k <= 0:
+            return []
+
+        scores = self.scores(pos, rows)
+        order = np.lexsort((rows, -scores))[:k]
+        return [(int(row), float(score)) for row, score in zip(rows[order], scores[order])]
+
+
+class TableRenderer(object):
+    """
+    Render rows of values as text in one pass
+
+    Formats: 'table' (bordered table, same layout as prettytable),
+    'text' (plain aligned columns) and 'json' (list of objects).
+    """
+
+    formats = ('table', 'text', 'json')
+
+    def __init__(self, output_format='table'):
+        """
+        Constructor for TableRenderer
+        :param str output_format: one of TableRenderer.formats
+        """
+
+        if output_format not in self.formats:
+            raise ValueError("unknown output format '{0}'".format(output_format))
+        self._format = output_format
+
+    @property
+    def output_format(self):
+        return self._format
+
+    @staticmethod
+    def _center(text, width):
+        """Center text in width (odd padding goes where prettytable puts it)"""
+
+        excess = width - len(text)
+        if excess % 2 and len(text) % 2:
+            return ' ' * (excess // 2) + text + ' ' * (excess // 2 + 1)
+        elif excess % 2:
+            return ' ' * (excess // 2 + 1) + text + ' ' * (excess // 2)
+        else:
+            return ' ' * (excess // 2) + text + ' ' * (excess // 2)
+
+    def render(self, header, rows, numbered=False):
+        """
+        Render the rows
+        :param list header: column names
+        :param rows: iterable of tuples of values
+        :param bool numbered: prepend a column with row numbers ('table' format only)
+        :return: rendered text
+        """
+
+        if self._format == 'json':
+            # numpy scalars are converted with .item()
+            return json.dumps([dict(zip(header, row)) for row in rows], default=lambda value: value.item())
+
+        cells = [[str(value) for value in row] for row in rows]
+        header = [str(name) for name in header]
+        if numbered and self._format == 'table':
+            header = [''] + header
+            cells = [[str(i)] + row for i, row in enumerate(cells)]
+
+        widths = [len(name) for name in header]
+        for row in cells:
+            for i, value in enumerate(row):
+                if len(value) > widths[i]:
+                    widths[i] = len(value)
+
+        if self._format == 'text':
+            lines = ['  '.join(value.ljust(w) for value, w in zip(row, widths)).rstrip()
+                     for row in [header] + cells]
+            return '\n'.join(lines)
+
+        border = '+' + '+'.join('-' * (w + 2) for w in widths) + '+'
+        lines = [border, '| ' + ' | '.join(self._center(name, w) for name, w in zip(header, widths)) + ' |', border]
+        for row in cells:
+            lines.append('| ' + ' | '.join(self._center(value, w) for value, w in zip(row, widths)) + ' |')
+        lines.append(border)
+
+        return '\n'.join(lines)
+
+
+class Metrics(object):
+    """
+    Thread safe counters and latency timers, with latency budgets
+
+    A timer with a budget counts its samples over budget ('<name>_over_budget')
+    and reports itself in violations() when its percentile exceeds it.
+    The name of the innermost running timer of each thread is kept for
+    SamplingProfiler.
+    """
+
+    def __init__(self, window=4096, budgets=None, on_over_budget=None):
+        """
+        Constructor for Metrics
+        :param int window: number of latest samples kept per timer (for percentiles)
+        :param dict budgets: timer name -> budget (seconds)
+        :param on_over_budget: function (timer name, seconds) called for every sample over budget, or None
+        """
+
+        self._lock = threading.Lock()
+        self._window = window
+        self._counters = Counter()
+        # timer name -> latest samples (seconds)
+        self._samples = {}
+        # timer name -> [count, total seconds, max seconds]
+        self._totals = {}
+        # timer name -> budget (seconds)
+        self._budgets = dict(budgets or {})
+        self._on_over_budget = on_over_budget
+        # thread id -> name of its innermost running timer
+        self.stages = {}
+
+    def incr(self, name, value=1):
+        """Increase counter"""
+
+        with self._lock:
+            self._counters[name] += value
+
+    def set_budget(self, name, seconds):
+        """Set latency budget of timer (None: remove it)"""
+
+        with self._lock:
+            if seconds is None:
+                self._budgets.pop(name, None)
+            else:
+                self._budgets[name] = seconds
+
+    def observe(self, name, seconds):
+        """Add timer sample"""
+
+        with self._lock:
+            if name not in self._samples:
+                self._samples[name] = deque(maxlen=self._window)
+                self._totals[name] = [0, 0.0, 0.0]
+            self._samples[name].append(seconds)
+            totals = self._totals[name]
+            totals[0] += 1
+            totals[1] += seconds
+            totals[2] = max(totals[2], seconds)
+            over = name in self._budgets and seconds > self._budgets[name]
+            if over:
+                self._counters[name + '_over_budget'] += 1
+
+        if over and self._on_over_budget is not None:
+            self._on_over_budget(name, seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """Time the with block"""
+
+        ident = threading.get_ident()
+        outer = self.stages.get(ident)
+        self.stages[ident] = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+            if outer is None:
+                self.stages.pop(ident, None)
+            else:
+                self.stages[ident] = outer
+
+    def snapshot(self):
+        """
+        Current values
+        :return: dict with counters, per timer count, mean, p50, p99 and max seconds, and budgets
+        """
+
+        with self._lock:
+            counters = dict(self._counters)
+            samples = {name: list(values) for name, values in self._samples.items()}
+            totals = {name: list(values) for name, values in self._totals.items()}
+            budgets = dict(self._budgets)
+
+        timers = {}
+        for name, (count, total, longest) in totals.items():
+            timers[name] = {'count': count,
+                            'mean': total / count,
+                            'p50': percentile(samples[name], 50),
+                            'p99': percentile(samples[name], 99),
+                            'max': longest}
+
+        return {'counters': counters, 'timers': timers, 'budgets': budgets}
+
+    def violations(self, q=99):
+        """
+        Timers over their budget
+        :param float q: percentile compared with the budget
+        :return: dict timer name -> {'budget': seconds, 'p<q>': seconds}
+        """
+
+        with self._lock:
+            samples = {name: list(self._samples[name]) for name in self._budgets if name in self._samples}
+            budgets = dict(self._budgets)
+
+        over = {}
+        for name, values in samples.items():
+            latency = percentile(values, q)
+            if latency > budgets[name]:
+                over[name] = {'budget': budgets[name], 'p{0:g}'.format(q): latency}
+
+        return over
+
+    def prometheus(self, prefix):
+        """
+        Current values in the Prometheus text format
+        :param str prefix: metric name prefix, like 'chatbot_server'
+        :return: text (counters as '<prefix>_<name>_total', timers as summaries '<prefix>_<name>_seconds')
+        """
+
+        def metric(name, suffix=''):
+            return re.sub(r'[^a-zA-Z0-9_]', '_', '{0}_{1}{2}'.format(prefix, name, suffix))
+
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE {0} counter'.format(metric(name, '_total')))
+            lines.append('{0} {1}'.format(metric(name, '_total'), value))
+        for name, timer in sorted(snapshot['timers'].items()):
+            lines.append('# TYPE {0} summary'.format(metric(name, '_seconds')))
+            lines.append('{0}{{quantile="0.5"}} {1!r}'.format(metric(name, '_seconds'), timer['p50']))
+            lines.append('{0}{{quantile="0.99"}} {1!r}'.format(metric(name, '_seconds'), timer['p99']))
+            lines.append('{0}_sum {1!r}'.format(metric(name, '_seconds'), timer['mean'] * timer['count']))
+            lines.append('{0}_count {1}'.format(metric(name, '_seconds'), timer['count']))
+        for name, budget in sorted(snapshot['budgets'].items()):
+            if name not in snapshot['timers']:
+                continue
+            lines.append('# TYPE {0} gauge'.format(metric(name, '_budget_seconds')))
+            lines.append('{0} {1!r}'.format(metric(name, '_budget_seconds'), budget))
+
+        return '\n'.join(lines) + '\n'
+
+
+def export_metrics(FileName, metrics):
+    """
+    Write metrics to a file, replacing it atomically (for a Prometheus textfile collector or a json reader)
+    :param str FileName: .json file (json snapshots) or any other name (Prometheus text)
+    :param dict metrics: prefix -> Metrics
+    """
+
+    if FileName.endswith('.json'):
+        text = json.dumps({prefix: m.snapshot() for prefix, m in metrics.items()}, sort_keys=True)
+    else:
+        text = ''.join(m.prometheus(prefix) for prefix, m in sorted(metrics.items()))
+
+    temp = '{0}.{1}.tmp'.format(FileName, os.getpid())
+    with open(temp, 'w') as f:
+        f.write(text)
+    os.replace(temp, FileName)
+
+
+def export_metrics_every(FileName, metrics, interval=10.0):
+    """
+    Call export_metrics periodically in a daemon thread
+    :param str FileName: as in export_metrics
+    :param dict metrics: prefix -> Metrics
+    :param float interval: seconds between exports
+    :return: threading.Event, set it to stop (after a last export)
+    """
+
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            export_metrics(FileName, metrics)
+        export_metrics(FileName, metrics)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+
+    return stop
+
+
+class SamplingProfiler(object):
+    """
+    Statistical profiler: samples the stacks of the other threads at a fixed interval
+
+    Stacks are counted in the folded format of flame graph tools
+    ('stage;module:function;... count'), the first frame being the innermost
+    running Metrics timer of the thread (or '-'). Opt-in: costs nothing until
+    started, then one stack walk per thread and interval.
+    """
+
+    def __init__(self, interval=0.005, metrics=(), max_depth=64):
+        """
+        Constructor for SamplingProfiler
+        :param float interval: seconds between samples
+        :param metrics: Metrics whose running timers label the samples
+        :param int max_depth: maximal number of frames kept per stack (innermost ones)
+        """
+
+        self._interval = interval
+        self._metrics = list(metrics)
+        self._max_depth = max_depth
+        self._lock = threading.Lock()
+        # folded stack -> number of samples
+        self.stacks = Counter()
+        self._stop = None
+        self._thread = None
+
+    def _stage(self, ident):
+        """Innermost running timer of thread"""
+
+        for metrics in self._metrics:
+            stage = metrics.stages.get(ident)
+            if stage is not None:
+                return stage
+
+        return '-'
+
+    def _sample(self):
+        """Add the current stacks of the other threads"""
+
+        own = threading.get_ident()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            frames = []
+            while frame is not None and len(frames) < self._max_depth:
+                code = frame.f_code
+                frames.append('{0}:{1}'.format(os.path.basename(code.co_filename), code.co_name))
+                frame = frame.f_back
+            stack = ';'.join([self._stage(ident)] + frames[::-1])
+            with self._lock:
+                self.stacks[stack] += 1
+
+    def start(self):
+        """Start sampling in a daemon thread"""
+
+        if self._thread is not None:
+            return
+
+        self._stop = threading.Event()
+
+        def run():
+            while not self._stop.wait(self._interval):
+                self._sample()
+
+        self._thread = threading.Thread(target=run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop sampling (the samples are kept)"""
+
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def top(self, n=20):
+        """
+        Functions with the most samples
+        :param int n: number of functions
+        :return: list of (stage;function, samples where it runs, samples where it is on the stack)
+        """
+
+        own, total = Counter(), Counter()
+        with self._lock:
+            stacks = list(self.stacks.items())
+        for stack, count in stacks:
+            frames = stack.split(';')
+            stage = frames[0]
+            own['{0};{1}'.format(stage, frames[-1])] += count
+            for frame in set(frames[1:]):
+                total['{0};{1}'.format(stage, frame)] += count
+
+        return [(name, samples, total[name]) for name, samples in own.most_common(n)]
+
+    def save(self, FileName):
+        """Write the folded stacks (one 'stack count' line each)"""
+
+        with self._lock:
+            stacks = sorted(self.stacks.items())
+        with open(FileName, 'w') as f:
+            for stack, count in stacks:
+                f.write('{0} {1}\n'.format(stack, count))
+
+
+class Session(object):
+    """
+    State of one conversation with the bot
+
+    pack() (or Bot.save_session()) stores it in a binary record of a few bytes,
+    Bot.load_session() resumes it in this or another process (see MemorySessionStore and
+    SQLiteSessionStore).
+    """
+
+    __slots__ = ('stage', 'greeted', 'asked_cat', 'asked_brand', 'asked_prod', 'asked_conv',
+                 'category', 'brand', 'searchtype', 'plan_filter', 'candidates',
+                 'current_input', 'current_type', 'raw_input', 'intent', 'catalog')
+
+    # fields that decide the reply to an input (the others are set from the input)
+    STATE = ('stage', 'greeted', 'asked_cat', 'asked_brand', 'asked_prod', 'asked_conv',
+             'category', 'brand', 'searchtype', 'plan_filter', 'candidates', 'catalog')
+
+    # binary record: format version, flags, catalog fingerprint, category, brand
+    # (utf-8 with uint16 length), then plan filter and candidates if flagged
+    record_format = 1
+    _header = struct.Struct('<BHI')
+    _length = struct.Struct('<H')
+    _plan = struct.Struct('<ddi')
+    _count = struct.Struct('<I')
+    # flags: stage and search type (their positions in these tuples), booleans, optional parts
+    _stages = ('conv', 'main', 'product', 'done')
+    _searchtypes = (None, 'category', 'brand')
+    _booleans = ('greeted', 'asked_cat', 'asked_brand', 'asked_prod', 'asked_conv')
+    _HAS_CATALOG, _HAS_PLAN, _HAS_CANDIDATES = 1 << 9, 1 << 10, 1 << 11
+
+    def __init__(self):
+
+        # What the bot waits for: 'conv' (answer to "would you like to look at our products?"),
+        # 'main' (category/brand search), 'product' (choice of a particular product), 'done'
+        self.stage = 'conv'
+        # If we said hi already
+        self.greeted = False
+        # If we asked about category
+        self.asked_cat = False
+        # If we asked about brand
+        self.asked_brand = False
+        # If we asked about search in categories
+        self.asked_prod = False
+        # Ask for conversation
+        self.asked_conv = True
+        # Current category under discussion
+        self.category = None
+        # Current brand under discussion
+        self.brand = None
+        # Current search type (category first or brand first)
+        self.searchtype = None
+        # Plan constraint: (lowest plan, highest plan, number of cheapest products, words of the input)
+        self.plan_filter = None
+        # Row positions of the products offered to choose from
+        self.candidates = None
+
+        # word list (TextBlob)
+        self.current_input = None
+        # Grammatic type of words
+        self.current_type = None
+        # string with row input (lower case)
+        self.raw_input = None
+        # Intents and slots of the current input (Intent), extracted on first use
+        self.intent = None
+
+        # Catalog version (CatalogIndex) of the current search
+        self.catalog = None
+
+    def pack(self):
+        """
+        Binary record of the conversation (the current input is not kept)
+
+        The catalog version is stored as its fingerprint and the candidates
+        as int32 row positions: a session waiting for an answer takes
+        about 10 bytes plus its category and brand names.
+        :return: bytes
+        """
+
+        import numpy as np
+
+        flags = self._stages.index(self.stage) | self._searchtypes.index(self.searchtype) << 7
+        for i, name in enumerate(self._booleans):
+            if getattr(self, name):
+                flags |= 1 << (i + 2)
+        parts = [None, self._pack_text(self.category), self._pack_text(self.brand)]
+
+        if self.plan_filter is not None:
+            flags |= self._HAS_PLAN
+            low, high, cheapest, words = self.plan_filter
+            parts.append(self._plan.pack(float('nan') if low is None else low, float('nan') if high is None else high,
+                                         -1 if cheapest is None else cheapest))
+            parts.append(self._pack_text(words))
+        if self.candidates is not None:
+            flags |= self._HAS_CANDIDATES
+            parts.append(self._count.pack(len(self.candidates)))
+            parts.append(np.asarray(self.candidates, dtype='<i4').tobytes())
+
+        fingerprint = 0
+        if self.catalog is not None:
+            flags |= self._HAS_CATALOG
+            fingerprint = self.catalog.fingerprint
+        parts[0] = self._header.pack(self.record_format, flags, fingerprint)
+
+        return b''.join(parts)
+
+    @classmethod
+    def unpack(cls, data, catalogs=()):
+        """
+        Conversation from a record of pack()
+        :param bytes data: the record
+        :param list catalogs: catalog versions (CatalogIndex) the session may be on, the current
+            one first; a session on another version continues its search on the current one
+            (an open choice of a product is asked again)
+        :return: Session
+        """
+
+        import numpy as np
+
+        record_format, flags, fingerprint = cls._header.unpack_from(data)
+        if record_format != cls.record_format:
+            raise ValueError('session record of format {0}, expected {1}'.format(record_format, cls.record_format))
+
+        s = cls()
+        s.stage = cls._stages[flags & 3]
+        s.searchtype = cls._searchtypes[flags >> 7 & 3]
+        for i, name in enumerate(cls._booleans):
+            setattr(s, name, bool(flags & 1 << (i + 2)))
+        offset = cls._header.size
+        s.category, offset = cls._unpack_text(data, offset)
+        s.brand, offset = cls._unpack_text(data, offset)
+
+        if flags & cls._HAS_PLAN:
+            low, high, cheapest = cls._plan.unpack_from(data, offset)
+            words, offset = cls._unpack_text(data, offset + cls._plan.size)
+            s.plan_filter = (None if math.isnan(low) else low, None if math.isnan(high) else high,
+                             None if cheapest < 0 else cheapest, words)
+        if flags & cls._HAS_CANDIDATES:
+            count, = cls._count.unpack_from(data, offset)
+            offset += cls._count.size
+            s.candidates = np.frombuffer(data, dtype='<i4', count=count, offset=offset).tolist()
+
+        if flags & cls._HAS_CATALOG:
+            s.catalog = next((catalog for catalog in catalogs if catalog.fingerprint == fingerprint), None)
+            if s.catalog is None and catalogs:
+                # row positions of a catalog version that is gone
+                s.catalog = catalogs[0]
+                s.candidates = None
+                if s.stage == 'product':
+                    s.stage = 'main'
+
+        return s
+
+    @classmethod
+    def _pack_text(cls, text):
+        """Record of a str or None"""
+
+        if text is None:
+            return cls._length.pack(0xffff)
+
+        data = text.encode('utf-8')
+        return cls._length.pack(len(data)) + data
+
+    @classmethod
+    def _unpack_text(cls, data, offset):
+        """str or None stored at offset by _pack_text, and the offset after it"""
+
+        length, = cls._length.unpack_from(data, offset)
+        offset += cls._length.size
+        if length == 0xffff:
+            return None, offset
+
+        return bytes(data[offset:offset + length]).decode('utf-8'), offset + length
+
+
+class MemorySessionStore(object):
+    """ Session records (Session.pack()) of idle conversations in a dict """
+
+    # calls return right away (ChatServer makes them on its event loop)
+    blocking = False
+
+    def __init__(self):
+
+        # session id -> record
+        self._records = {}
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, sid):
+        """Record of the session, None if unknown"""
+
+        return self._records.get(sid)
+
+    def put(self, sid, record):
+        """Store the record of the session"""
+
+        self._records[sid] = record
+
+    def delete(self, sid):
+        """Forget the session"""
+
+        self._records.pop(sid, None)
+
+    def close(self):
+        pass
+
+
+class SQLiteSessionStore(object):
+    """
+    Session records (Session.pack()) in an SQLite file
+
+    Processes sharing the file can resume each other's conversations, and
+    the sessions outlive a restart. Each put() is committed (write-ahead
+    log, synchronous=NORMAL: a commit survives a crash of the process, not
+    of the machine).
+    """
+
+    # calls wait for the disk and for the write lock of the file (ChatServer makes them in its thread pool)
+    blocking = True
+
+    def __init__(self, FileName):
+        """
+        Constructor for SQLiteSessionStore
+        :param str FileName: name of the database file (created if needed)
+        """
+
+        import sqlite3
+
+        self._db = sqlite3.connect(FileName, timeout=30, check_same_thread=False, isolation_level=None)
+        # one connection, used from the server threads
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute('PRAGMA journal_mode=WAL')
+            self._db.execute('PRAGMA synchronous=NORMAL')
+            self._db.execute('CREATE TABLE IF NOT EXISTS sessions (id TEXT PRIMARY KEY, record BLOB NOT NULL)')
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def get(self, sid):
+        """Record of the session, None if unknown"""
+
+        with self._lock:
+            row = self._db.execute('SELECT record FROM sessions WHERE id = ?', (sid,)).fetchone()
+
+        return None if row is None else bytes(row[0])
+
+    def put(self, sid, record):
+        """Store the record of the session"""
+
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO sessions (id, record) VALUES (?, ?)', (sid, record))
+
+    def delete(self, sid):
+        """Forget the session"""
+
+        with self._lock:
+            self._db.execute('DELETE FROM sessions WHERE id = ?', (sid,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
 
 class Bot(object):
     """ A class for Grover ChatBot """
 
-    def __init__(self, FileName):
+    def __init__(self, FileName, cache_size=4096, cache_file=None, corrector='textblob',
+                 synonyms_file=None, output_format='table', warm_up=None, budgets=None,
+                 response_cache_size=1024, recommendations=3, version_ttl=3600.0):
         """
         Constructor for ChatBot
         :param str FileName: name of the .csv file with available products
+        :param int cache_size: maximal number of normalized words to keep in memory
+        :param str cache_file: json file to warm the word cache from; if it does not exist yet,
+            the cache is filled with the catalog vocabulary and saved there
+        :param str corrector: spell correction engine, 'textblob' (full English model)
+            or 'domain' (nearest word of the bot vocabulary, other words are left as is)
+        :param str synonyms_file: .csv file with extra 'keyword,replacement' rows for user input
+        :param str output_format: how to show tables, 'table', 'text' or 'json'
+        :param str warm_up: when to load the NLP models: None (with the first message),
+            'background' (in a thread, right away) or 'now' (before returning)
+        :param dict budgets: latency budgets of the turn stages, timer name -> seconds (see metrics)
+        :param int response_cache_size: maximal number of replies to keep for repeated inputs (0: none)
+        :param int recommendations: number of similar products offered with the chosen one (0: none)
+        :param float version_ttl: seconds a catalog version is kept after the last session record on it
+            was stored with save_session() (session objects hold their version as long as they live)
         """
 
-        # read data from csv file
-        self._data = pd.read_csv(FileName, index_col=0)
-        self._data.columns = ['name', 'brand', 'category', 'plan']
-
         # manually add categories
         self._categories = {'computer', 'phone', 'home', 'drone', 'clock', 'game'}
 
-        # make all the brands lower case
-        self._data['brand'] = self._data['brand'].apply(lambda x: x.lower())
-        # add brands
-        self._all_brands = list(self._data['brand'].unique())
-
         # rename categories in the data frame
         self._map = {'phone':'Phones & Tablets',
                    'computer':'Computing',
@@ -35,36 +2259,51 @@ class Bot(object):
                    'drone':'Drones'
                    }
 
-        for m, val in self._map.items():
-            self._data.loc[self._data['category']==val, 'category'] = m
+        # current catalog version (products, brands and their index); reload() replaces it,
+        # sessions keep the version they started their search with
+        self._file_name = FileName
+        self._catalog = self._load_catalog(FileName)
+        self._catalog.version = 1
+        # versions still referenced (by sessions or the bot): version -> CatalogIndex
+        self._versions = weakref.WeakValueDictionary({1: self._catalog})
+        # versions of the session records stored with save_session(): version -> [CatalogIndex, time of last save]
+        self._retired = {}
+        self._retired_lock = threading.Lock()
+        self._version_ttl = version_ttl
+        # serializes reloads
+        self._reload_lock = threading.Lock()
+        # serializes typeahead builds
+        self._typeahead_lock = threading.Lock()
+        # timers of the turn stages ('turn', 'tag', 'normalize', 'results', 'plan_rows', 'product_search',
+        # 'render', 'recommend'), completions ('suggest') and reloads ('reload'), counters of turns,
+        # caches, catalog lookups and reloads
+        self.metrics = Metrics(budgets=budgets)
+        # renders listings of categories, brands and products
+        self._renderer = TableRenderer(output_format)
 
         # set with quit keywords
         self._quit_words = {'bye', 'bye-bye', 'exit', 'quit', 'leave'}
         # set with greeting keywords
         self._greet_words = {'hi', 'hello'}
-
-        # word list (TextBlob)
-        self._current_input = None
-        # string with row input (lower case)
-        self._raw_input = None
-        # Grammatic type of words
-        self._current_type = None
-        # If we said hi already
-        self._greeted = False
-        # If we asked about category
-        self._asked_cat = False
-        # If we asked about brand
-        self._asked_brand = False
-        # If we asked about search in categories
-        self._asked_prod = False
-        # Ask for conversation
-        self._asked_conv = True
-        # Current category under discussion
-        self._category = None
-        # Current brand under discussion
-        self._brand = None
-        # Current search type (category first or brand first)
-        self._searchtype = None
+        # quit, greeting, yes/no, category, brand and search type of a message in one pass
+        self._intents = IntentExtractor(self._quit_words, self._greet_words, self._categories)
+
+        # plan constraints in user input, like 'under $40', 'between 30 and 50' or 'the 3 cheapest'
+        amount = r'\$?(\d+(?:\.\d+)?)(?:\s*(?:usd|eur|euros?|dollars?|bucks)\b|\s*\$|(?!\w|\.\d))'
+        self._amount_pattern = re.compile(amount)
+        self._plan_patterns = [
+            ('between', re.compile(r'\b(?:between|from)\s+' + amount + r'\s*(?:and|to|-)\s*' + amount)),
+            ('under', re.compile(r'\b(?:under|below|less than|cheaper than|lower than)\s+' + amount)),
+            ('up to', re.compile(r'\b(?:up to|at most|max(?:imum)?)\s+' + amount + r'|' + amount + r'\s*or less\b')),
+            ('over', re.compile(r'\b(?:over|above|more than|higher than)\s+' + amount)),
+            ('at least', re.compile(r'\b(?:at least|from|min(?:imum)?)\s+' + amount + r'|' + amount + r'\s*or more\b')),
+            ('cheapest', re.compile(r'\b(?:(\d+)\s+)?cheapest(?:\s+(\d+)(?!\w))?')),
+        ]
+
+        # conversation of the console frontend (start_conversation)
+        self._session = Session()
+        # number of similar products offered after "you got it!"
+        self._recommendations = recommendations
 
         # keywords to replace in user input
         self._replace_dict = {'laptop': 'computer',
@@ -97,124 +2336,572 @@ class Bot(object):
                               'give': 'want',
                               'smart': 'home'
                               }
+        if synonyms_file is not None:
+            self._replace_dict.update(KeywordRewriter.read_table(synonyms_file))
+        self._rewriter = KeywordRewriter(self._replace_dict)
+
+        # spell corrector over the bot vocabulary (None: use TextBlob)
+        if corrector not in ('textblob', 'domain'):
+            raise ValueError("unknown corrector '{0}'".format(corrector))
+        self._corrector_name = corrector
+        self._corrector = self._make_corrector(self._catalog)
+
+        # normalized words (raw token -> lemmatized, singularized and corrected word)
+        self._word_cache = LRUCache(cache_size)
+        if cache_file is not None:
+            self._warm_word_cache(cache_file)
+        # replies of whole turns: (session state, lower case input, catalog versions) ->
+        # (session state after the turn, analyze() result, bot messages)
+        self._responses = LRUCache(response_cache_size)
+
+        # thread loading the NLP models (analyze waits for it)
+        self._warm_thread = None
+        if warm_up == 'background':
+            self._warm_thread = threading.Thread(target=self.warm_up)
+            self._warm_thread.daemon = True
+            self._warm_thread.start()
+        elif warm_up == 'now':
+            self.warm_up()
+        elif warm_up is not None:
+            raise ValueError("unknown warm_up '{0}'".format(warm_up))
+
+    def _load_catalog(self, FileName):
+        """
+        Load catalog version from .csv or snapshot file
+        :param str FileName: name of the file
+        :return: CatalogIndex
+        """
+
+        # imported before the clock starts: the load rate is the one of parsing
+        import numpy
+
+        if CatalogIndex.is_snapshot(FileName):
+            start = time.perf_counter()
+            catalog = CatalogIndex.load(FileName)
+        else:
+            import pandas
+            start = time.perf_counter()
+            catalog = self._read_csv(FileName)
+        seconds = time.perf_counter() - start
+
+        rows = len(catalog)
+        catalog.load_stats = {'file': FileName, 'rows': rows, 'seconds': seconds,
+                              'rows_per_s': rows / seconds if seconds else 0.0, 'peak_rss': peak_rss()}
+        return catalog
+
+    def _read_csv(self, FileName):
+        """
+        Read catalog from csv file
+        :param str FileName: name of the .csv file with available products
+        :return: CatalogIndex with brands in lower case and short category names
+        """
+
+        return CatalogIndex.read_csv(FileName, {val: m for m, val in self._map.items()})
+
+    def save_snapshot(self, FileName):
+        """
+        Save the catalog and its index as binary snapshot, Bot(FileName) loads it back
+        :param str FileName: name of the snapshot file
+        """
+
+        self._catalog.save(FileName)
+
+    def reload(self, FileName=None, background=False):
+        """
+        Load new catalog version and swap it in
+
+        The version (with its index, spell corrector, word cache warmed with the
+        words of the current one and empty response cache) is built aside and
+        replaces the current one at once. Sessions finish their search on the
+        version they started it with and switch at the next "would you like to
+        look at our products?".
+        :param str FileName: .csv or snapshot file (default: the current catalog file)
+        :param bool background: build in a daemon thread and return right away
+        :return: new CatalogIndex (the thread if background)
+        """
+
+        if background:
+            thread = threading.Thread(target=self.reload, args=(FileName,))
+            thread.daemon = True
+            thread.start()
+            return thread
+
+        FileName = FileName or self._file_name
+        with self._reload_lock:
+            start = time.perf_counter()
+            catalog = self._load_catalog(FileName)
+            catalog.version = self._catalog.version + 1
+            corrector = self._make_corrector(catalog)
+            word_cache = self._carry_word_cache(catalog, corrector)
+            responses = LRUCache(self._responses.maxsize)
+
+            self._prune_retired()
+            self._catalog, self._corrector, self._word_cache = catalog, corrector, word_cache
+            self._responses = responses
+            self._file_name = FileName
+            self._versions[catalog.version] = catalog
+            self.metrics.observe('reload', time.perf_counter() - start)
+            self.metrics.incr('reloads')
+
+        return catalog
+
+    def watch(self, FileName=None, interval=2.0):
+        """
+        Reload the catalog whenever its file changes
+
+        A daemon thread polls modification time and size. Replace the file
+        atomically (write another file and rename it): a snapshot in use is
+        memory-mapped and must not be overwritten in place. A failed reload
+        keeps the current version.
+        :param str FileName: file to watch (default: the current catalog file)
+        :param float interval: seconds between checks
+        :return: threading.Event, set it to stop watching
+        """
+
+        FileName = FileName or self._file_name
+        stop = threading.Event()
+
+        def stamp():
+            try:
+                st = os.stat(FileName)
+            except OSError:
+                return None
+            return st.st_mtime_ns, st.st_size
+
+        def poll(last):
+            while not stop.wait(interval):
+                current = stamp()
+                if current is None or current == last:
+                    continue
+                last = current
+                try:
+                    self.reload(FileName)
+                except Exception as e:
+                    self.metrics.incr('reload_errors')
+                    print("reload of '{0}' failed: {1}".format(FileName, e), file=sys.stderr)
+
+        thread = threading.Thread(target=poll, args=(stamp(),))
+        thread.daemon = True
+        thread.start()
+
+        return stop
+
+    def catalog_stats(self):
+        """
+        Catalog versions and reloads
+        :return: dict with current version and rows, older versions still held by
+            sessions and their memory (bytes), number of reloads and failed reloads
+        """
+
+        self._prune_retired()
+        current = self._catalog
+        old = [catalog for catalog in list(self._versions.values()) if catalog is not current]
+        counters = self.metrics.snapshot()['counters']
+
+        return {'version': current.version,
+                'rows': len(current),
+                'load': current.load_stats,
+                'old_versions': sorted(catalog.version for catalog in old),
+                'old_bytes': sum(catalog.nbytes for catalog in old),
+                'reloads': counters.get('reloads', 0),
+                'reload_errors': counters.get('reload_errors', 0)}
+
+    def save_session(self, s):
+        """
+        Record of a conversation to resume with load_session() (Session.pack())
+
+        The catalog version of the session is kept for version_ttl seconds,
+        so that the conversation can finish its search on it after a reload.
+        :param Session s: conversation
+        :return: bytes
+        """
+
+        record = s.pack()
+        if s.catalog is not None:
+            now = time.monotonic()
+            self._prune_retired(now)
+            with self._retired_lock:
+                self._retired[s.catalog.version] = [s.catalog, now]
+
+        return record
+
+    def load_session(self, data):
+        """
+        Resume a conversation saved with save_session() or Session.pack() (in this or another process)
+
+        A session on a replaced catalog version continues on it if the version
+        is still loaded: kept for a record stored with save_session() within
+        version_ttl seconds, or held by a session object.
+        :param bytes data: the record
+        :return: Session
+        """
+
+        self._prune_retired()
+        current = self._catalog
+
+        return Session.unpack(data, [current] + [catalog for catalog in list(self._versions.values())
+                                                 if catalog is not current])
+
+    def _prune_retired(self, now=None):
+        """Stop keeping the catalog versions of records stored more than version_ttl seconds ago"""
+
+        if now is None:
+            now = time.monotonic()
+        with self._retired_lock:
+            expired = [version for version, (_, saved) in self._retired.items() if now - saved > self._version_ttl]
+            for version in expired:
+                del self._retired[version]
 
     @property
     def current_input(self):
-        return self._current_input
+        return self._session.current_input
 
     @property
     def current_type(self):
-        return self._current_type
+        return self._session.current_type
 
     @property
-    def current_type(self):
-        return self._raw_input
+    def raw_input(self):
+        return self._session.raw_input
 
     @current_input.setter
     def current_input(self, inp):
 
-        tb = TextBlob(self._preprocess_inp(inp)).tags
-        self._current_input = [self._process_word(t[0]) for t in tb]
-        self._current_type =[t[1] for t in tb]
-        self._raw_input = inp.lower()
+        self._set_input(self._session, inp)
+
+    def analyze(self, inp):
+        """
+        Tag and normalize user input (does not depend on any conversation)
+        :param str inp: user input
+        :return: tuple (word list, grammatic types of words, lower case input)
+        """
+
+        from textblob import TextBlob
+
+        if self._warm_thread is not None:
+            self._warm_thread.join()
+
+        with self.metrics.timer('tag'):
+            tb = TextBlob(self._preprocess_inp(inp)).tags
+        with self.metrics.timer('normalize'):
+            words = [self._process_word(t[0]) for t in tb]
+
+        return words, [t[1] for t in tb], inp.lower()
+
+    def analyze_batch(self, texts):
+        """
+        Tag and normalize many user inputs at once (same results as analyze())
+
+        Equal inputs are analyzed once, the sentences of all the others are
+        tagged in one call (the tagger model is loaded once per batch, not
+        per message) and every distinct token is normalized once.
+        :param list texts: user inputs
+        :return: list of analyze() results, in the order of texts
+        """
+
+        import nltk
+        from textblob import TextBlob
+        from textblob.utils import PUNCTUATION_REGEX
+
+        if self._warm_thread is not None:
+            self._warm_thread.join()
+
+        inputs = [self._preprocess_inp(text) for text in texts]
+        # distinct input -> position in tags
+        distinct = {}
+        for inp in inputs:
+            distinct.setdefault(inp, len(distinct))
+
+        # the tokens of every sentence, tagged together (as TextBlob.tags does sentence by sentence)
+        with self.metrics.timer('tag'):
+            sentences, owners = [], []
+            for inp, i in distinct.items():
+                for sentence in TextBlob(inp).sentences:
+                    sentences.append(list(sentence.tokens))
+                    owners.append(i)
+            tagged = nltk.pos_tag_sents(sentences) if sentences else []
+
+        tags = [[] for _ in distinct]
+        for i, sentence in zip(owners, tagged):
+            tags[i].extend((word, tag) for word, tag in sentence if not PUNCTUATION_REGEX.match(tag))
+
+        with self.metrics.timer('normalize'):
+            normalized = {}
+            for words in tags:
+                for word, _ in words:
+                    if word not in normalized:
+                        normalized[word] = self._process_word(word)
+
+        self.metrics.incr('batches')
+        self.metrics.incr('batched_inputs', len(texts))
+        analyzed = [([normalized[word] for word, _ in words], [tag for _, tag in words]) for words in tags]
+        return [analyzed[distinct[inp]] + (text.lower(),) for inp, text in zip(inputs, texts)]
+
+    def warm_up(self):
+        """Load TextBlob and its models (tagger, lemmatizer, spelling) by analyzing a sample"""
+
+        from textblob import TextBlob, Word
+
+        tb = TextBlob("hello, I would like to see some phones").tags
+        for w, _ in tb:
+            Word(w).lemmatize()
+            Word(w).singularize()
+        if self._corrector is None:
+            Word('phnoe').correct()
+
+    def _set_input(self, s, inp, analyzed=None):
+        """
+        Store user input in the conversation
+        :param Session s: conversation
+        :param str inp: user input
+        :param tuple analyzed: result of analyze(inp) if already computed
+        """
+
+        if analyzed is None:
+            analyzed = self.analyze(inp)
+        s.current_input, s.current_type, s.raw_input = analyzed
+        s.intent = None
+
+    def _intent(self, s):
+        """Intents and slots of the current input (extracted once per input and catalog version)"""
+
+        intent = s.intent
+        if intent is None or intent.catalog is not s.catalog:
+            intent = self._intents.extract(s.current_input, s.raw_input, s.catalog.brand_code, s.catalog)
+            s.intent = intent
+
+        return intent
 
     def _process_word(self, w):
-        """Lemmatize and singularize the word"""
+        """Lemmatize and singularize the word (cached)"""
 
-        if w not in self._all_brands:
+        processed = self._word_cache.get(w)
+        if processed is None:
+            self.metrics.incr('word_cache_misses')
+            processed = self._normalize_word(w)
+            self._word_cache.put(w, processed)
+        else:
+            self.metrics.incr('word_cache_hits')
+
+        return processed
+
+    def _normalize_word(self, w, catalog=None, corrector=None):
+        """
+        Lemmatize, singularize and correct the word
+        :param str w: the word
+        :param CatalogIndex catalog: catalog version of the brands (default: the current one)
+        :param DomainCorrector corrector: its corrector (default: the current one)
+        """
+
+        from textblob import Word
+
+        if catalog is None:
+            catalog = self._catalog
+        if corrector is None:
+            corrector = self._corrector
+        if w not in catalog.brand_code:
             w = Word(w).lemmatize()
             w = Word(w).singularize()
-            w = Word(w).correct()
+            if corrector is None:
+                w = Word(w).correct()
+            else:
+                w = corrector.correct(w)
 
         return w
 
+    def _make_corrector(self, catalog):
+        """Spell corrector for the catalog version (None: use TextBlob)"""
+
+        if self._corrector_name == 'domain':
+            return DomainCorrector(self._domain_vocabulary(catalog), keywords=self._control_words())
+
+        return None
+
+    def _catalog_vocabulary(self, catalog):
+        """Words the users are likely to type (with frequencies): product names, brands and keywords"""
+
+        words = Counter(catalog.brands)
+        words.update(self._categories | self._quit_words | self._greet_words)
+        for name in catalog.names.tolist():
+            words.update(re.findall(r"\w+", str(name).lower()))
+        for replace in self._replace_dict.values():
+            words.update(replace.split(' '))
+
+        return words
+
+    def _domain_vocabulary(self, catalog):
+        """Catalog vocabulary plus every keyword the dialogue logic reacts to"""
+
+        words = self._catalog_vocabulary(catalog)
+        for word in self._replace_dict:
+            words.update(word.split(' '))
+        # yes/no, search type and negation keywords used by the _check_* methods
+        words.update(self._control_words())
+        words.update(['brand', 'category', 'hate', 'dislike', 'discard', 'but', 'want',
+                      'else', 'other', 'none', 'nothing', 'another'])
+
+        return words
+
+    def _control_words(self):
+        """Keywords that steer the dialogue by themselves: quit, greeting, yes and no"""
+
+        return self._quit_words | self._greet_words | {'yes', 'ye', 'yep', 'yeah', 'would', 'no', 'not', 'nope'}
+
+    def _warm_word_cache(self, FileName):
+        """
+        Load the word cache from disk, or fill it with the catalog vocabulary and save it
+        :param str FileName: name of the json file with cached words
+        """
+
+        if os.path.exists(FileName):
+            self._word_cache.load(FileName)
+        else:
+            # dialogue keywords, then the most frequent catalog words that fit; put least
+            # frequent first (the last ones put are kept longest)
+            maxsize = self._word_cache.maxsize
+            keywords = sorted(self._categories | self._quit_words | self._greet_words)
+            words = keywords + [w for w, _ in self._catalog_vocabulary(self._catalog).most_common(
+                maxsize + len(keywords)) if w not in keywords]
+            for w in reversed(words[:maxsize]):
+                self._word_cache.put(w, self._normalize_word(w))
+            self.save_word_cache(FileName)
+
+    def _carry_word_cache(self, catalog, corrector):
+        """
+        Word cache of a new catalog version, with the words cached for the current one
+
+        Normalized words are carried over, except brand names of either version
+        (they are kept as they are instead of normalized); with the domain
+        corrector, whose vocabulary is the catalog's, every word is normalized again.
+        :param CatalogIndex catalog: the new version
+        :param DomainCorrector corrector: its corrector (None: TextBlob)
+        :return: LRUCache
+        """
+
+        cache = LRUCache(self._word_cache.maxsize)
+        brands = self._catalog.brand_code
+        for w, processed in self._word_cache.items():
+            if corrector is not None or w in brands or w in catalog.brand_code:
+                processed = self._normalize_word(w, catalog, corrector)
+            cache.put(w, processed)
+
+        return cache
+
+    def save_word_cache(self, FileName):
+        """
+        Save normalized words to disk (to warm up the next start)
+        :param str FileName: name of the json file
+        """
+
+        self._word_cache.save(FileName)
+
     def _preprocess_inp(self, inp):
         """Preprocess input string"""
 
         inp = inp.lower()
 
         # replace keywords in the string (if any)
-        for word, replace in self._replace_dict.items():
-            if word in inp:
-                inp = inp.replace(word, replace)
+        return self._rewriter.rewrite(inp)
 
-        return inp
-
-    def _check_usr_quit(self):
+    def _check_usr_quit(self, s):
         """Check if the user wants to quit"""
 
-        if self.current_input is not None:
-            if any(inp in self._quit_words for inp in self.current_input):
-                return True
-
-        return False
-
+        return self._intent(s).quit
 
-
-    def _check_for_greeting(self):
+    def _check_for_greeting(self, s):
         """Check if user said hello"""
-        if any(inp in self._greet_words for inp in self.current_input):
-            return True
-        else:
-            return False
 
-    def _say_hi(self):
+        return self._intent(s).greet
+
+    def _say_hi(self, s, out):
         """Say Hi"""
-        if not self._greeted:
-            print("Bot: Hi there!\n")
+        if not s.greeted:
+            out.append("Bot: Hi there!\n")
         else:
-            print("Bot: Hello again!\n")
+            out.append("Bot: Hello again!\n")
 
 
-    def _check_for_category_keywords(self):
+    def _check_for_category_keywords(self, s):
         """
         Check if user input contains some category keywords
         :return: 
         """
 
-        if self.current_input is not None:
-            return any(inp_word in self._categories for inp_word in self.current_input)
-        else:
-            return False
+        return self._intent(s).category_mentioned
 
-    def _get_category_from_input(self):
+    def _get_category_from_input(self, s):
         """
         Extract one category from input
         :return: 
         """
 
-        words = self._analyze_sentence_structure(self.current_input)
-
-        cats = [word for word in words if word in self._categories]
-        if len(cats)>=1:
-            return cats[0]
-        else:
-            return None
+        return self._intent(s).category
 
-    def _check_for_brand_keywords(self):
+    def _check_for_brand_keywords(self, s):
         """
         Check if user input contains some brand keywords
         :return: 
         """
 
-        if self.current_input is not None:
-            return any(inp_word in self._all_brands for inp_word in self.current_input)
-        else:
-            return False
+        return self._intent(s).brand_mentioned
 
-    def _get_brand_from_input(self):
+    def _get_brand_from_input(self, s):
         """
         Extract one brand from input
         :return: 
         """
 
-        words = self._analyze_sentence_structure(self.current_input)
+        return self._intent(s).brand
+
+    def _check_for_plan_keywords(self, s):
+        """Check if user input limits the plan (price range or cheapest products)"""
 
-        brands = [word for word in words if word in self._all_brands]
-        if len(brands)>=1:
-            return brands[0]
+        if s.raw_input is not None:
+            return any(pattern.search(s.raw_input) for _, pattern in self._plan_patterns)
         else:
-            return None
+            return False
+
+    def _get_plan_filter_from_input(self, s):
+        """
+        Extract plan constraint from input
+        :return: tuple (lowest plan, highest plan, number of cheapest products, words of the input);
+            plans are included, None for no limit
+        """
+
+        import numpy as np
+
+        low, high, cheapest = None, None, None
+        found = []
+        text = s.raw_input
+        for kind, pattern in self._plan_patterns:
+            for match in pattern.finditer(text):
+                found.append((match.start(), match.group(0).strip()))
+                values = [float(value) for value in match.groups() if value is not None]
+                if kind == 'cheapest':
+                    cheapest = int(values[0]) if values else 1
+                    continue
+
+                # strict limits: the next float32 plan inside the range
+                if kind == 'between':
+                    bounds = min(values), max(values)
+                elif kind == 'under':
+                    bounds = None, float(np.nextafter(np.float32(values[0]), np.float32(-np.inf)))
+                elif kind == 'up to':
+                    bounds = None, values[0]
+                elif kind == 'over':
+                    bounds = float(np.nextafter(np.float32(values[0]), np.float32(np.inf))), None
+                else:
+                    bounds = values[0], None
+
+                if bounds[0] is not None:
+                    low = bounds[0] if low is None else max(low, bounds[0])
+                if bounds[1] is not None:
+                    high = bounds[1] if high is None else min(high, bounds[1])
+
+            # a phrase counts once ('from 30 to 50' is not also 'from 30')
+            text = pattern.sub(lambda match: ' ' * len(match.group(0)), text)
+
+        return low, high, cheapest, ' and '.join(words for _, words in sorted(found))
 
     def _analyze_sentence_structure(self, words):
         """
@@ -253,56 +2940,63 @@ class Bot(object):
         return words_to_ret
 
 
-    def _print_table(self, table):
+    def _render_table(self, table):
         """
-        Print table using prettytable
-        :param data: 
-        :return: 
+        Render table with numbered rows
+        :param dict table: column name -> list of values
+        :return: table text
+        """
+
+        with self.metrics.timer('render'):
+            return self._renderer.render(list(table), zip(*table.values()), numbered=True)
+
+    def _summary_table(self, catalog, key, build):
+        """
+        Rendered summary table, computed once per catalog version
+        :param CatalogIndex catalog: catalog version
+        :param tuple key: table kind and its category/brand
+        :param build: function returning the table (column name -> list of values)
+        :return: table text
         """
 
-        df = pd.DataFrame(table)
+        text = catalog.tables.get(key)
+        if text is None:
+            self.metrics.incr('table_cache_misses')
+            text = self._render_table(build())
+            catalog.tables[key] = text
+        else:
+            self.metrics.incr('table_cache_hits')
 
-        output = StringIO()
-        df.to_csv(output)
-        output.seek(0)
-        pt = prettytable.from_csv(output)
+        return text
 
-        print (pt)
+    def _get_results(self, catalog, cat=None, brand=None):
+        """
+        Get results based on category and brand
+        :param CatalogIndex catalog: catalog version
+        :return: row positions of the products, number of categories, number of brands
+        """
 
-    def _get_results(self, cat=None, brand=None):
-        """Get results based on category and brand"""
+        with self.metrics.timer('results'):
+            results = catalog.rows(cat, brand)
+        self.metrics.incr('catalog_lookups')
+        self.metrics.incr('catalog_rows', len(results))
+        if not len(results):
+            return results, 0, 0
 
         if cat is not None and brand is not None:
-            results = self._data.loc[(self._data['category']==cat)&(self._data['brand']==brand), :]
-            if len(results):
-                return results, 1, 1
-            else:
-                return [], 0, 0
-
-        elif cat is not None and brand is None:
-            results = self._data.loc[(self._data['category']==cat), :]
-            if len(results):
-                return results, \
-                       1,\
-                       len(list(results.loc[results['category'] == cat, 'brand'].unique()))
-            else:
-                return [], 0, 0
-
-        elif cat is None and brand is not None:
-            results = self._data.loc[(self._data['brand']==brand), :]
-            if len(results):
-                return results,\
-                       len(list(results.loc[results['brand'] == brand, 'category'].unique())),\
-                       1
-            else:
-                return [], 0, 0
+            return results, 1, 1
+        elif cat is not None:
+            return results, 1, catalog.num_brands(cat)
         else:
-            return [], 0, 0
-
+            return results, catalog.num_categories(brand), 1
 
-    def _list_categories(self, results, brand=None):
+    def _list_categories(self, catalog, brand=None):
         """ List available categories of the products"""
 
+        return self._summary_table(catalog, ('categories', brand), lambda: self._category_table(catalog, brand))
+
+    def _category_table(self, catalog, brand=None):
+        """ Table with available categories of the products"""
 
         if brand is None:
             table = {'categories':[], 'number of brands': [], 'number of products':[]}
@@ -312,344 +3006,1174 @@ class Bot(object):
         for cat in self._categories:
 
             if brand is None:
-                data = results.loc[results['category']==cat, :]
                 table['categories'].append(self._map[cat])
-                table['number of brands'].append(len(list(data['brand'].unique())))
-                table['number of products'].append(len(data))
+                table['number of brands'].append(catalog.num_brands(cat))
+                table['number of products'].append(catalog.count(cat))
             else:
-                data = results.loc[(results['category']==cat)&(results['brand']==brand), :]
-                if len(data):
+                count = catalog.count(cat, brand)
+                if count:
                     table['categories'].append(self._map[cat])
-                    table['number of products'].append(len(data))
+                    table['number of products'].append(count)
 
-        self._print_table(table)
+        return table
 
-    def _list_brands(self, results, category=None):
+    def _list_brands(self, catalog, category=None):
         """ List available brands of the products"""
 
+        return self._summary_table(catalog, ('brands', category), lambda: self._brand_table(catalog, category))
+
+    def _brand_table(self, catalog, category=None):
+        """ Table with available brands of the products"""
 
         if category is not None:
             table = {'brands':[], 'number of products': []}
-            cat_brands = list(results.loc[results['category']==category, 'brand'].unique())
+            cat_brands = catalog.brands_of_category.get(category, [])
         else:
             table = {'brands':[], 'number of categories': [], 'number of products': []}
-            cat_brands = list(results['brand'].unique())
+            cat_brands = catalog.brands
 
         for brand in cat_brands:
+            table['brands'].append(brand)
             if category:
-                data = results.loc[
-                       (results['category']==category)&(results['brand']==brand), :]
-
-                if len(data):
-                    table['brands'].append(brand)
-                    table['number of products'].append(len(data))
+                table['number of products'].append(catalog.count(category, brand))
             else:
-                data = results.loc[(results['brand']==brand), :]
-
-                if len(data):
-                    table['brands'].append(brand)
-                    table['number of categories'].append(len(list(data['category'].unique())))
-                    table['number of products'].append(len(data))
+                table['number of categories'].append(catalog.num_categories(brand))
+                table['number of products'].append(catalog.count(brand=brand))
 
-        self._print_table(table)
+        return table
 
-    def _list_products(self, results, cat, brand):
+    def _list_products(self, catalog, results):
         """
-        List all products from category and brands
-        :param str category: current category
-        :param str brand: brand
-        :return: 
+        List products
+        :param CatalogIndex catalog: catalog version
+        :param results: row positions of the products, most expensive first (as in the catalog groups)
+        :return: table text
         """
 
-        products = results.loc[
-            (results['category']==cat)&(results['brand']==brand),
-            ['name', 'brand', 'plan']]
+        import numpy as np
 
-        products.sort_values(by='plan', ascending=False, inplace=True)
+        with self.metrics.timer('render'):
+            results = np.asarray(results)
 
-        output = StringIO()
-        products.to_csv(output)
-        output.seek(0)
-        pt = prettytable.from_csv(output)
+            # plans are float32: numpy scalars print them the way they are written in the file
+            rows = [(index, catalog.names[pos], catalog.brand_of(pos), float(str(catalog.plans[pos])))
+                    for index, pos in zip(catalog.ids[results].tolist(), results)]
 
-        print (pt)
+            return self._renderer.render([catalog.index_name, 'name', 'brand', 'plan'], rows)
 
-    def _check_searchtype_keywords(self):
-        """Check if user would like to go after brands or caegories"""
+    def _model_words(self, s):
+        """Words of the input (not negated) with letters and digits, like 's8' or 'i5-5250u'"""
 
-        if self.current_input is not None:
-            return any(inp_word in ('brand', 'category') for inp_word in self.current_input)
+        words = self._analyze_sentence_structure(s.raw_input.split())
+        return [w for w in words if re.search(r'\d', w) and re.search(r'[^\W\d_]', w) and
+                not self._amount_pattern.fullmatch(w)]
+
+    def _check_for_product_query(self, s):
+        """Check if user input names a product by its model code"""
+
+        if s.raw_input is not None:
+            return bool(self._model_words(s))
         else:
             return False
 
-    def _get_searchtype_from_input(self):
+    def _find_products(self, s, k=10, cutoff=0.6):
+        """
+        Products named in user input, within the current category, brand and plan range
+        :param Session s: conversation
+        :param int k: maximal number of products
+        :param float cutoff: minimal score relative to the best match
+        :return: row positions of the best matches, most expensive first
+        """
+
+        catalog = s.catalog
+        low, high = s.plan_filter[:2] if s.plan_filter is not None else (None, None)
+        with self.metrics.timer('product_search'):
+            hits = catalog.search.top(' '.join(self._model_words(s)), k,
+                                      catalog.selector(s.category, s.brand, low, high))
+        if not hits:
+            return []
+
+        found = [pos for pos, score in hits if score >= cutoff * hits[0][1]]
+        # listed like the catalog groups (ties in catalog order)
+        return sorted(found, key=lambda pos: (-catalog.plans[pos], pos))
+
+    def search(self, text, k=10, category=None, brand=None):
+        """
+        Ranked product search over the current catalog
+        :param str text: product name or model code (also partial)
+        :param int k: maximal number of results
+        :param str category: only products of this category (short name, like 'phone')
+        :param str brand: only products of this brand (lower case)
+        :return: list of dicts with id, name, brand, category, plan and score, best first
+        """
+
+        catalog = self._catalog
+        with self.metrics.timer('product_search'):
+            hits = catalog.search.top(text, k, catalog.selector(category, brand))
+        ids = catalog.ids[[pos for pos, _ in hits]].tolist()
+
+        return [{'id': index, 'name': catalog.names[pos], 'brand': catalog.brand_of(pos),
+                 'category': catalog.category_of(pos), 'plan': float(str(catalog.plans[pos])), 'score': score}
+                for index, (pos, score) in zip(ids, hits)]
+
+    def recommend(self, product_id, k=5):
+        """
+        Products similar to a product of the current catalog, of other brands or with a lower plan
+        :param product_id: id of the product
+        :param int k: maximal number of products
+        :return: list of dicts with id, name, brand, category, plan and score, most similar first
+        """
+
+        import numpy as np
+
+        catalog = self._catalog
+        found = np.flatnonzero(catalog.ids == product_id)
+        if not len(found):
+            raise KeyError("no product with id {0}".format(product_id))
+
+        with self.metrics.timer('recommend'):
+            similar = catalog.recommender.similar(int(found[0]), k)
+        ids = catalog.ids[[pos for pos, _ in similar]].tolist()
+
+        return [{'id': index, 'name': catalog.names[pos], 'brand': catalog.brand_of(pos),
+                 'category': catalog.category_of(pos), 'plan': float(str(catalog.plans[pos])), 'score': score}
+                for index, (pos, score) in zip(ids, similar)]
+
+    def suggest(self, prefix, k=10):
+        """
+        Completions of a partly typed message over the current catalog
+
+        Categories (short and display names), brands and the synonyms that
+        name them come first, by number of products, then the products
+        with a name word starting with the prefix, by plan (most expensive
+        first). The index is built on first use for each catalog version.
+        :param str prefix: typed text
+        :param int k: maximal number of completions
+        :return: list of dicts with text and kind ('category', 'brand', 'synonym' or 'product'); keywords
+            have their value (categories and brands their number of products), products their id, brand,
+            category and plan
+        """
+
+        catalog = self._catalog
+        with self.metrics.timer('suggest'):
+            typeahead = catalog.typeahead
+            if typeahead is None:
+                with self._typeahead_lock:
+                    if catalog.typeahead is None:
+                        catalog.typeahead = Typeahead(catalog.names, catalog.plans, self._typeahead_keywords(catalog))
+                    typeahead = catalog.typeahead
+            entries = typeahead.top(prefix, k)
+
+        suggestions = []
+        for entry in entries:
+            keyword = typeahead.keyword(entry)
+            if keyword is not None:
+                suggestions.append(dict(keyword))
+            else:
+                suggestions.append({'text': catalog.names[entry], 'kind': 'product', 'id': catalog.ids[entry].item(),
+                                    'brand': catalog.brand_of(entry), 'category': catalog.category_of(entry),
+                                    'plan': float(str(catalog.plans[entry]))})
+
+        return suggestions
+
+    def _typeahead_keywords(self, catalog):
+        """Keywords of the catalog for Typeahead: (texts, score, value) of categories, brands and synonyms"""
+
+        # keywords rank above every product (plans are far below)
+        base = 1e12
+        products = {}
+        keywords = []
+        for cat in catalog.categories:
+            products[cat] = len(catalog.rows(cat=cat))
+            texts = [self._map.get(cat, cat)] + ([cat] if cat in self._map else [])
+            keywords.append((texts, base + products[cat], {'text': texts[0], 'kind': 'category', 'value': cat,
+                                                            'products': products[cat]}))
+        for brand in catalog.brands:
+            products[brand] = len(catalog.rows(brand=brand))
+            keywords.append(([brand], base + products[brand], {'text': brand, 'kind': 'brand', 'value': brand,
+                                                               'products': products[brand]}))
+        # synonyms naming a category or brand (like 'iphone' -> 'apple phone')
+        for word, replace in sorted(self._replace_dict.items()):
+            named = [products[w] for w in replace.split(' ') if w in products]
+            if named and word not in products:
+                keywords.append(([word], base + min(named), {'text': word, 'kind': 'synonym', 'value': replace}))
+
+        return keywords
+
+    def _check_searchtype_keywords(self, s):
+        """Check if user would like to go after brands or caegories"""
+
+        return self._intent(s).searchtype is not None
+
+    def _get_searchtype_from_input(self, s):
         """Get search type"""
 
-        if 'category' in self.current_input:
-            return 'category'
-        elif 'brand' in self.current_input:
-            return 'brand'
-        else:
-            return None
+        return self._intent(s).searchtype
 
-    def _check_no_input(self):
+    def _check_no_input(self, s):
         """Check if user said no"""
 
-        if (self._current_input and
-                ('no' in self._current_input or 'not' in self._current_input or 'nope' in self._raw_input) and
-                not (self._check_for_brand_keywords())
-            ):
-            return True
-        else:
-            return False
+        return self._intent(s).no
 
-    def _check_yes_input(self):
+    def _check_yes_input(self, s):
         """Check if user said yes"""
 
-        if ((self._current_input) and
-                ('ye' in self._current_input or
-                         'yep' in self._current_input or
-                         'yeah' in self._current_input or
-                     ('would' in self._current_input and 'not' not in self._current_input)
-                 )
-            ):
-            return True
-
-    def _back_to_default(self):
-
-        self._asked_cat = False
-        self._asked_brand = False
-        self._asked_search = False
-        self._asked_prod = False
-        self._asked_conv = True
-        self._category = None
-        self._brand = None
-        self._searchtype = None
-
-    def _check_match(self, item, index):
-        """Count number of matches of input with item"""
-
-        words = self._raw_input.lower().split(' ')
+        return self._intent(s).yes
+
+    def _back_to_default(self, s):
+
+        s.catalog = self._catalog
+        s.asked_cat = False
+        s.asked_brand = False
+        s.asked_prod = False
+        s.asked_conv = True
+        s.category = None
+        s.brand = None
+        s.searchtype = None
+        s.plan_filter = None
+        s.candidates = None
+
+    def _match_scores(self, s, results):
+        """
+        Count number of matches of input with each product
+        :param Session s: conversation
+        :param results: row positions of the candidate products
+        :return: Counter row position -> number of matching input words
+        """
+
+        import numpy as np
+
+        words = s.raw_input.lower().split(' ')
         words = self._analyze_sentence_structure(words)
-        wname = str(item['name']).lower().split(' ')
-        pname = str(item['plan']).lower().split(' ')
-        matches = [w for w in words if
-                   w in wname or
-                   str(index).lower()==w or
-                   w in pname]
-        return len(matches)
-
-    def _ask_for_particular_item(self, results):
-        """ Asks for particular item in results"""
-
-        while len(results)>1:
-
-            self._list_products(results, cat=self._category, brand=self._brand)
-
-            self.current_input = input("Bot: which product would you like?\nUser: ")
-
-            if ('else' in self._raw_input or
-                        'other' in self._raw_input or
-                        'none' in self._raw_input or
-                        'nothing' in self._raw_input or
-                        'no' in self._raw_input or
-                        'nope' in self._raw_input or
-                        'another' in self._raw_input or
-                        'others' in self._raw_input or self._check_usr_quit()):
-                return 0
-
-            scores = {}
-            max_score = 0
-            for index, item in results.iterrows():
-                scores[index] = self._check_match(item, index)
-                if scores[index]>max_score:
-                    max_score = scores[index]
-
-            if not max_score == 0:
-                indeces = []
-                for index, item in results.iterrows():
-                    if scores[index] == max_score:
-                        indeces.append(index)
-
-                results = results.loc[indeces, :]
+
+        rows = np.unique(np.asarray(results, dtype=np.int32))
+        tokens = s.catalog.product_tokens
+        counts = np.zeros(len(rows), dtype=np.int32)
+        for w in words:
+            counts += tokens.matches(w, rows)
+
+        hit = np.flatnonzero(counts)
+        return Counter(dict(zip(rows[hit].tolist(), counts[hit].tolist())))
+
+    def _ask_for_particular_item(self, s, results, out):
+        """
+        Asks for particular item in results
+        :param Session s: conversation
+        :param results: row positions of the products
+        :param list out: bot messages
+        """
+
+        if len(results)>1:
+            s.candidates = [int(pos) for pos in results]
+            s.stage = 'product'
+            out.append(self._list_products(s.catalog, s.candidates))
+            out.append("Bot: which product would you like?")
+        else:
+            self._got_particular_item(s, results, out)
+
+    def _answer_particular_item(self, s, out):
+        """ Handle user answer to "which product would you like?" """
+
+        if ('else' in s.raw_input or
+                    'other' in s.raw_input or
+                    'none' in s.raw_input or
+                    'nothing' in s.raw_input or
+                    'no' in s.raw_input or
+                    'nope' in s.raw_input or
+                    'another' in s.raw_input or
+                    'others' in s.raw_input or self._check_usr_quit(s)):
+            if self._check_usr_quit(s):
+                self._say_bye(s, out)
             else:
-                print("Bot: sorry, your request does not match our records\n")
+                self._ask_for_conversation(s, out)
+            return
+
+        results = s.candidates
+        scores = self._match_scores(s, results)
+        max_score = max(scores.values()) if scores else 0
+
+        if not max_score == 0:
+            results = [pos for pos in results if scores[pos] == max_score]
+        else:
+            out.append("Bot: sorry, your request does not match our records\n")
+
+        self._ask_for_particular_item(s, results, out)
 
-        self._list_products(results, cat=self._category, brand=self._brand)
-        print("Bot: you got it!")
+    def _got_particular_item(self, s, results, out):
+        """ Show the chosen product and start over """
 
-        return 1
+        out.append(self._list_products(s.catalog, results))
+        out.append("Bot: you got it!")
 
-    def _ask_for_conversation(self):
+        if self._recommendations > 0 and len(results):
+            with self.metrics.timer('recommend'):
+                similar = s.catalog.recommender.similar(int(results[0]), self._recommendations)
+            if similar:
+                out.append("Bot: you may also like:\n")
+                out.append(self._list_products(s.catalog, [pos for pos, _ in similar]))
+
+        self._ask_for_conversation(s, out)
+
+    def _ask_for_conversation(self, s, out):
         """ Ask for conversation """
 
-        self.current_input = input("Bot: would you like to look at our products?\nUser: ")
+        self._back_to_default(s)
+        s.stage = 'conv'
+        out.append("Bot: would you like to look at our products?")
+
+    def _answer_conversation(self, s, out):
+        """ Handle user answer to "would you like to look at our products?" """
+
+        if self._check_usr_quit(s) or self._check_no_input(s):
+            self._say_bye(s, out)
+            return
+
+        # check for greeting
+        if self._check_for_greeting(s):
+            self._say_hi(s, out)
+        elif not (self._check_yes_input(s) or
+                  self._check_for_brand_keywords(s) or
+                  self._check_searchtype_keywords(s) or
+                  self._check_for_category_keywords(s) or
+                  self._check_for_product_query(s) or
+                  self._check_for_plan_keywords(s)):
+            out.append("Bot: Sorry? Would you like to look at our products?")
+            return
 
-        while not self._check_usr_quit() and not self._check_no_input():
+        s.asked_conv = False
+        s.stage = 'main'
+        self._search(s, out)
 
-            # check for greeting
-            if self._check_for_greeting():
-                self._say_hi()
-                return True
-            if self._check_yes_input():
-                return True
-            if self._check_for_brand_keywords():
-                return True
-            if self._check_searchtype_keywords():
-                return True
-            if self._check_for_category_keywords():
-                return True
+    def _say_bye(self, s, out):
+        """ Finish the conversation """
+
+        s.stage = 'done'
+        out.append("Bot: See you later!")
+
+    def _search(self, s, out):
+        """ One turn of the category/brand search """
+
+        # check for No answer
+        if self._check_no_input(s):
+            if s.asked_cat or s.asked_brand:
+                self._ask_for_conversation(s, out)
+                return
+
+        # check for Yes answer
+        elif self._check_yes_input(s):
+
+            if s.asked_cat or s.asked_brand:
+                s.asked_cat = False
+                s.asked_brand = False
+                out.append("Bot: Please, specify\n")
+
+        # check for category keywords in input
+        if self._check_for_category_keywords(s):
+            s.category = self._get_category_from_input(s)
+
+        # check for brand keywords in input
+        if self._check_for_brand_keywords(s):
+            s.brand = self._get_brand_from_input(s)
+
+        # check for "brand" and "category" keywords:
+        if self._check_searchtype_keywords(s):
+            s.searchtype = self._get_searchtype_from_input(s)
+
+        # check for price range or cheapest products
+        if self._check_for_plan_keywords(s):
+            s.plan_filter = self._get_plan_filter_from_input(s)
+
+        # products named by their model code: offer the best matches right away
+        if self._check_for_product_query(s):
+            found = self._find_products(s)
+            if found:
+                out.append("Bot: Here are the products matching your request:\n")
+                self._ask_for_particular_item(s, found, out)
+                return
+
+        # get search results based on category and brand
+        results, ncat, nbrand = self._get_results(s.catalog, cat=s.category, brand=s.brand)
+
+        # check if there is a mismatch between brand and category
+        if s.category is not None and s.brand is not None and not len(results):
+
+            if s.asked_cat:
+                out.append("Bot: sorry there is no category {0} for brand {1}".format(s.category, s.brand))
+                s.category = None
+                results, ncat, nbrand = self._get_results(s.catalog, cat=s.category, brand=s.brand)
+                s.asked_cat = False
+
+            if s.asked_brand:
+                out.append("Bot: sorry there is no brand {0} in category {1}".format(s.brand, s.category))
+                s.brand = None
+                results, ncat, nbrand = self._get_results(s.catalog, cat=s.category, brand=s.brand)
+                s.asked_brand = False
+
+        if ncat==1 and s.category is None:
+            s.category = s.catalog.category_of(results[0])
+        if nbrand==1 and s.brand is None:
+            s.brand = s.catalog.brand_of(results[0])
+
+
+        # The main decision tree
+        if s.category is None and s.brand is None and s.searchtype is None:
+
+            if s.asked_cat == True:
+                out.append("Bot: sorry, there is no such a product or category\n")
+
+            out.append("""Bot: we have the following categories for you today:\n""")
+            out.append(self._list_categories(s.catalog))
+            out.append("Bot: do you have a particular category in mind?\n")
+
+            s.asked_cat = True
+            s.asked_brand = False
+
+            s.searchtype = 'category'
+
+        elif s.category is None and s.brand is None and s.searchtype == 'category':
+
+            if s.asked_cat == True:
+                out.append("Bot: sorry, there is no such a product or category\n")
+
+            out.append("Bot: We have the following categories for you today:\n")
+            out.append(self._list_categories(s.catalog))
+            out.append("Bot: do you have a particular category in mind?\n")
+
+            s.asked_cat= True
+            s.asked_brand = False
+
+        elif s.category is None and s.brand is None and s.searchtype == 'brand':
+
+            if s.asked_brand == True:
+                out.append("Bot: sorry, there is no such a product or category\n")
+
+            out.append("Bot: We have the following brands for you today:\n")
+            out.append(self._list_brands(s.catalog))
+            out.append("Bot: do you have a brand in mind?\n")
+            s.asked_brand= True
+            s.asked_cat = False
 
-            self.current_input = input("Bot: Sorry? Would you like to look at our products?\nUser: ")
+        elif s.category and nbrand>1:
+            if s.asked_brand:
+                out.append("Bot: Sorry, there is no such a brand in category {0}\n".format(s.category))
 
-        return False
+            out.append("Bot: The category {0} has the following brands:\n".format(self._map[s.category]))
+            out.append(self._list_brands(s.catalog, s.category))
+            out.append("Bot: do you have a particular brand in mind?\n")
 
+            s.asked_brand= True
+            s.asked_cat = False
 
+        elif ncat>1 and s.brand:
+
+            if s.asked_cat:
+                out.append("Bot: Sorry, there is no such a category for brand {0}\n".format(s.brand))
+
+            out.append("Bot: The brand {0} is in the following categories:\n".format(s.brand))
+            out.append(self._list_categories(s.catalog, s.brand))
+            out.append("Bot: do you have a category in mind?\n")
+            s.asked_cat= True
+            s.asked_brand = False
+
+        elif ncat==1 and nbrand==1:
+
+            # products in the plan range (all of them if there are none)
+            if s.plan_filter is not None:
+                low, high, cheapest, words = s.plan_filter
+                with self.metrics.timer('plan_rows'):
+                    in_range = s.catalog.plan_rows(s.category, s.brand, low, high, cheapest)
+                if len(in_range):
+                    results = in_range
+                else:
+                    out.append("Bot: sorry, there is nothing {0} for brand {1} in {2}\n".format(
+                        words, s.brand, self._map[s.category]))
+
+            out.append(
+                "Bot: Here is the list of options for brand {0} in {1}:\n".format(
+                    s.brand, self._map[s.category])
+            )
+
+            # ask user for particular item
+            self._ask_for_particular_item(s, results, out)
+
+    def start(self, s):
+        """
+        Start a conversation
+        :param Session s: new conversation
+        :return: list of bot messages
+        """
+
+        out = ["Bot: Welcome!\n"]
+        self._ask_for_conversation(s, out)
+
+        return out
+
+    def step(self, s, inp, analyzed=None, key=None):
+        """
+        Process one user message
+        :param Session s: conversation (updated in place)
+        :param str inp: user input
+        :param tuple analyzed: result of analyze(inp) if already computed
+        :param tuple key: response_key(s, inp) if replay() already missed it (the
+            response cache is not looked up again)
+        :return: list of bot messages
+        """
+
+        if key is None:
+            key = self.response_key(s, inp)
+            out = self.replay(s, inp, key)
+            if out is not None:
+                return out
+
+        out = []
+        if s.stage == 'done':
+            return out
+
+        self.metrics.incr('turns')
+        if self._responses.maxsize:
+            self.metrics.incr('response_cache_misses')
+        with self.metrics.timer('turn'):
+            if s.catalog is None:
+                s.catalog = self._catalog
+            self._set_input(s, inp, analyzed)
+
+            if s.stage == 'conv':
+                self._answer_conversation(s, out)
+            elif s.stage == 'product':
+                self._answer_particular_item(s, out)
+            elif self._check_usr_quit(s):
+                self._say_bye(s, out)
+            else:
+                self._search(s, out)
+
+            self._responses.put(key, (tuple(getattr(s, name) for name in Session.STATE),
+                                      (s.current_input, s.current_type, s.raw_input), tuple(out)))
+
+        return out
+
+    def replay(self, s, inp, key=None):
+        """
+        Process one user message if the reply is cached
+
+        From the same state, the same input always gets the same reply and
+        next state (on the same catalog version): tagging, normalization,
+        catalog lookups and rendering are skipped.
+        :param Session s: conversation (updated in place if the reply is cached)
+        :param str inp: user input
+        :param tuple key: response_key(s, inp) if already computed
+        :return: list of bot messages, None if the reply is not cached
+        """
+
+        if s.stage == 'done' or not self._responses.maxsize:
+            return None
+
+        start = time.perf_counter()
+        if s.catalog is None:
+            s.catalog = self._catalog
+        cached = self._responses.get(key if key is not None else self.response_key(s, inp))
+        if cached is None:
+            return None
+
+        state, analyzed, out = cached
+        for name, value in zip(Session.STATE, state):
+            setattr(s, name, value)
+        s.current_input, s.current_type, s.raw_input = analyzed
+        s.intent = None
+
+        self.metrics.incr('turns')
+        self.metrics.incr('response_cache_hits')
+        self.metrics.observe('turn', time.perf_counter() - start)
+        return list(out)
+
+    def response_key(self, s, inp):
+        """Key of the reply to the input in the response cache (see replay())"""
+
+        state = tuple(getattr(s, name) for name in Session.STATE[:-2])
+        candidates = tuple(s.candidates) if s.candidates is not None else None
+        catalog = s.catalog if s.catalog is not None else self._catalog
+        return state + (candidates, catalog.version, self._catalog.version, inp.lower())
 
     def start_conversation(self):
+        """ Talk to the user on the console """
 
-        print ("Bot: Welcome!\n")
+        s = self._session
+        for message in self.start(s):
+            print (message)
 
-        while not self._check_usr_quit():
+        while s.stage != 'done':
+            for message in self.step(s, input("User: ")):
+                print (message)
 
-            if self._asked_conv:
-                self._back_to_default()
-                if not self._ask_for_conversation():
-                    break
-                self._asked_conv = False
 
-            # check for No answer
-            if self._check_no_input():
-                if self._asked_cat or self._asked_brand:
-                    self._back_to_default()
-                    if not self._ask_for_conversation():
-                        break
-                    self._asked_conv = False
+class BatchAnalyzer(object):
+    """
+    Micro-batching queue in front of Bot.analyze_batch
+
+    Inputs submitted from any thread are collected until max_batch of them
+    wait or the first one waited max_delay seconds, then analyzed together
+    in a worker thread; each submit() gets a future with its own result.
+    """
+
+    def __init__(self, bot, max_batch=32, max_delay=0.005):
+        """
+        Constructor for BatchAnalyzer
+        :param Bot bot: the bot analyzing the inputs
+        :param int max_batch: maximal number of inputs analyzed at once
+        :param float max_delay: maximal seconds an input waits for others
+        """
+
+        import queue
+
+        self._bot = bot
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        # (text, future), None to stop
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, text):
+        """
+        Queue user input
+        :param str text: user input
+        :return: concurrent.futures.Future of the analyze() result
+        """
+
+        from concurrent.futures import Future
 
-            # check for Yes answer
-            elif self._check_yes_input():
+        future = Future()
+        self._queue.put((text, future))
+        return future
 
-                if self._asked_cat or self._asked_brand:
-                    self._asked_cat = False
-                    self._asked_brand = False
-                    print ("Bot: Please, specify\n")
+    def analyze(self, text):
+        """Analyze user input in the next batch (blocking)"""
 
-            # check for category keywords in input
-            if self._check_for_category_keywords():
-                self._category = self._get_category_from_input()
+        return self.submit(text).result()
 
-            # check for brand keywords in input
-            if self._check_for_brand_keywords():
-                self._brand = self._get_brand_from_input()
+    def close(self):
+        """Analyze the inputs already queued and stop the worker"""
 
-            # check for "brand" and "category" keywords:
-            if self._check_searchtype_keywords():
-                self._searchtype = self._get_searchtype_from_input()
+        self._queue.put(None)
+        self._thread.join()
 
-            # get search results based on category and brand
-            results, ncat, nbrand = self._get_results(cat=self._category, brand=self._brand)
+    def _next_batch(self):
+        """Wait for the next batch of (text, future); None when closed"""
+
+        import queue
+
+        item = self._queue.get()
+        if item is None:
+            return None
+
+        batch = [item]
+        deadline = time.perf_counter() + self._max_delay
+        while len(batch) < self._max_batch:
+            try:
+                item = self._queue.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if item is None:
+                # stop after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+
+        return batch
+
+    def _run(self):
+        """Worker: analyze batches until closed"""
+
+        for batch in iter(self._next_batch, None):
+            # cancelled futures (their caller is gone) are left out, the others can no longer be cancelled
+            batch = [(text, future) for text, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = self._bot.analyze_batch([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                future.set_result(result)
+
+
+class ChatServer(object):
+    """
+    Newline-delimited json chat server, many sessions over one Bot
+
+    Requests (one json object per line):
+        {"session": "id"}                   start the session
+        {"session": "id", "text": "..."}    user message (starts unknown sessions first)
+        {"search": "...", "k": 10}          ranked product search (also "category", "brand")
+        {"suggest": "gal", "k": 10}         completions of a partly typed message
+        {"similar": 42, "k": 5}             products similar to product 42
+        {"stats": true}                     server and bot metrics
+    Responses:
+        {"session": "id", "messages": [...], "done": false}
+
+    Between messages, sessions are kept as records (Bot.save_session()) in a
+    store: a dict by default, or a file shared by several servers
+    (SQLiteSessionStore). The messages of a session must reach one server
+    at a time. Replies cached by the bot (Bot.replay) are sent right away. Tagging and
+    normalization run in a bounded thread pool, or in micro-batches of the
+    messages of all sessions (BatchAnalyzer) when batch_size > 1; when
+    max_pending requests wait for them, connections are not read any further
+    (backpressure). The rest of the turn (Bot.step) runs in the pool too: it
+    may build the search, choice or recommendation index of a catalog version.
+    """
+
+    def __init__(self, bot, workers=4, max_pending=64, budgets=None, batch_size=1, batch_delay=0.005,
+                 store=None):
+        """
+        Constructor for ChatServer
+        :param Bot bot: the bot (shared by all sessions)
+        :param int workers: number of threads tagging and normalizing input (and searching)
+        :param int max_pending: maximal number of messages waiting for or in the thread pool
+        :param dict budgets: latency budgets of the server timers ('queue', 'analyze', 'request'), name -> seconds
+        :param int batch_size: maximal number of messages tagged together (1: one at a time in the pool)
+        :param float batch_delay: maximal seconds a message waits for others to fill its batch
+        :param store: session store (MemorySessionStore, SQLiteSessionStore or alike, called in the thread
+            pool unless its blocking attribute is False), default: in memory
+        """
+
+        from concurrent.futures import ThreadPoolExecutor
+
+        self._bot = bot
+        self._pool = ThreadPoolExecutor(workers)
+        self._max_pending = max_pending
+        self._pending = None
+        self._batcher = BatchAnalyzer(bot, batch_size, batch_delay) if batch_size > 1 else None
+        # session id -> session record
+        self._store = store if store is not None else MemorySessionStore()
+        # session id -> [lock serializing its messages, number of messages holding or waiting for it]
+        self._locks = {}
+        self.metrics = Metrics(budgets=budgets)
+
+    async def _analyze(self, text):
+        """Run bot NLP in the thread pool"""
+
+        import asyncio
+
+        queued = time.perf_counter()
+        async with self._pending:
+            started = time.perf_counter()
+            self.metrics.observe('queue', started - queued)
+            if self._batcher is not None:
+                analyzed = await asyncio.wrap_future(self._batcher.submit(text))
+            else:
+                analyzed = await asyncio.get_running_loop().run_in_executor(self._pool, self._bot.analyze, text)
+            self.metrics.observe('analyze', time.perf_counter() - started)
 
-            # check if there is a mismatch between brand and category
-            if self._category is not None and self._brand is not None and not len(results):
+        return analyzed
 
-                if self._asked_cat:
-                    print("Bot: sorry there is no category {0} for brand {1}".format(self._category, self._brand))
-                    self._category = None
-                    results, ncat, nbrand = self._get_results(cat=self._category, brand=self._brand)
-                    self._asked_cat = False
+    async def _pooled(self, function, *args):
+        """
+        Call a function in the thread pool
 
-                if self._asked_brand:
-                    print("Bot: sorry there is no brand {0} in category {1}".format(self._brand, self._category))
-                    self._brand = None
-                    results, ncat, nbrand = self._get_results(cat=self._category, brand=self._brand)
-                    self._asked_brand = False
+        Whatever may block runs there, off the event loop: the first search,
+        completion, recommendation or product choice of a catalog version
+        builds its index, a store file is read and written.
+        """
 
-            if ncat==1 and self._category is None:
-                self._category = results.loc[results.index[0], 'category']
-            if nbrand==1 and self._brand is None:
-                self._brand = results.loc[results.index[0], 'brand']
+        import asyncio
 
+        return await asyncio.get_running_loop().run_in_executor(self._pool, function, *args)
 
-            # The main decision tree
-            if self._category is None and self._brand is None and self._searchtype is None:
+    async def _stored(self, method, *args):
+        """Call a method of the session store (in the thread pool if it blocks)"""
 
-                if self._asked_cat == True:
-                    print ("Bot: sorry, there is no such a product or category\n")
+        if not getattr(self._store, 'blocking', True):
+            return method(*args)
 
-                print ("""Bot: we have the following categories for you today:\n""")
-                self._list_categories(self._data)
-                print ("Bot: do you have a particular category in mind?\n")
+        return await self._pooled(method, *args)
 
-                self._asked_cat = True
-                self._asked_brand = False
+    def stats(self):
+        """Server metrics"""
 
-                self._searchtype = 'category'
+        stats = self.metrics.snapshot()
+        stats['sessions'] = len(self._store)
+        stats['catalog'] = self._bot.catalog_stats()
+        # turn stages, caches and catalog lookups of the bot
+        stats['bot'] = self._bot.metrics.snapshot()
+        # timers (of the server or the bot) whose p99 is over budget
+        stats['over_budget'] = dict(self._bot.metrics.violations(), **self.metrics.violations())
+        return stats
 
-            elif self._category is None and self._brand is None and self._searchtype is 'category':
+    async def handle(self, request):
+        """
+        Process one request
+        :param dict request: decoded request
+        :return: response dict
+        """
 
-                if self._asked_cat == True:
-                    print ("Bot: sorry, there is no such a product or category\n")
+        import asyncio
 
-                print ("Bot: We have the following categories for you today:\n")
-                self._list_categories(self._data)
-                print ("Bot: do you have a particular category in mind?\n")
+        if request.get('stats'):
+            return {'stats': await self._pooled(self.stats)}
 
-                self._asked_cat= True
-                self._asked_brand = False
+        if 'similar' in request:
+            return {'results': await self._pooled(self._bot.recommend, request['similar'], int(request.get('k', 5)))}
 
-            elif self._category is None and self._brand is None and self._searchtype is 'brand':
+        if 'suggest' in request:
+            return {'suggestions': await self._pooled(self._bot.suggest, str(request['suggest']),
+                                                      int(request.get('k', 10)))}
 
-                if self._asked_brand == True:
-                    print ("Bot: sorry, there is no such a product or category\n")
+        if 'search' in request:
+            return {'results': await self._pooled(self._bot.search, str(request['search']), int(request.get('k', 10)),
+                                                  request.get('category'), request.get('brand'))}
 
-                print ("Bot: We have the following brands for you today:\n")
-                self._list_brands(self._data)
-                print ("Bot: do you have a brand in mind?\n")
-                self._asked_brand= True
-                self._asked_cat = False
+        start = time.perf_counter()
+        sid = str(request['session'])
+        text = request.get('text')
 
-            elif self._category and nbrand>1:
-                if self._asked_brand:
-                    print ("Bot: Sorry, there is no such a brand in category {0}\n".format(self._category))
+        entry = self._locks.setdefault(sid, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                s, messages = await self._talk(sid, text)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[sid]
 
-                print("Bot: The category {0} has the following brands:\n".format(self._map[self._category]))
-                self._list_brands(results, self._category)
-                print ("Bot: do you have a particular brand in mind?\n")
+        self.metrics.incr('requests')
+        self.metrics.observe('request', time.perf_counter() - start)
 
-                self._asked_brand= True
-                self._asked_cat = False
+        return {'session': sid, 'messages': messages, 'done': s.stage == 'done'}
 
-            elif ncat>1 and self._brand:
+    async def _talk(self, sid, text):
+        """
+        Pass user message to the session (started if unknown) and store it back
+        :return: tuple (Session, list of bot messages)
+        """
 
-                if self._asked_cat:
-                    print ("Bot: Sorry, there is no such a category for brand {0}\n".format(self._brand))
+        messages = []
+        record = await self._stored(self._store.get, sid)
+        if record is None:
+            s = Session()
+            messages += self._bot.start(s)
+            self.metrics.incr('sessions')
+        else:
+            s = self._bot.load_session(record)
+
+        if text is not None:
+            key = self._bot.response_key(s, str(text))
+            replied = self._bot.replay(s, str(text), key)
+            if replied is None:
+                analyzed = await self._analyze(str(text))
+                replied = await self._pooled(self._bot.step, s, str(text), analyzed, key)
+            messages += replied
+
+        if s.stage == 'done':
+            await self._stored(self._store.delete, sid)
+        else:
+            await self._stored(self._store.put, sid, self._bot.save_session(s))
 
-                print("Bot: The brand {0} is in the following categories:\n".format(self._brand))
-                self._list_categories(results, self._brand)
-                print ("Bot: do you have a category in mind?\n")
-                self._asked_cat= True
-                self._asked_brand = False
+        return s, messages
 
-            elif ncat==1 and nbrand==1:
+    async def _client(self, reader, writer):
+        """Serve one connection"""
 
-                print(
-                    "Bot: Here is the list of options for brand {0} in {1}:\n".format(
-                        self._brand, self._map[self._category])
-                )
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
 
-                # ask user for particular item
-                self._ask_for_particular_item(results)
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                    response = await self.handle(request)
+                except (ValueError, KeyError, TypeError, AttributeError) as e:
+                    self.metrics.incr('errors')
+                    response = {'error': '{0}: {1}'.format(type(e).__name__, e)}
+
+                writer.write((json.dumps(response) + '\n').encode('utf-8'))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host='127.0.0.1', port=8765, path=None):
+        """
+        Serve forever
+        :param str host: host to listen on
+        :param int port: tcp port
+        :param str path: unix socket path (instead of host and port)
+        """
 
-                self._asked_conv = True
-                self._asked_cat = False
-                self._asked_brand = False
+        import asyncio
 
-            if not self._asked_conv:
-                self.current_input = input("User: ")
+        self._pending = asyncio.Semaphore(self._max_pending)
+        if path is not None:
+            server = await asyncio.start_unix_server(self._client, path=path)
+        else:
+            server = await asyncio.start_server(self._client, host, port)
+
+        async with server:
+            await server.serve_forever()
+
+
+def _batch_worker(FileName, options, inbox, outbox, batch_size=64, max_sessions=1024, max_idle=100000):
+    """
+    Worker process of run_batch: replays the sessions routed to it
+
+    The records already waiting (up to batch_size) are tagged together with
+    Bot.analyze_batch, then stepped in order. The max_sessions most recently
+    active sessions are kept as they are, the others packed into records
+    (Bot.save_session()) until max_idle more records were processed: then the
+    session is dropped, a later message of it starts a new conversation.
+    The worker always ends its output with None, after an {"error": ...}
+    record if it failed.
+    """
+
+    import queue
+
+    try:
+        bot = Bot(FileName, **options)
+        # session id -> (Session, number of the last record of the session), least recently active first
+        sessions = OrderedDict()
+        # session id -> (session record, number of the last record of the session), least recently active first
+        records = OrderedDict()
+        processed = 0
+        done = False
+        while not done:
+            batch = [inbox.get()]
+            while batch[-1] is not None and len(batch) < batch_size:
+                try:
+                    batch.append(inbox.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is None:
+                done = True
+                batch.pop()
+
+            analyzed = bot.analyze_batch([text for _, text in batch])
+            for (sid, text), result in zip(batch, analyzed):
+                processed += 1
+                s, _ = sessions.pop(sid, (None, None))
+                messages = []
+                if s is None:
+                    record, _ = records.pop(sid, (None, None))
+                    if record is None:
+                        s = Session()
+                        messages += bot.start(s)
+                    else:
+                        s = bot.load_session(record)
+                messages += bot.step(s, text, result)
+                if s.stage != 'done':
+                    sessions[sid] = (s, processed)
+                    if len(sessions) > max_sessions:
+                        idle, (idle_session, last) = sessions.popitem(last=False)
+                        records[idle] = (bot.save_session(idle_session), last)
+                while records and processed - next(iter(records.values()))[1] > max_idle:
+                    records.popitem(last=False)
+
+                outbox.put({'session_id': sid, 'text': text, 'replies': messages})
+    except Exception as e:
+        outbox.put({'error': '{0}: {1}'.format(type(e).__name__, e)})
+        raise
+    finally:
+        outbox.put(None)
+
+
+def run_batch(FileName, inp, out, processes=None, queue_size=1024, max_idle=100000, **options):
+    """
+    Replay user messages from json lines {"session_id": ..., "text": ...}
+
+    Sessions are spread over worker processes by session id, so the messages
+    of a session are processed in order by one Bot. Records are streamed in
+    and replies streamed out as json lines {"session_id", "text", "replies"},
+    memory only holds the recently active sessions, the records of the idle
+    ones and the bounded queues. A session that got no message while its
+    worker processed max_idle records is forgotten (its next message starts
+    a new conversation). When a worker fails, reading stops and the other
+    workers finish what they have.
+    :param str FileName: name of the .csv file with available products
+    :param inp: file object with input json lines
+    :param out: file object for output json lines
+    :param int processes: number of worker processes (default: number of cores)
+    :param int queue_size: maximal number of records waiting for each worker
+    :param int max_idle: number of records of a worker after which an idle session is forgotten
+    :param options: Bot constructor options
+    :return: number of processed records
+    :raises RuntimeError: if a worker failed
+    """
+
+    import multiprocessing
+    import queue
+
+    processes = processes or multiprocessing.cpu_count()
+    inboxes = [multiprocessing.Queue(queue_size) for _ in range(processes)]
+    outbox = multiprocessing.Queue(queue_size)
+    workers = [multiprocessing.Process(target=_batch_worker, args=(FileName, options, inbox, outbox),
+                                       kwargs={'max_idle': max_idle})
+               for inbox in inboxes]
+    for worker in workers:
+        worker.start()
+
+    counts = {'records': 0}
+
+    def write():
+        finished = 0
+        while finished < processes:
+            try:
+                record = outbox.get(timeout=0.5)
+            except queue.Empty:
+                # a worker killed before its None (its output is flushed once it exited)
+                if all(worker.exitcode is not None for worker in workers):
+                    break
+                continue
+            if record is None:
+                finished += 1
+                continue
+            out.write(json.dumps(record) + '\n')
+            counts['records'] += 1
+
+    def put(i, item):
+        """Queue item for worker i, False if the worker is gone (its inbox is not read any more)"""
+
+        while True:
+            try:
+                inboxes[i].put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                if workers[i].exitcode is not None:
+                    return False
+
+    writer = threading.Thread(target=write)
+    writer.start()
+
+    try:
+        for n, line in enumerate(inp, 1):
+            if n % 1024 == 0 and any(worker.exitcode is not None for worker in workers):
+                break
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                sid, text = str(record['session_id']), str(record['text'])
+            except (ValueError, KeyError, TypeError) as e:
+                outbox.put({'line': n, 'error': '{0}: {1}'.format(type(e).__name__, e)})
+                continue
+            if not put(zlib.crc32(sid.encode('utf-8')) % processes, (sid, text)):
+                break
+    finally:
+        for i, inbox in enumerate(inboxes):
+            if not put(i, None):
+                # nobody reads the records left in it, do not wait for them at exit
+                inbox.cancel_join_thread()
+        writer.join()
+        for worker in workers:
+            worker.join()
+
+    failed = [(i, worker.exitcode) for i, worker in enumerate(workers) if worker.exitcode]
+    if failed:
+        raise RuntimeError(', '.join('batch worker {0} failed (exit code {1})'.format(i, code)
+                                     for i, code in failed))
+
+    return counts['records']
 
-        print("Bot: See you later!")
 
 if __name__ == '__main__':
 
-    bot = Bot('data.csv')
-    bot.start_conversation()
+    parser = argparse.ArgumentParser(description='Grover ChatBot')
+    parser.add_argument('--catalog', default='data.csv', help='.csv file with available products')
+    parser.add_argument('--corrector', default='textblob', choices=('textblob', 'domain'))
+    parser.add_argument('--serve', metavar='HOST:PORT', help='run json server on tcp socket')
+    parser.add_argument('--unix', metavar='PATH', help='run json server on unix socket')
+    parser.add_argument('--workers', type=int, default=4, help='server threads for tagging')
+    parser.add_argument('--max-pending', type=int, default=64,
+                        help='server messages waiting for tagging before backpressure')
+    parser.add_argument('--micro-batch', type=int, default=1, metavar='N',
+                        help='server: tag up to N messages of all sessions together')
+    parser.add_argument('--micro-batch-delay', type=float, default=0.005, metavar='SECONDS',
+                        help='server: longest wait of a message for its batch to fill')
+    parser.add_argument('--sessions', metavar='FILE',
+                        help='server: keep sessions in an SQLite file (shared by servers, kept across restarts)')
+    parser.add_argument('--response-cache', type=int, default=1024, metavar='N',
+                        help='replies kept for repeated inputs in the same dialogue state (0: none)')
+    parser.add_argument('--batch', metavar='FILE',
+                        help='replay json lines {"session_id", "text"} from FILE (- for stdin)')
+    parser.add_argument('--output', metavar='FILE', help='batch replies (default: stdout)')
+    parser.add_argument('--processes', type=int, help='batch worker processes (default: all cores)')
+    parser.add_argument('--compile', metavar='SNAPSHOT',
+                        help='write binary snapshot of the catalog (use it as --catalog later)')
+    parser.add_argument('--watch', type=float, metavar='SECONDS',
+                        help='reload the catalog when its file changes (checked every SECONDS)')
+    parser.add_argument('--budget', action='append', default=[], metavar='TIMER=MS',
+                        help='latency budget of a bot or server timer, like tag=20 (repeatable)')
+    parser.add_argument('--metrics', metavar='FILE',
+                        help='export metrics to FILE (.json: json, otherwise Prometheus text)')
+    parser.add_argument('--metrics-interval', type=float, default=10.0, metavar='SECONDS',
+                        help='seconds between metrics exports')
+    parser.add_argument('--profile', metavar='FILE', help='sample stacks and write them folded to FILE at exit')
+    parser.add_argument('--profile-interval', type=float, default=0.005, metavar='SECONDS',
+                        help='seconds between stack samples')
+    args = parser.parse_args()
+
+    budgets = {}
+    for budget in args.budget:
+        name, _, ms = budget.partition('=')
+        try:
+            budgets[name] = float(ms) / 1000
+        except ValueError:
+            parser.error("--budget: expected TIMER=MS, got '{0}'".format(budget))
+
+    if args.compile:
+        bot = Bot(args.catalog)
+        bot.save_snapshot(args.compile)
+        load = bot.catalog_stats()['load']
+        print('{0} rows in {1:.2f} s ({2:.0f} rows/s), peak RSS {3:.0f} MB'.format(
+            load['rows'], load['seconds'], load['rows_per_s'], (load['peak_rss'] or 0) / 2 ** 20),
+            file=sys.stderr)
+        sys.exit(0)
+
+    if args.batch:
+        inp = sys.stdin if args.batch == '-' else open(args.batch)
+        out = sys.stdout if args.output is None else open(args.output, 'w')
+        with inp, out:
+            try:
+                run_batch(args.catalog, inp, out, processes=args.processes, corrector=args.corrector,
+                          response_cache_size=args.response_cache)
+            except RuntimeError as e:
+                sys.exit(str(e))
+        sys.exit(0)
+
+    bot = Bot(args.catalog, corrector=args.corrector, warm_up='background', budgets=budgets,
+              response_cache_size=args.response_cache)
+    if args.watch:
+        bot.watch(interval=args.watch)
+
+    metrics = {'chatbot_bot': bot.metrics}
+    server = None
+    if args.serve or args.unix:
+        store = SQLiteSessionStore(args.sessions) if args.sessions else None
+        server = ChatServer(bot, workers=args.workers, max_pending=args.max_pending, budgets=budgets,
+                            batch_size=args.micro_batch, batch_delay=args.micro_batch_delay, store=store)
+        metrics['chatbot_server'] = server.metrics
+
+    stop_export = None
+    if args.metrics:
+        stop_export = export_metrics_every(args.metrics, metrics, args.metrics_interval)
+    profiler = None
+    if args.profile:
+        profiler = SamplingProfiler(args.profile_interval, metrics.values())
+        profiler.start()
+
+    try:
+        if server is not None:
+            import asyncio
+
+            host, _, port = (args.serve or '').rpartition(':')
+            asyncio.run(server.serve(host or '127.0.0.1', int(port or 8765), path=args.unix))
+        else:
+            bot.start_conversation()
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            profiler.save(args.profile)
+        if stop_export is not None:
+            export_metrics(args.metrics, metrics)
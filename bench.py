@@ -0,0 +1,1011 @@
+"""
+Benchmarks for the ChatBot
+
+    python bench.py spell [--catalog data.csv]
+    python bench.py index [--sizes 1000 100000 1000000]
+    python bench.py catalog [--sizes 1000 100000]
+    python bench.py search [--sizes 1000 100000 1000000]
+    python bench.py typeahead [--sizes 1000 100000 1000000]
+    python bench.py recommend [--sizes 1000 100000 1000000]
+    python bench.py render [--sizes 6 100 1000]
+    python bench.py tagging [--batches 1 8 32 128]
+    python bench.py intents [--brands 10 1000 100000]
+    python bench.py sessions [--sessions 100000]
+    python bench.py startup [--catalog data.csv]
+    python bench.py snapshot [--sizes 1000 100000 1000000]
+    python bench.py ingest [--sizes 100000 1000000]
+    python bench.py dialogues [--sizes 10 1000 100000 1000000] [--response-cache 0] [--output results.json]
+    python bench.py compare BASELINE.json RESULTS.json [--tolerance 0.1]
+"""
+import argparse
+from io import StringIO
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import pandas as pd
+import prettytable
+
+from textblob import Word
+
+from Bot import Bot, DomainCorrector, TableRenderer
+
+
+def _misspell(word, rnd):
+    """Apply one random edit (delete, insert, replace or transpose) to the word"""
+
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    i = rnd.randrange(len(word))
+    edit = rnd.choice(('delete', 'insert', 'replace', 'transpose'))
+    if edit == 'delete':
+        return word[:i] + word[i+1:]
+    elif edit == 'insert':
+        return word[:i] + rnd.choice(letters) + word[i:]
+    elif edit == 'replace':
+        return word[:i] + rnd.choice(letters.replace(word[i], '')) + word[i+1:]
+    else:
+        i = min(i, len(word) - 2)
+        return word[:i] + word[i+1] + word[i] + word[i+2:]
+
+
+CATEGORIES = ['Phones & Tablets', 'Computing', 'Gaming & VR', 'Wearables', 'Smart Home', 'Drones']
+BRANDS = ['Apple', 'Samsung', 'Parrot', 'HTC', 'Oculus', 'Microsoft', 'Lenovo', 'Suunto',
+          'Polar', 'Asus', 'Amazon', 'Tchibo']
+
+
+def synthetic_catalog(FileName, rows, seed=0):
+    """
+    Write a random catalog in the data.csv format
+    :param str FileName: name of the .csv file
+    :param int rows: number of products
+    :param int seed: random seed
+    """
+
+    rnd = random.Random(seed)
+    # the real brands plus generated ones for the larger catalogs
+    brands = BRANDS + ['Brand{0}'.format(i) for i in range(max(0, rows // 500 - len(BRANDS)))]
+    # every brand sells in a couple of categories
+    brand_categories = {brand: rnd.sample(CATEGORIES, rnd.randint(1, 3)) for brand in brands}
+
+    names, product_brands, categories, plans = [], [], [], []
+    for i in range(rows):
+        brand = rnd.choice(brands)
+        names.append('{0} Model{1} {2}GB'.format(brand, i, rnd.choice((16, 32, 64, 128, 256))))
+        product_brands.append(brand)
+        categories.append(rnd.choice(brand_categories[brand]))
+        plans.append(rnd.randint(9, 99) + 0.99)
+
+    data = pd.DataFrame({'Product Name': names, 'Brand': product_brands,
+                         'Category': categories, 'Subscription Plan': plans},
+                        index=pd.Index(range(1, rows + 1), name='Product Id'))
+    data.to_csv(FileName)
+
+
+# dialogue paths of scripted_dialogues
+PATHS = ('category first', 'brand first', 'negation', 'mismatch', 'product selection')
+
+
+def scripted_dialogues(catalog, count, seed=0):
+    """
+    User turns of conversations over a synthetic catalog, one path after the other
+
+    Paths: 'category first' (category, brand, model), 'brand first' ('brand',
+    brand, category, model), 'negation' ("I don't want X but Y"), 'mismatch'
+    (a brand the category does not have, then a right one) and 'product
+    selection' (category and brand at once, then "something else"). Category
+    and brand answers are skipped when the bot would not ask for them.
+    :param CatalogIndex catalog: catalog of the bot
+    :param int count: number of conversations
+    :param int seed: random seed
+    :return: list of (path, list of user messages)
+    """
+
+    rnd = random.Random(seed)
+    dialogues = []
+    for i in range(count):
+        path = PATHS[i % len(PATHS)]
+        cat, brand = rnd.choice(catalog.pairs)
+        # the model word of one of its products ('Brand7 Model123 64GB' -> 'model123')
+        model = catalog.names[int(rnd.choice(catalog.rows(cat, brand)))].split(' ')[1].lower()
+        pick_brand = [brand] if catalog.num_brands(cat) > 1 else []
+        pick_category = [cat] if catalog.num_categories(brand) > 1 else []
+        others = [other for other in catalog.brands if other not in catalog.brands_of_category[cat]]
+
+        if path == 'category first':
+            turns = ['hi', 'yes', cat] + pick_brand + [model, 'bye']
+        elif path == 'brand first':
+            turns = ['yes', 'brand', brand] + pick_category + [model, 'bye']
+        elif path == 'negation' and len(catalog.brands) > 1:
+            other = rnd.choice([other for other in catalog.brands if other != brand])
+            turns = ["i don't want {0} but {1}".format(other, brand)] + pick_category + [model, 'exit']
+        elif path == 'mismatch' and others and pick_brand:
+            turns = ['yes', cat, rnd.choice(others), brand, model, 'bye']
+        else:
+            turns = ['{0} {1}'.format(cat, brand), 'something else', 'no']
+        dialogues.append((path, turns))
+
+    return dialogues
+
+
+def _time_per_call(func, words, repeat=3):
+    """Best average time of func over the words (seconds)"""
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for w in words:
+            func(w)
+        elapsed = (time.perf_counter() - start) / len(words)
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def bench_spell(args):
+    """Latency and accuracy of TextBlob correction vs the domain corrector"""
+
+    bot = Bot(args.catalog)
+    vocabulary = bot._domain_vocabulary(bot._catalog)
+    corrector = DomainCorrector(vocabulary, keywords=bot._control_words())
+    rnd = random.Random(args.seed)
+
+    # misspelled domain words (the corrector should restore them)
+    domain = [w for w in sorted(vocabulary) if len(w) >= 4 and w.isalpha()]
+    cases = []
+    for _ in range(args.samples):
+        word = rnd.choice(domain)
+        typo = _misspell(word, rnd)
+        if typo not in vocabulary:
+            cases.append((typo, word))
+    # correctly spelled words outside of the domain (should stay as they are)
+    for word in ('please', 'thanks', 'maybe', 'something', 'today', 'weather',
+                 'show', 'cheap', 'looking', 'options', 'family', 'music'):
+        cases.append((word, word))
+
+    words = [typo for typo, _ in cases]
+    engines = (('textblob', lambda w: str(Word(w).correct())),
+               ('domain', corrector.correct))
+
+    print('{0:>10} {1:>14} {2:>10}'.format('engine', 'us per word', 'accuracy'))
+    for name, func in engines:
+        latency = _time_per_call(func, words, repeat=1 if name == 'textblob' else 3)
+        accuracy = sum(func(typo) == word for typo, word in cases) / float(len(cases))
+        print('{0:>10} {1:>14.1f} {2:>10.3f}'.format(name, latency * 1e6, accuracy))
+
+
+def _object_frame(FileName, bot):
+    """Catalog as the object-dtype data frame the bot used to keep"""
+
+    data = pd.read_csv(FileName, index_col=0)
+    data.columns = ['name', 'brand', 'category', 'plan']
+    data['brand'] = data['brand'].apply(lambda x: x.lower())
+    for m, val in bot._map.items():
+        data.loc[data['category']==val, 'category'] = m
+
+    return data
+
+
+def _masked_results(data, cat, brand):
+    """Boolean mask lookup as done by Bot._get_results before the catalog index"""
+
+    if cat is not None and brand is not None:
+        results = data.loc[(data['category']==cat)&(data['brand']==brand), :]
+        return results, 1, 1
+    elif cat is not None:
+        results = data.loc[(data['category']==cat), :]
+        return results, 1, len(list(results['brand'].unique()))
+    else:
+        results = data.loc[(data['brand']==brand), :]
+        return results, len(list(results['category'].unique())), 1
+
+
+def bench_index(args):
+    """Per-turn catalog lookups: boolean masks vs the catalog index"""
+
+    tmp = tempfile.mkdtemp()
+    try:
+        print('{0:>9} {1:>10} {2:>14} {3:>14} {4:>9}'.format(
+            'rows', 'build s', 'mask us', 'index us', 'speedup'))
+        for rows in args.sizes:
+            FileName = os.path.join(tmp, 'catalog{0}.csv'.format(rows))
+            synthetic_catalog(FileName, rows, seed=args.seed)
+
+            start = time.perf_counter()
+            bot = Bot(FileName)
+            build = time.perf_counter() - start
+
+            rnd = random.Random(args.seed)
+            queries = []
+            for _ in range(args.queries):
+                cat = rnd.choice(sorted(bot._categories))
+                brand = rnd.choice(bot._catalog.brands)
+                queries.append(rnd.choice(((cat, None), (None, brand), (cat, brand))))
+
+            data = _object_frame(FileName, bot)
+            mask = _time_per_call(lambda q: _masked_results(data, *q), queries, repeat=1)
+            index = _time_per_call(lambda q: bot._get_results(bot._catalog, *q), queries)
+            print('{0:>9} {1:>10.2f} {2:>14.1f} {3:>14.1f} {4:>8.0f}x'.format(
+                rows, build, mask * 1e6, index * 1e6, mask / index))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def _masked_category_table(data, bot, brand):
+    """Category table from boolean masks, as built before the catalog index"""
+
+    if brand is None:
+        table = {'categories':[], 'number of brands': [], 'number of products':[]}
+    else:
+        table = {'categories':[], 'number of products':[]}
+
+    for cat in bot._categories:
+        if brand is None:
+            results = data.loc[data['category']==cat, :]
+            table['categories'].append(bot._map[cat])
+            table['number of brands'].append(len(list(results['brand'].unique())))
+            table['number of products'].append(len(results))
+        else:
+            results = data.loc[(data['category']==cat)&(data['brand']==brand), :]
+            if len(results):
+                table['categories'].append(bot._map[cat])
+                table['number of products'].append(len(results))
+
+    return table
+
+
+def _masked_brand_table(data, category):
+    """Brand table of a category from boolean masks, as built before the catalog index"""
+
+    table = {'brands':[], 'number of products': []}
+    for brand in list(data.loc[data['category']==category, 'brand'].unique()):
+        results = data.loc[(data['category']==category)&(data['brand']==brand), :]
+        if len(results):
+            table['brands'].append(brand)
+            table['number of products'].append(len(results))
+
+    return table
+
+
+def _masked_products(data, renderer, cat, brand):
+    """Product listing from a boolean mask and a sort, as done before the catalog index"""
+
+    products = data.loc[(data['category']==cat)&(data['brand']==brand), ['name', 'brand', 'plan']]
+    products.sort_values(by='plan', ascending=False, inplace=True)
+
+    return renderer.render([products.index.name] + list(products.columns), products.itertuples())
+
+
+def _masked_plan_range(data, cat, brand, high, cheapest=None):
+    """Products of a plan range from boolean masks and a sort"""
+
+    products = data.loc[(data['category']==cat)&(data['brand']==brand)&(data['plan']<=high), :]
+    if cheapest is not None:
+        products = products.sort_values(by='plan', kind='stable').head(cheapest)
+
+    return products.sort_values(by='plan', ascending=False, kind='stable')
+
+
+def bench_catalog(args):
+    """Memory and query methods: object-dtype data frame vs array-backed catalog"""
+
+    tmp = tempfile.mkdtemp()
+    try:
+        print('{0:>9} {1:>16} {2:>10} {3:>14} {4:>14} {5:>9}'.format(
+            'rows', 'query', 'queries', 'frame us', 'catalog us', 'speedup'))
+        for rows in args.sizes:
+            FileName = os.path.join(tmp, 'catalog{0}.csv'.format(rows))
+            synthetic_catalog(FileName, rows, seed=args.seed)
+            bot = Bot(FileName)
+            catalog = bot._catalog
+            data = _object_frame(FileName, bot)
+
+            rnd = random.Random(args.seed)
+            pairs = [rnd.choice(catalog.pairs) for _ in range(args.queries)]
+            ranges = [pair + (rnd.randint(9, 99),) for pair in pairs]
+            categories = [cat for cat, _ in pairs]
+            brands = [brand for _, brand in pairs]
+
+            cases = [('results', [(cat, None) for cat in categories] + [(None, brand) for brand in brands] + pairs,
+                      lambda q: _masked_results(data, *q), lambda q: bot._get_results(catalog, *q)),
+                     ('category table', [None] + brands,
+                      lambda brand: _masked_category_table(data, bot, brand),
+                      lambda brand: bot._category_table(catalog, brand)),
+                     ('brand table', categories,
+                      lambda cat: _masked_brand_table(data, cat),
+                      lambda cat: bot._brand_table(catalog, cat)),
+                     ('products', pairs,
+                      lambda q: _masked_products(data, bot._renderer, *q),
+                      lambda q: bot._list_products(catalog, catalog.rows(*q))),
+                     ('plan range', ranges,
+                      lambda q: _masked_plan_range(data, *q),
+                      lambda q: catalog.plan_rows(q[0], q[1], high=q[2])),
+                     ('cheapest 3', ranges,
+                      lambda q: _masked_plan_range(data, *q, cheapest=3),
+                      lambda q: catalog.plan_rows(q[0], q[1], high=q[2], cheapest=3))]
+
+            frame_mb = data.memory_usage(index=True, deep=True).sum() / 2 ** 20
+            print('{0:>9} {1:>16} {2:>10} {3:>12.1f}MB {4:>12.1f}MB {5:>8.1f}x'.format(
+                rows, 'memory', '', frame_mb, catalog.nbytes / 2 ** 20, frame_mb * 2 ** 20 / catalog.nbytes))
+            for name, queries, frame_query, catalog_query in cases:
+                frame = _time_per_call(frame_query, queries, repeat=1)
+                indexed = _time_per_call(catalog_query, queries)
+                print('{0:>9} {1:>16} {2:>10} {3:>14.1f} {4:>14.1f} {5:>8.0f}x'.format(
+                    rows, name, len(queries), frame * 1e6, indexed * 1e6, frame / indexed))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_search(args):
+    """Ranked product search: index build and top-k latency for full and partial model names"""
+
+    from Bot import percentile
+
+    tmp = tempfile.mkdtemp()
+    try:
+        print('{0:>9} {1:>9} {2:>9} {3:>8} {4:>9} {5:>9} {6:>7}'.format(
+            'rows', 'build s', 'index MB', 'query', 'p50 us', 'p99 us', 'top1'))
+        for rows in args.sizes:
+            FileName = os.path.join(tmp, 'catalog{0}.csv'.format(rows))
+            synthetic_catalog(FileName, rows, seed=args.seed)
+            catalog = Bot(FileName)._catalog
+
+            start = time.perf_counter()
+            search = catalog.search
+            build = time.perf_counter() - start
+
+            # the name of a random product ('Brand7 Model123 64GB'): its model word, brand and
+            # model, and the bare model number
+            rnd = random.Random(args.seed)
+            queries = {'full': [], 'partial': []}
+            for _ in range(args.queries):
+                pos = rnd.randrange(len(catalog))
+                words = catalog.names[pos].split(' ')
+                queries['full'].append((pos, rnd.choice((words[1], words[0] + ' ' + words[1]))))
+                queries['partial'].append((pos, words[1][5:]))
+
+            for kind in ('full', 'partial'):
+                latencies, found = [], 0
+                for pos, query in queries[kind]:
+                    start = time.perf_counter()
+                    hits = search.top(query, args.k)
+                    latencies.append(time.perf_counter() - start)
+                    # the product is among the best matches (ties included)
+                    found += any(hit == pos for hit, score in hits if score == hits[0][1])
+                print('{0:>9} {1:>9.2f} {2:>9.1f} {3:>8} {4:>9.0f} {5:>9.0f} {6:>7.2f}'.format(
+                    rows, build, search.nbytes / 2 ** 20, kind, percentile(latencies, 50) * 1e6,
+                    percentile(latencies, 99) * 1e6, found / float(len(queries[kind]))))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def _typed_products(catalog, prefix, k):
+    """Best k products with a name word starting with prefix, by plan (a scan over all names)"""
+
+    prefix = prefix.lstrip().encode('utf-8').lower()
+    found = []
+    for pos, name in enumerate(catalog.names.tolist()):
+        name = name.encode('utf-8').lower()
+        starts = [i for i in range(len(name)) if name[i:i + 1].isalnum() and not name[i - 1:i].isalnum()]
+        if any(name.startswith(prefix, i) for i in starts):
+            found.append((-float(catalog.plans[pos]), pos))
+
+    return [pos for _, pos in sorted(found)[:k]]
+
+
+def bench_typeahead(args):
+    """Typeahead: index build and latency per keystroke (checked against a scan of the names on small catalogs)"""
+
+    from Bot import percentile
+
+    tmp = tempfile.mkdtemp()
+    try:
+        print('{0:>9} {1:>9} {2:>9} {3:>10} {4:>9} {5:>9} {6:>9}'.format(
+            'rows', 'build s', 'index MB', 'keystrokes', 'p50 us', 'p99 us', 'max us'))
+        for rows in args.sizes:
+            FileName = os.path.join(tmp, 'catalog{0}.csv'.format(rows))
+            synthetic_catalog(FileName, rows, seed=args.seed)
+            bot = Bot(FileName)
+            catalog = bot._catalog
+
+            start = time.perf_counter()
+            bot.suggest('a', args.k)
+            build = time.perf_counter() - start
+
+            # typing out product names and brands, one keystroke at a time
+            rnd = random.Random(args.seed)
+            prefixes = []
+            for _ in range(args.words):
+                word = rnd.choice((catalog.names[rnd.randrange(len(catalog))], rnd.choice(catalog.brands)))
+                prefixes += [word[:i] for i in range(1, len(word) + 1)]
+
+            latencies = []
+            for prefix in prefixes:
+                start = time.perf_counter()
+                bot.suggest(prefix, args.k)
+                latencies.append(time.perf_counter() - start)
+            print('{0:>9} {1:>9.2f} {2:>9.1f} {3:>10} {4:>9.0f} {5:>9.0f} {6:>9.0f}'.format(
+                rows, build, catalog.typeahead.nbytes / 2 ** 20, len(prefixes), percentile(latencies, 50) * 1e6,
+                percentile(latencies, 99) * 1e6, max(latencies) * 1e6))
+
+            if rows <= args.check:
+                typeahead = catalog.typeahead
+                for prefix in prefixes[::7]:
+                    entries = typeahead.top(prefix, args.k)
+                    products = [entry for entry in entries if typeahead.keyword(entry) is None]
+                    if products != _typed_products(catalog, prefix, args.k - len(entries) + len(products)):
+                        raise AssertionError('typeahead differs from a scan for {0!r}'.format(prefix))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_recommend(args):
+    """Similar products: pruned candidates vs scoring the whole catalog"""
+
+    import numpy as np
+
+    from Bot import percentile
+
+    tmp = tempfile.mkdtemp()
+    try:
+        print('{0:>9} {1:>9} {2:>9} {3:>10} {4:>9} {5:>9} {6:>9} {7:>7}'.format(
+            'rows', 'build s', 'index MB', 'candidates', 'p50 ms', 'p99 ms', 'all ms', 'recall'))
+        for rows in args.sizes:
+            FileName = os.path.join(tmp, 'catalog{0}.csv'.format(rows))
+            synthetic_catalog(FileName, rows, seed=args.seed)
+            catalog = Bot(FileName)._catalog
+
+            start = time.perf_counter()
+            recommender = catalog.recommender
+            build = time.perf_counter() - start
+
+            rnd = random.Random(args.seed)
+            products = [rnd.randrange(len(catalog)) for _ in range(args.queries)]
+            latencies, candidates = [], 0
+            for pos in products:
+                start = time.perf_counter()
+                recommender.similar(pos, args.k)
+                latencies.append(time.perf_counter() - start)
+                candidates += len(recommender.candidates(pos))
+
+            # every product of another brand or with a lower plan scored: are the best ones found?
+            everything = np.arange(len(catalog))
+            brute, found, expected = [], 0, 0
+            for pos in products[:args.check]:
+                start = time.perf_counter()
+                allowed = everything[((catalog.brand_codes != catalog.brand_codes[pos]) |
+                                      (catalog.plans < catalog.plans[pos])) & (everything != pos)]
+                scores = np.sort(recommender.scores(pos, allowed))[::-1][:args.k]
+                brute.append(time.perf_counter() - start)
+                if len(scores):
+                    best = [score for _, score in recommender.similar(pos, args.k)]
+                    found += sum(score >= scores[-1] - 1e-6 for score in best)
+                    expected += len(scores)
+
+            print('{0:>9} {1:>9.2f} {2:>9.1f} {3:>10.0f} {4:>9.2f} {5:>9.2f} {6:>9.2f} {7:>7.2f}'.format(
+                rows, build, (catalog.search.nbytes + recommender.nbytes) / 2 ** 20, candidates / len(products),
+                percentile(latencies, 50) * 1e3, percentile(latencies, 99) * 1e3,
+                percentile(brute, 50) * 1e3, found / float(expected or 1)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def bench_tagging(args):
+    """Tagging and normalization: one message at a time vs Bot.analyze_batch"""
+
+    from loadgen import CONVERSATIONS
+
+    bot = Bot(args.catalog, warm_up='now')
+    rnd = random.Random(args.seed)
+    # messages of the scripted conversations, with a random product name now and then
+    names = bot._catalog.names.tolist()
+    messages = [rnd.choice(rnd.choice(CONVERSATIONS)) if rnd.random() < 0.8 else rnd.choice(names).lower()
+                for _ in range(args.messages)]
+
+    # spelling corrections of new words are the same work either way: fill the word cache first
+    for text in messages:
+        bot.analyze(text)
+
+    print('{0:>7} {1:>12} {2:>12} {3:>9}'.format('batch', 'messages/s', 'us/message', 'speedup'))
+    single = None
+    for size in args.batches:
+        start = time.perf_counter()
+        if size == 1:
+            results = [bot.analyze(text) for text in messages]
+        else:
+            results = []
+            for i in range(0, len(messages), size):
+                results += bot.analyze_batch(messages[i:i + size])
+        elapsed = time.perf_counter() - start
+        if single is None:
+            single, expected = elapsed, results
+        elif results != expected:
+            raise AssertionError('analyze_batch({0}) differs from analyze'.format(size))
+        print('{0:>7} {1:>12.0f} {2:>12.1f} {3:>8.1f}x'.format(
+            size, len(messages) / elapsed, elapsed / len(messages) * 1e6, single / elapsed))
+
+
+def _scanned_intent(bot, words, raw_input, brands):
+    """Decisions of a message the way the _check_* methods made them: one scan per question"""
+
+    kept = bot._analyze_sentence_structure(words)
+    brand_mentioned = any(w in brands for w in words)
+    return (any(w in bot._quit_words for w in words),
+            any(w in bot._greet_words for w in words),
+            bool(('ye' in words or 'yep' in words or 'yeah' in words or
+                  ('would' in words and 'not' not in words))),
+            bool(('no' in words or 'not' in words or 'nope' in raw_input) and not brand_mentioned),
+            next((w for w in kept if w in bot._categories), None),
+            next((w for w in bot._analyze_sentence_structure(words) if w in brands), None),
+            'category' if 'category' in words else 'brand' if 'brand' in words else None,
+            any(w in bot._categories for w in words),
+            brand_mentioned)
+
+
+def bench_intents(args):
+    """Intent decisions of a message: repeated scans over a brand list vs IntentExtractor"""
+
+    from loadgen import CONVERSATIONS
+
+    bot = Bot(args.catalog)
+    rnd = random.Random(args.seed)
+    print('{0:>9} {1:>12} {2:>12} {3:>9}'.format('brands', 'scans us', 'extract us', 'speedup'))
+    for count in args.brands:
+        brands = ['brand{0}'.format(i) for i in range(count)]
+        brand_code = {brand: i for i, brand in enumerate(brands)}
+        messages = []
+        for _ in range(args.messages):
+            words = rnd.choice(rnd.choice(CONVERSATIONS)).lower().split()
+            if rnd.random() < 0.5:
+                words.insert(rnd.randint(0, len(words)), rnd.choice(brands))
+            messages.append((words, ' '.join(words)))
+
+        for words, raw_input in messages:
+            intent = bot._intents.extract(words, raw_input, brand_code)
+            extracted = (intent.quit, intent.greet, intent.yes, intent.no, intent.category, intent.brand,
+                         intent.searchtype, intent.category_mentioned, intent.brand_mentioned)
+            if extracted != _scanned_intent(bot, words, raw_input, brands):
+                raise AssertionError('IntentExtractor differs on {0!r}'.format(raw_input))
+
+        scans = _time_per_call(lambda m: _scanned_intent(bot, m[0], m[1], brands), messages, repeat=1)
+        extract = _time_per_call(lambda m: bot._intents.extract(m[0], m[1], brand_code), messages)
+        print('{0:>9} {1:>12.1f} {2:>12.1f} {3:>8.0f}x'.format(count, scans * 1e6, extract * 1e6, scans / extract))
+
+
+def bench_sessions(args):
+    """Session records: size, pack/resume time, memory of idle sessions and the SQLite store"""
+
+    import tracemalloc
+
+    from loadgen import CONVERSATIONS
+    from Bot import MemorySessionStore, Session, SQLiteSessionStore
+
+    bot = Bot(args.catalog)
+    # sessions stopped after every turn of the scripted conversations
+    samples = []
+    for turns in CONVERSATIONS:
+        s = Session()
+        bot.start(s)
+        for text in turns:
+            samples.append(s.pack())
+            bot.step(s, text)
+    sessions = [bot.load_session(record) for record in samples]
+    sizes = [len(record) for record in samples]
+    print('record bytes: mean {0:.1f}, max {1}'.format(sum(sizes) / len(sizes), max(sizes)))
+    print('pack {0:.1f} us, resume {1:.1f} us'.format(_time_per_call(Session.pack, sessions * 10) * 1e6,
+                                                      _time_per_call(bot.load_session, samples * 10) * 1e6))
+
+    ids = ['session{0}'.format(i) for i in range(args.sessions)]
+    for kind in ('objects', 'records'):
+        tracemalloc.start()
+        if kind == 'objects':
+            kept = {sid: bot.load_session(samples[i % len(samples)]) for i, sid in enumerate(ids)}
+        else:
+            kept = MemorySessionStore()
+            for i, sid in enumerate(ids):
+                kept.put(sid, bytes(bytearray(samples[i % len(samples)])))
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del kept
+        print('{0} idle sessions as {1}: {2:.1f} MB ({3:.0f} bytes each)'.format(
+            args.sessions, kind, size / 2 ** 20, size / args.sessions))
+
+    tmp = tempfile.mkdtemp()
+    try:
+        store = SQLiteSessionStore(os.path.join(tmp, 'sessions.db'))
+        put = _time_per_call(lambda sid: store.put(sid, samples[hash(sid) % len(samples)]), ids[:args.queries])
+        get = _time_per_call(store.get, ids[:args.queries])
+        store.close()
+        print('SQLite store: put {0:.1f} us, get {1:.1f} us'.format(put * 1e6, get * 1e6))
+    finally:
+        shutil.rmtree(tmp)
+
+
+def _prettytable_render(df):
+    """DataFrame -> CSV -> prettytable round trip the bot used to print tables"""
+
+    output = StringIO()
+    df.to_csv(output)
+    output.seek(0)
+    return str(prettytable.from_csv(output))
+
+
+def bench_render(args):
+    """Table rendering: prettytable round trip vs TableRenderer"""
+
+    rnd = random.Random(args.seed)
+    print('{0:>7} {1:>16} {2:>12} {3:>12} {4:>12}'.format(
+        'rows', 'prettytable us', 'table us', 'text us', 'json us'))
+    for rows in args.sizes:
+        table = {'brands': ['brand{0}'.format(i) for i in range(rows)],
+                 'number of categories': [rnd.randint(1, 6) for _ in range(rows)],
+                 'number of products': [rnd.randint(1, 5000) for _ in range(rows)]}
+        header = list(table)
+        body = list(zip(*table.values()))
+
+        df = pd.DataFrame(table)
+        timings = [_time_per_call(lambda _: _prettytable_render(df), range(args.repeat))]
+        for output_format in TableRenderer.formats:
+            renderer = TableRenderer(output_format)
+            timings.append(_time_per_call(
+                lambda _: renderer.render(header, body, numbered=True), range(args.repeat)))
+        print('{0:>7} {1:>16.1f} {2:>12.1f} {3:>12.1f} {4:>12.1f}'.format(
+            rows, *[t * 1e6 for t in timings]))
+
+
+def bench_snapshot(args):
+    """Catalog loading: .csv file vs binary snapshot"""
+
+    tmp = tempfile.mkdtemp()
+    try:
+        print('{0:>9} {1:>10} {2:>12} {3:>10} {4:>12}'.format('rows', 'csv MB', 'csv load s', 'snap MB', 'snap load s'))
+        for rows in args.sizes:
+            csv_file = os.path.join(tmp, 'catalog{0}.csv'.format(rows))
+            snap_file = os.path.join(tmp, 'catalog{0}.snap'.format(rows))
+            synthetic_catalog(csv_file, rows, seed=args.seed)
+
+            start = time.perf_counter()
+            bot = Bot(csv_file)
+            csv_load = time.perf_counter() - start
+            bot.save_snapshot(snap_file)
+            start = time.perf_counter()
+            Bot(snap_file)
+            snap_load = time.perf_counter() - start
+
+            print('{0:>9} {1:>10.1f} {2:>12.3f} {3:>10.1f} {4:>12.3f}'.format(
+                rows, os.path.getsize(csv_file) / 1e6, csv_load, os.path.getsize(snap_file) / 1e6, snap_load))
+    finally:
+        shutil.rmtree(tmp)
+
+
+# run in a fresh interpreter: read the catalog one-shot (as the bot used to) or in chunks
+_INGEST = """
+import json, sys, time
+import pandas as pd
+from Bot import CatalogIndex, peak_rss
+base = peak_rss()
+start = time.perf_counter()
+if sys.argv[2] == 'one-shot':
+    data = pd.read_csv(sys.argv[1], index_col=0)
+    data.columns = ['name', 'brand', 'category', 'plan']
+    data['brand'] = data['brand'].apply(lambda x: x.lower())
+    nbytes = int(data.memory_usage(deep=True).sum())
+else:
+    data = CatalogIndex.read_csv(sys.argv[1])
+    nbytes = data.nbytes
+seconds = time.perf_counter() - start
+print(json.dumps({'rows_per_s': len(data) / seconds, 'rss': peak_rss() - base, 'catalog': nbytes}))
+"""
+
+
+def bench_ingest(args):
+    """Reading the .csv catalog: one-shot read_csv vs chunked loader (rows/s and peak RSS growth)"""
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    tmp = tempfile.mkdtemp()
+    try:
+        print('{0:>9} {1:>10} {2:>12} {3:>12} {4:>11}'.format('rows', 'loader', 'rows/s', 'peak RSS MB', 'catalog MB'))
+        for rows in args.sizes:
+            FileName = os.path.join(tmp, 'catalog{0}.csv'.format(rows))
+            synthetic_catalog(FileName, rows, seed=args.seed)
+            for loader in ('one-shot', 'chunked'):
+                proc = subprocess.run([sys.executable, '-c', _INGEST, FileName, loader],
+                                      cwd=here, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+                result = json.loads(proc.stdout.strip().splitlines()[-1])
+                print('{0:>9} {1:>10} {2:>12.0f} {3:>12.1f} {4:>11.1f}'.format(
+                    rows, loader, result['rows_per_s'], result['rss'] / 2 ** 20, result['catalog'] / 2 ** 20))
+    finally:
+        shutil.rmtree(tmp)
+
+
+# run in a fresh interpreter (own peak RSS): replay scripted dialogues, time every turn
+_DIALOGUES = """
+import json, sys, time
+from Bot import Bot, Session, percentile, peak_rss
+from bench import scripted_dialogues
+start = time.perf_counter()
+bot = Bot(sys.argv[1], corrector=sys.argv[4], warm_up='now', response_cache_size=int(sys.argv[5]))
+build = time.perf_counter() - start
+dialogues = scripted_dialogues(bot._catalog, int(sys.argv[2]), int(sys.argv[3]))
+# warm the tables and the search index outside the measure (words met first are still corrected in it)
+for _, turns in dialogues[:len(dialogues) // 10 + 1]:
+    s = Session()
+    bot.start(s)
+    for text in turns:
+        bot.step(s, text)
+bot.metrics = type(bot.metrics)()
+latencies, paths = [], {}
+start = time.perf_counter()
+for path, turns in dialogues:
+    s = Session()
+    bot.start(s)
+    for text in turns:
+        turn = time.perf_counter()
+        bot.step(s, text)
+        latencies.append(time.perf_counter() - turn)
+        paths.setdefault(path, []).append(latencies[-1])
+elapsed = time.perf_counter() - start
+snapshot = bot.metrics.snapshot()
+stages, counters = snapshot['timers'], snapshot['counters']
+print(json.dumps({'build_s': build, 'dialogues': len(dialogues), 'turns': len(latencies),
+                  'p50_ms': percentile(latencies, 50) * 1e3, 'p99_ms': percentile(latencies, 99) * 1e3,
+                  'turns_per_s': len(latencies) / elapsed, 'peak_rss_mb': peak_rss() / 2 ** 20,
+                  'catalog_mb': bot._catalog.nbytes / 2 ** 20,
+                  'response_hit_rate': counters.get('response_cache_hits', 0) / len(latencies),
+                  'paths': {path: {'turns': len(values), 'p50_ms': percentile(values, 50) * 1e3,
+                                   'p99_ms': percentile(values, 99) * 1e3} for path, values in paths.items()},
+                  'stages': {name: {'p50_ms': timer['p50'] * 1e3, 'p99_ms': timer['p99'] * 1e3}
+                             for name, timer in stages.items()}}))
+"""
+
+
+def _git_commit(here):
+    """Commit of the working tree (None outside git)"""
+
+    try:
+        proc = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=here, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+    return proc.stdout.strip()
+
+
+def bench_dialogues(args):
+    """Scripted conversations over synthetic catalogs: turn latency, throughput and peak memory"""
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    tmp = tempfile.mkdtemp()
+    results = []
+    try:
+        print('{0:>9} {1:>8} {2:>7} {3:>9} {4:>9} {5:>10} {6:>12} {7:>11}'.format(
+            'rows', 'build s', 'turns', 'p50 ms', 'p99 ms', 'turns/s', 'peak RSS MB', 'catalog MB'))
+        for rows in args.sizes:
+            FileName = os.path.join(tmp, 'catalog{0}.csv'.format(rows))
+            synthetic_catalog(FileName, rows, seed=args.seed)
+            proc = subprocess.run([sys.executable, '-c', _DIALOGUES, FileName, str(args.dialogues), str(args.seed),
+                                   args.corrector, str(args.response_cache)], cwd=here, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            result['rows'] = rows
+            results.append(result)
+            print('{0:>9} {1:>8.2f} {2:>7} {3:>9.2f} {4:>9.2f} {5:>10.0f} {6:>12.1f} {7:>11.1f}'.format(
+                rows, result['build_s'], result['turns'], result['p50_ms'], result['p99_ms'],
+                result['turns_per_s'], result['peak_rss_mb'], result['catalog_mb']))
+            if args.verbose:
+                print('{0:>9}   {1:<21} {2:>5.0f}%'.format('', 'cached replies', result['response_hit_rate'] * 100))
+                for path in PATHS:
+                    if path in result['paths']:
+                        timing = result['paths'][path]
+                        print('{0:>9}   {1:<21} {2:>5} {3:>9.2f} {4:>9.2f}'.format(
+                            '', path, timing['turns'], timing['p50_ms'], timing['p99_ms']))
+                for name, timing in sorted(result['stages'].items()):
+                    print('{0:>9}   {1:<21} {2:>5} {3:>9.2f} {4:>9.2f}'.format(
+                        '', 'stage ' + name, '', timing['p50_ms'], timing['p99_ms']))
+    finally:
+        shutil.rmtree(tmp)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': _git_commit(here), 'python': sys.version.split()[0], 'dialogues': args.dialogues,
+                       'seed': args.seed, 'corrector': args.corrector, 'response_cache': args.response_cache,
+                       'results': results},
+                      f, indent=1, sort_keys=True)
+
+
+# lower is better, except turns_per_s
+_COMPARED = ('p50_ms', 'p99_ms', 'turns_per_s', 'peak_rss_mb', 'build_s')
+
+
+def bench_compare(args):
+    """Compare two result files of the dialogues benchmark; exit status 1 on regressions"""
+
+    with open(args.baseline) as f:
+        baseline = {result['rows']: result for result in json.load(f)['results']}
+    with open(args.results) as f:
+        results = json.load(f)['results']
+
+    regressions = 0
+    print('{0:>9} {1:>12} {2:>12} {3:>12} {4:>8}'.format('rows', 'metric', 'baseline', 'results', 'change'))
+    for result in results:
+        base = baseline.get(result['rows'])
+        if base is None:
+            continue
+        for metric in _COMPARED:
+            change = result[metric] / base[metric] - 1 if base[metric] else 0.0
+            worse = -change if metric == 'turns_per_s' else change
+            flag = '  worse' if worse > args.tolerance else ''
+            regressions += bool(flag)
+            print('{0:>9} {1:>12} {2:>12.2f} {3:>12.2f} {4:>+7.0%}{5}'.format(
+                result['rows'], metric, base[metric], result[metric], change, flag))
+
+    if regressions:
+        sys.exit(1)
+
+
+# run in a fresh interpreter: time to import Bot, build it and answer the first message
+_FIRST_REPLY = """
+import json, sys, time
+start = time.perf_counter()
+import Bot
+imported = time.perf_counter()
+bot = Bot.Bot(sys.argv[1], warm_up=None if sys.argv[2] == 'none' else sys.argv[2])
+built = time.perf_counter()
+time.sleep(float(sys.argv[3]))
+session = Bot.Session()
+bot.start(session)
+bot.step(session, 'hi, I want a phone')
+replied = time.perf_counter()
+print(json.dumps({'import': imported - start, 'construct': built - imported,
+                  'first reply': replied - built - float(sys.argv[3])}))
+"""
+
+
+def bench_startup(args):
+    """Import time breakdown (-X importtime) and time to the first reply"""
+
+    here = os.path.dirname(os.path.abspath(__file__))
+
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import Bot'],
+                          cwd=here, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    imports = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        head, cumulative_us, name = line.split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0 and name.strip() != 'Bot':
+            # interpreter startup (site), not imported by Bot
+            imports = []
+            continue
+        imports.append((int(cumulative_us), int(head.split(':')[1]), depth, name.strip()))
+
+    print('import Bot: {0:.1f} ms'.format(imports[-1][0] / 1e3))
+    print('{0:>12} {1:>10}  {2}'.format('cumulative', 'self', 'module (imported by Bot)'))
+    for cumulative_us, self_us, depth, name in sorted(imports, reverse=True)[:args.top]:
+        if depth <= 1:
+            print('{0:>9.1f} ms {1:>7.1f} ms  {2}'.format(cumulative_us / 1e3, self_us / 1e3, name))
+
+    print()
+    print('{0:>12} {1:>10} {2:>12} {3:>14}'.format('warm_up', 'import s', 'construct s', 'first reply s'))
+    for warm_up in ('none', 'background', 'now'):
+        proc = subprocess.run([sys.executable, '-c', _FIRST_REPLY, args.catalog, warm_up, str(args.think)],
+                              cwd=here, stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        timing = json.loads(proc.stdout.strip().splitlines()[-1])
+        print('{0:>12} {1:>10.3f} {2:>12.3f} {3:>14.3f}'.format(
+            warm_up, timing['import'], timing['construct'], timing['first reply']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='ChatBot benchmarks')
+    subparsers = parser.add_subparsers(dest='bench')
+    subparsers.required = True
+
+    spell = subparsers.add_parser('spell', help='spell correction latency and accuracy')
+    spell.add_argument('--catalog', default='data.csv')
+    spell.add_argument('--samples', type=int, default=300)
+    spell.add_argument('--seed', type=int, default=0)
+    spell.set_defaults(func=bench_spell)
+
+    index = subparsers.add_parser('index', help='catalog lookups at several catalog sizes')
+    index.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    index.add_argument('--queries', type=int, default=200)
+    index.add_argument('--seed', type=int, default=0)
+    index.set_defaults(func=bench_index)
+
+    catalog = subparsers.add_parser('catalog', help='catalog memory and query methods at several catalog sizes')
+    catalog.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000])
+    catalog.add_argument('--queries', type=int, default=20)
+    catalog.add_argument('--seed', type=int, default=0)
+    catalog.set_defaults(func=bench_catalog)
+
+    search = subparsers.add_parser('search', help='ranked product search at several catalog sizes')
+    search.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    search.add_argument('--queries', type=int, default=300)
+    search.add_argument('-k', type=int, default=10)
+    search.add_argument('--seed', type=int, default=0)
+    search.set_defaults(func=bench_search)
+
+    typeahead = subparsers.add_parser('typeahead', help='completions per keystroke at several catalog sizes')
+    typeahead.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    typeahead.add_argument('--words', type=int, default=200, help='number of names and brands typed out')
+    typeahead.add_argument('-k', type=int, default=10)
+    typeahead.add_argument('--check', type=int, default=10000, help='compare with a scan of the names up to this size')
+    typeahead.add_argument('--seed', type=int, default=0)
+    typeahead.set_defaults(func=bench_typeahead)
+
+    recommend = subparsers.add_parser('recommend', help='similar products at several catalog sizes')
+    recommend.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    recommend.add_argument('--queries', type=int, default=300)
+    recommend.add_argument('--check', type=int, default=50, help='number of queries also scored against every product')
+    recommend.add_argument('-k', type=int, default=5)
+    recommend.add_argument('--seed', type=int, default=0)
+    recommend.set_defaults(func=bench_recommend)
+
+    tagging = subparsers.add_parser('tagging', help='tagging one message at a time vs in batches')
+    tagging.add_argument('--catalog', default='data.csv')
+    tagging.add_argument('--messages', type=int, default=2000)
+    tagging.add_argument('--batches', type=int, nargs='+', default=[1, 8, 32, 128],
+                         help='batch sizes (1: one analyze() per message, measured first)')
+    tagging.add_argument('--seed', type=int, default=0)
+    tagging.set_defaults(func=bench_tagging)
+
+    intents = subparsers.add_parser('intents', help='intent decisions of a message at several brand counts')
+    intents.add_argument('--catalog', default='data.csv')
+    intents.add_argument('--brands', type=int, nargs='+', default=[10, 1000, 100000])
+    intents.add_argument('--messages', type=int, default=2000)
+    intents.add_argument('--seed', type=int, default=0)
+    intents.set_defaults(func=bench_intents)
+
+    sessions = subparsers.add_parser('sessions', help='session records and stores')
+    sessions.add_argument('--catalog', default='data.csv')
+    sessions.add_argument('--sessions', type=int, default=100000, help='number of idle sessions held')
+    sessions.add_argument('--queries', type=int, default=2000, help='number of SQLite puts and gets')
+    sessions.set_defaults(func=bench_sessions)
+
+    render = subparsers.add_parser('render', help='table rendering')
+    render.add_argument('--sizes', type=int, nargs='+', default=[6, 100, 1000])
+    render.add_argument('--repeat', type=int, default=50)
+    render.add_argument('--seed', type=int, default=0)
+    render.set_defaults(func=bench_render)
+
+    startup = subparsers.add_parser('startup', help='import time and time to first reply')
+    startup.add_argument('--catalog', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data.csv'))
+    startup.add_argument('--think', type=float, default=0.0,
+                         help='seconds the user takes to type the first message')
+    startup.add_argument('--top', type=int, default=25, help='number of slowest imports to show')
+    startup.set_defaults(func=bench_startup)
+
+    snapshot = subparsers.add_parser('snapshot', help='catalog loading from .csv and snapshot')
+    snapshot.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    snapshot.add_argument('--seed', type=int, default=0)
+    snapshot.set_defaults(func=bench_snapshot)
+
+    ingest = subparsers.add_parser('ingest', help='chunked .csv loading speed and memory')
+    ingest.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000])
+    ingest.add_argument('--seed', type=int, default=0)
+    ingest.set_defaults(func=bench_ingest)
+
+    dialogues = subparsers.add_parser('dialogues', help='scripted conversations over synthetic catalogs')
+    dialogues.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 100000, 1000000])
+    dialogues.add_argument('--dialogues', type=int, default=200)
+    dialogues.add_argument('--seed', type=int, default=0)
+    dialogues.add_argument('--corrector', default='textblob', choices=('textblob', 'domain'))
+    dialogues.add_argument('--response-cache', type=int, default=1024, metavar='N',
+                           help='size of the bot response cache (0: none)')
+    dialogues.add_argument('--output', metavar='FILE', help='save the results as json')
+    dialogues.add_argument('-v', '--verbose', action='store_true', help='latency per path and per stage')
+    dialogues.set_defaults(func=bench_dialogues)
+
+    compare = subparsers.add_parser('compare', help='compare two dialogues result files')
+    compare.add_argument('baseline')
+    compare.add_argument('results')
+    compare.add_argument('--tolerance', type=float, default=0.1, help='relative change reported as worse')
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,93 @@
+"""
+Load generator for the ChatBot json server
+
+    python Bot.py --serve 127.0.0.1:8765 &
+    python loadgen.py --port 8765 --users 50 --rounds 4
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from Bot import percentile
+
+
+# scripted conversations (user messages after the welcome)
+CONVERSATIONS = [
+    ["hi", "phones", "apple", "plus", "bye"],
+    ["yes", "i want a laptop", "lenovo", "no", "bye"],
+    ["show me brands", "samsung", "home", "29.99", "quit"],
+    ["yes", "category", "drone", "yes", "bebop 2", "no"],
+    ["I don't want apple but samsung", "phone", "s8+", "exit"],
+    ["nope"],
+    ["what", "yes please", "apple", "clock", "42mm", "leave"],
+    ["watch", "asus", "bye"],
+    ["yes", "computer", "microsoft", "hello", "bye"],
+    ["yes", "apple", "drone", "no", "yes", "games", "htc", "bye"],
+    ["macbook pro", "13", "bye"],
+    ["yes", "brand", "oculus", "bye"],
+    ["yes", "vacuum cleaner", "something else", "bye"],
+]
+
+
+async def _connect(args):
+    if args.unix:
+        return await asyncio.open_unix_connection(args.unix)
+    return await asyncio.open_connection(args.host, args.port)
+
+
+async def _request(reader, writer, request):
+    writer.write((json.dumps(request) + '\n').encode('utf-8'))
+    await writer.drain()
+    return json.loads((await reader.readline()).decode('utf-8'))
+
+
+async def _user(uid, args, latencies, errors):
+    """One virtual user replaying conversations over its own connection"""
+
+    reader, writer = await _connect(args)
+    try:
+        for r in range(args.rounds):
+            conversation = CONVERSATIONS[(uid + r) % len(CONVERSATIONS)]
+            sid = 'user{0}-{1}'.format(uid, r)
+            for text in [None] + conversation:
+                request = {'session': sid}
+                if text is not None:
+                    request['text'] = text
+                start = time.perf_counter()
+                response = await _request(reader, writer, request)
+                latencies.append(time.perf_counter() - start)
+                if 'error' in response:
+                    errors.append(response['error'])
+    finally:
+        writer.close()
+
+
+async def run(args):
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(*[_user(uid, args, latencies, errors) for uid in range(args.users)])
+    elapsed = time.perf_counter() - start
+
+    reader, writer = await _connect(args)
+    stats = (await _request(reader, writer, {'stats': True}))['stats']
+    writer.close()
+
+    print('requests: {0}, errors: {1}, {2:.1f} s, {3:.1f} requests/s'.format(
+        len(latencies), len(errors), elapsed, len(latencies) / elapsed))
+    print('client latency ms: p50 {0:.1f}, p90 {1:.1f}, p99 {2:.1f}, max {3:.1f}'.format(
+        *[1e3 * percentile(latencies, q) for q in (50, 90, 99, 100)]))
+    for name, timer in sorted(stats['timers'].items()):
+        print('server {0:>8} ms: p50 {1:.1f}, p99 {2:.1f}, max {3:.1f}'.format(
+            name, 1e3 * timer['p50'], 1e3 * timer['p99'], 1e3 * timer['max']))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='ChatBot server load generator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix', metavar='PATH', help='connect to unix socket instead')
+    parser.add_argument('--users', type=int, default=20, help='concurrent connections')
+    parser.add_argument('--rounds', type=int, default=3, help='conversations per user')
+    asyncio.run(run(parser.parse_args()))
@@ -0,0 +1,197 @@
+"""
+Decisions of the bot on user messages: quit, greeting, yes/no, category,
+brand and search type (with the negation rules), and a few dialogues.
+
+Messages are given with the words analyze() makes of them, so no NLP model
+is needed, except by the last test.
+"""
+import os
+
+import pytest
+
+from conftest import ROOT
+from Bot import Bot, Session
+
+
+@pytest.fixture(scope='module')
+def bot():
+    return Bot(os.path.join(ROOT, 'data.csv'))
+
+
+def analyzed(bot, text, words=None):
+    """
+    analyze() result of a message
+    :param str text: user message
+    :param str words: its normalized words (default: the words of the rewritten message)
+    """
+
+    if words is None:
+        words = bot._preprocess_inp(text)
+    words = words.split()
+    return words, ['NN'] * len(words), text.lower()
+
+
+def decisions(bot, text, words=None):
+    """What the _check_* and _get_* methods decide on a message"""
+
+    s = Session()
+    s.catalog = bot._catalog
+    bot._set_input(s, text, analyzed(bot, text, words))
+
+    return {'quit': bot._check_usr_quit(s),
+            'greet': bot._check_for_greeting(s),
+            'yes': bot._check_yes_input(s),
+            'no': bot._check_no_input(s),
+            'category': bot._get_category_from_input(s),
+            'brand': bot._get_brand_from_input(s),
+            'searchtype': bot._get_searchtype_from_input(s),
+            'category_mentioned': bot._check_for_category_keywords(s),
+            'brand_mentioned': bot._check_for_brand_keywords(s)}
+
+
+NOTHING = {'quit': False, 'greet': False, 'yes': False, 'no': False, 'category': None, 'brand': None,
+           'searchtype': None, 'category_mentioned': False, 'brand_mentioned': False}
+
+# message, its normalized words (None: as rewritten), decisions other than NOTHING
+CASES = [
+    ('bye', None, {'quit': True}),
+    ('ok bye-bye', None, {'quit': True}),
+    ('exit', None, {'quit': True}),
+    ('leave', None, {'quit': True}),
+    ('hi', None, {'greet': True}),
+    ('hello there', None, {'greet': True}),
+    ('yes', 'ye', {'yes': True}),
+    ('yeah sure', None, {'yes': True}),
+    ('yep', None, {'yes': True}),
+    ('i would like a phone', None, {'yes': True, 'category': 'phone', 'category_mentioned': True}),
+    ('i would not', None, {'no': True}),
+    ('no', None, {'no': True}),
+    ('nope', 'hope', {'no': True}),
+    ('what', None, {}),
+    ('search by brand', None, {'searchtype': 'brand'}),
+    ('category or brand', None, {'searchtype': 'category'}),
+    ('laptop', None, {'category': 'computer', 'category_mentioned': True}),
+    ('macbook air', None, {'category': 'computer', 'brand': 'apple',
+                           'category_mentioned': True, 'brand_mentioned': True}),
+    ('show me a computer from apple', None, {'category': 'computer', 'brand': 'apple',
+                                             'category_mentioned': True, 'brand_mentioned': True}),
+    # negated brands are mentioned but not taken, a named brand is not a 'no'
+    ("I don't want apple but samsung", None, {'brand': 'samsung', 'brand_mentioned': True}),
+    ('no apple but samsung', None, {'brand': 'samsung', 'brand_mentioned': True}),
+    ('i hate apple', None, {'brand_mentioned': True}),
+    ('not samsung', None, {'brand_mentioned': True}),
+    ("i don't hate apple", None, {'brand': 'apple', 'brand_mentioned': True}),
+    ('i dislike apple but i want a computer', None, {'category': 'computer',
+                                                     'category_mentioned': True, 'brand_mentioned': True}),
+    ('no phone, a drone', 'no phone a drone', {'category': None, 'category_mentioned': True, 'no': True}),
+]
+
+
+@pytest.mark.parametrize('text, words, expected', CASES)
+def test_decisions(bot, text, words, expected):
+    assert decisions(bot, text, words) == dict(NOTHING, **expected)
+
+
+@pytest.mark.parametrize('text, words, expected', CASES)
+def test_slots_follow_sentence_structure(bot, text, words, expected):
+    # the first category and brand of the words left by _analyze_sentence_structure
+    words = analyzed(bot, text, words)[0]
+    kept = bot._analyze_sentence_structure(words)
+    found = decisions(bot, text, ' '.join(words))
+    assert found['category'] == next((w for w in kept if w in bot._categories), None)
+    assert found['brand'] == next((w for w in kept if w in bot._catalog.brand_code), None)
+
+
+def talk(bot, messages):
+    """
+    Run a dialogue
+    :param list messages: user messages, or (message, normalized words) pairs
+    :return: tuple (bot sentences (tables left out), stage after each message)
+    """
+
+    s = Session()
+    out = bot.start(s)
+    stages = []
+    for message in messages:
+        text, words = message if isinstance(message, tuple) else (message, None)
+        out += bot.step(s, text, analyzed(bot, text, words))
+        stages.append(s.stage)
+
+    return [line for line in out if line.startswith('Bot:')], stages
+
+
+def test_category_brand_product(bot):
+    lines, stages = talk(bot, ['hi', 'phone', 'apple', 'plus', 'bye'])
+    assert stages == ['main', 'main', 'product', 'conv', 'done']
+    assert lines == ['Bot: Welcome!\n',
+                     'Bot: would you like to look at our products?',
+                     'Bot: Hi there!\n',
+                     'Bot: we have the following categories for you today:\n',
+                     'Bot: do you have a particular category in mind?\n',
+                     'Bot: The category Phones & Tablets has the following brands:\n',
+                     'Bot: do you have a particular brand in mind?\n',
+                     'Bot: Here is the list of options for brand apple in Phones & Tablets:\n',
+                     'Bot: which product would you like?',
+                     'Bot: you got it!',
+                     'Bot: you may also like:\n',
+                     'Bot: would you like to look at our products?',
+                     'Bot: See you later!']
+
+
+def test_negated_brand(bot):
+    lines, stages = talk(bot, ["I don't want apple but samsung", 'phone', 's8+', 'exit'])
+    assert stages == ['main', 'product', 'conv', 'done']
+    assert lines[2:6] == ['Bot: The brand samsung is in the following categories:\n',
+                          'Bot: do you have a category in mind?\n',
+                          'Bot: Here is the list of options for brand samsung in Phones & Tablets:\n',
+                          'Bot: which product would you like?']
+
+
+def test_brand_search_type(bot):
+    lines, stages = talk(bot, [('yes', 'ye'), 'brand', 'oculus', 'bye'])
+    assert stages == ['main', 'main', 'conv', 'done']
+    assert lines[2:8] == ['Bot: we have the following categories for you today:\n',
+                          'Bot: do you have a particular category in mind?\n',
+                          'Bot: We have the following brands for you today:\n',
+                          'Bot: do you have a brand in mind?\n',
+                          'Bot: Here is the list of options for brand oculus in Gaming & VR:\n',
+                          'Bot: you got it!']
+
+
+def test_no_and_unknown_input(bot):
+    assert talk(bot, [('nope', 'hope')]) == (['Bot: Welcome!\n', 'Bot: would you like to look at our products?',
+                                              'Bot: See you later!'], ['done'])
+    lines, stages = talk(bot, ['what', ('yes please', 'ye please'), 'apple', 'clock', '42mm', 'leave'])
+    assert stages == ['conv', 'main', 'main', 'product', 'conv', 'done']
+    assert lines[2:9] == ['Bot: Sorry? Would you like to look at our products?',
+                          'Bot: we have the following categories for you today:\n',
+                          'Bot: do you have a particular category in mind?\n',
+                          'Bot: Sorry, there is no such a category for brand apple\n',
+                          'Bot: The brand apple is in the following categories:\n',
+                          'Bot: do you have a category in mind?\n',
+                          'Bot: Here is the list of options for brand apple in Wearables:\n']
+
+
+def _nlp_models():
+    """Check if the NLTK data TextBlob uses (tokenizer, tagger, lemmatizer) is installed"""
+
+    import nltk
+
+    for resource in ('tokenizers/punkt_tab', 'taggers/averaged_perceptron_tagger_eng', 'corpora/wordnet'):
+        try:
+            nltk.data.find(resource)
+        except LookupError:
+            return False
+
+    return True
+
+
+@pytest.mark.skipif(not _nlp_models(), reason='NLTK data is not installed (python -m textblob.download_corpora)')
+def test_step_analyzes_input(bot):
+    s = Session()
+    bot.start(s)
+    stages = []
+    for text in ['hi', 'phones', 'apple', 'plus', 'bye']:
+        bot.step(s, text)
+        stages.append(s.stage)
+    assert stages == ['main', 'main', 'product', 'conv', 'done']
@@ -0,0 +1,87 @@
+"""
+Session records: a conversation packed by one bot continues in another.
+"""
+import os
+
+import pytest
+
+from conftest import ROOT
+from test_intents import analyzed
+from Bot import Bot, Session
+
+
+@pytest.fixture(scope='module')
+def sku_catalog(tmp_path_factory):
+    """data.csv with product ids like 'SKU-1'"""
+
+    with open(os.path.join(ROOT, 'data.csv')) as f:
+        lines = f.read().splitlines()
+    path = tmp_path_factory.mktemp('catalog') / 'sku.csv'
+    path.write_text('\n'.join([lines[0]] + ['SKU-' + line for line in lines[1:]]) + '\n')
+    return str(path)
+
+
+def test_pack_string_ids(sku_catalog):
+    bot = Bot(sku_catalog)
+    assert bot._catalog.ids.dtype.kind == 'O'
+
+    s = Session()
+    bot.start(s)
+    for text in ['phone', 'apple']:
+        bot.step(s, text, analyzed(bot, text))
+    assert s.stage == 'product'
+
+    other = Bot(sku_catalog)
+    resumed = other.load_session(s.pack())
+    assert resumed.catalog is other._catalog
+    assert resumed.catalog.fingerprint == s.catalog.fingerprint
+    assert resumed.candidates is not None
+    for name in Session.STATE[:-1]:
+        assert getattr(resumed, name) == getattr(s, name)
+    assert other.step(resumed, 'plus', analyzed(other, 'plus')) == bot.step(s, 'plus', analyzed(bot, 'plus'))
+
+
+def test_reload_keeps_versions_of_saved_records(tmp_path):
+    import gc
+
+    with open(os.path.join(ROOT, 'data.csv')) as f:
+        lines = f.read().splitlines()
+    changed = tmp_path / 'changed.csv'
+    changed.write_text('\n'.join(lines[:-1]) + '\n')
+
+    bot = Bot(os.path.join(ROOT, 'data.csv'))
+    s = Session()
+    bot.start(s)
+    for text in ['phone', 'apple']:
+        bot.step(s, text, analyzed(bot, text))
+    record = bot.save_session(s)
+    del s
+
+    for _ in range(3):
+        bot.reload(str(changed))
+    gc.collect()
+    # only the version of the stored record is kept
+    assert bot.catalog_stats()['old_versions'] == [1]
+    s = bot.load_session(record)
+    assert s.catalog.version == 1 and s.stage == 'product'
+
+    bot._version_ttl = 0.0
+    del s
+    gc.collect()
+    assert bot.catalog_stats()['old_versions'] == []
+
+
+def test_snapshot_string_ids(sku_catalog, tmp_path):
+    bot = Bot(sku_catalog)
+    snapshot = str(tmp_path / 'sku.snap')
+    bot.save_snapshot(snapshot)
+    mapped = Bot(snapshot)
+    assert mapped._catalog.ids.tolist() == bot._catalog.ids.tolist()
+    assert mapped._catalog.fingerprint == bot._catalog.fingerprint
+
+    s = Session()
+    bot.start(s)
+    for text in ['phone', 'apple']:
+        bot.step(s, text, analyzed(bot, text))
+    resumed = mapped.load_session(bot.save_session(s))
+    assert resumed.catalog is mapped._catalog and resumed.candidates == s.candidates